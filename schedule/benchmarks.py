@@ -0,0 +1,585 @@
+"""
+Benchmarks of the hot paths of django-schedule, run with
+
+    ./manage.py schedule_benchmark [name name ...]
+
+A benchmark is a function registered with the ``benchmark`` decorator.  It
+takes the ``size`` to run at and returns a list of (label, seconds, count)
+tuples, ``count`` being the number of items ``seconds`` were spent on, so
+the per-item cost can be reported.
+
+``--json results.json`` stores the results of a run, and ``--baseline
+results.json`` compares a run with stored results and fails when an item
+became slower by more than ``--tolerance``::
+
+    ./manage.py schedule_benchmark --json baseline.json
+    ./manage.py schedule_benchmark --baseline baseline.json
+"""
+import datetime
+import time
+
+from django.utils.datastructures import SortedDict
+
+BENCHMARKS = SortedDict()
+
+def benchmark(name, size):
+    """
+    Registers a benchmark under ``name``, to run at ``size`` by default.
+    """
+    def dec(func):
+        func.default_size = size
+        BENCHMARKS[name] = func
+        return func
+    return dec
+
+def best_of(func, repeat=3):
+    """
+    Calls ``func`` ``repeat`` times and returns the shortest run in seconds.
+    """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+    return min(timings)
+
+def run_benchmark(name, size=None):
+    """
+    Runs the benchmark called ``name`` at ``size`` (its own size by default)
+    and returns its results as a list of dicts, ready to be stored as JSON.
+    """
+    func = BENCHMARKS[name]
+    size = size or func.default_size
+    return [{'benchmark': name, 'size': size, 'label': label, 'seconds': seconds,
+        'count': count, 'us_per_item': seconds * 1000000 / max(count, 1)}
+        for label, seconds, count in func(size)]
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Compares ``results`` with the ``baseline`` results of an earlier run.
+    Returns a list of (result, baseline us per item or None, ratio or None,
+    regressed) tuples, one per result.  A result regressed if its cost per
+    item grew by more than ``tolerance``.
+    """
+    previous = dict([((r['benchmark'], r['size'], r['label']), r['us_per_item'])
+        for r in baseline])
+    comparison = []
+    for result in results:
+        before = previous.get((result['benchmark'], result['size'], result['label']))
+        if not before:
+            comparison.append((result, before, None, False))
+            continue
+        ratio = result['us_per_item'] / before
+        comparison.append((result, before, ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+@benchmark('atom_feed', 1000)
+def atom_feed(size):
+    """
+    Writes an atom feed of ``size`` entries built from plain objects, with
+    validation and with the STREAM production mode.
+    """
+    from schedule.feeds.atom import ChunkBuffer, Feed
+
+    class Item(object):
+        def __init__(self, i):
+            self.id = i
+            self.title = u'Item %d' % i
+            self.updated = datetime.datetime(2009, 1, 1) + datetime.timedelta(minutes=i)
+
+    class BenchmarkFeed(Feed):
+        feed_id = 'benchmark'
+        feed_title = 'Benchmark'
+
+        def items(self):
+            return [Item(i) for i in xrange(size)]
+
+        def item_id(self, item):
+            return str(item.id)
+
+        def item_title(self, item):
+            return item.title
+
+        def item_updated(self, item):
+            return item.updated
+
+        def item_authors(self, item):
+            return [{'name': 'author'}]
+
+        def item_content(self, item):
+            return item.title
+
+    class ProductionFeed(BenchmarkFeed):
+        VALIDATE = False
+        STREAM = True
+
+        def feed_updated(self):
+            return datetime.datetime(2009, 1, 1)
+
+    def write():
+        BenchmarkFeed(None, None).get_feed().write(ChunkBuffer(), 'utf-8')
+
+    def stream():
+        for chunk in ProductionFeed(None, None).get_feed().iter_write('utf-8'):
+            pass
+
+    return [
+        ('validated', best_of(write), size),
+        ('production', best_of(stream), size),
+    ]
+
+
+@benchmark('event_relations', 1000000)
+def event_relations(size):
+    """
+    Looks up the events of one object with
+    ``EventRelation.objects.get_events_for_object`` among ``size`` event
+    relations and ``size / 10`` calendar relations, spread over ``size / 10``
+    objects, ``size / 100`` events and 100 calendars.  The rows are inserted
+    in a transaction that is rolled back.
+    """
+    import random
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import transaction
+    from schedule.models import Calendar, CalendarRelation, Event, EventRelation
+    from schedule.utils import bulk_insert
+
+    rand = random.Random(0)
+    objects = max(size // 10, 1)
+    distinctions = ['owner', 'viewer', 'editor']
+    ct = ContentType.objects.get_for_model(User)
+    start = datetime.datetime(2009, 1, 1)
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        started = time.time()
+        calendars = []
+        for i in range(100):
+            calendar = Calendar(name='Benchmark %d' % i, slug='benchmark-%d' % i)
+            calendar.save()
+            calendars.append(calendar)
+        bulk_insert(Event, [Event(calendar=rand.choice(calendars),
+            title='Event %d' % i, start=start, end=start)
+            for i in xrange(max(size // 100, 1))])
+        event_ids = list(Event.objects.filter(
+            calendar__in=calendars).values_list('id', flat=True))
+        batch = 10000
+        for offset in xrange(0, size, batch):
+            bulk_insert(EventRelation, [EventRelation(content_type=ct,
+                object_id=rand.randrange(objects), event_id=rand.choice(event_ids),
+                distinction=rand.choice(distinctions))
+                for i in xrange(min(batch, size - offset))])
+        bulk_insert(CalendarRelation, [CalendarRelation(content_type=ct,
+            object_id=rand.randrange(objects), calendar=rand.choice(calendars),
+            distinction=rand.choice(distinctions), inheritable=True)
+            for i in xrange(objects)])
+        inserted = time.time() - started
+
+        user = User(id=objects // 2)
+        def direct():
+            list(EventRelation.objects.get_events_for_object(user, 'owner', inherit=False))
+        def inherited():
+            list(EventRelation.objects.get_events_for_object(user, 'owner'))
+        def any_distinction():
+            list(EventRelation.objects.get_events_for_object(user))
+        return [
+            ('insert', inserted, size),
+            ('direct', best_of(direct), 1),
+            ('inherited', best_of(inherited), 1),
+            ('any distinction', best_of(any_distinction), 1),
+        ]
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark('bulk_relations', 50000)
+def bulk_relations(size):
+    """
+    Attaches ``size`` users to a calendar and to an event, changes the
+    distinction of those relations and removes them, with the bulk relation
+    APIs.  The rows are inserted in a transaction that is rolled back.
+    """
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from schedule.models import Calendar, CalendarRelation, Event, EventRelation
+    from schedule.utils import bulk_insert
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        bulk_insert(User, (User(username='benchmark%d' % i) for i in xrange(size)))
+        users = User.objects.filter(username__startswith='benchmark')
+        calendar = Calendar(name='Benchmark', slug='benchmark')
+        calendar.save()
+        event = Event(calendar=calendar, title='Benchmark',
+            start=datetime.datetime(2009, 1, 1), end=datetime.datetime(2009, 1, 1))
+        event.save()
+        rows = []
+        for label, func in (
+            ('calendar relations', lambda: calendar.bulk_create_relations(users, 'member')),
+            ('event relations', lambda: event.bulk_create_relations(users, 'attendee')),
+            ('change distinction', lambda: EventRelation.objects.change_distinction(
+                'attendee', 'guest')),
+            ('remove', lambda: CalendarRelation.objects.remove_relations(calendar, users)),
+        ):
+            started = time.time()
+            func()
+            rows.append((label, time.time() - started, size))
+        return rows
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark('occurrence_options', 400)
+def occurrence_options(size):
+    """
+    Builds the urls of the ``options`` tag for ``size`` occurrences of 20
+    events, one occurrence at a time with ``reverse()`` as the tag used to,
+    and with ``attach_occurrence_options``.
+    """
+    from django.contrib.auth.models import User
+    from django.core.urlresolvers import reverse
+    from django.db import transaction
+    from schedule.conf.settings import CHECK_PERMISSION_FUNC
+    from schedule.models import Calendar, Event, Rule
+    from schedule.utils import attach_occurrence_options
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        calendar = Calendar(name='Benchmark', slug='benchmark')
+        calendar.save()
+        rule = Rule(frequency='DAILY', name='Benchmark')
+        rule.save()
+        start = datetime.datetime(2009, 1, 1, 9)
+        occurrences = []
+        for i in range(20):
+            event = Event(calendar=calendar, rule=rule, title='Event %d' % i,
+                start=start, end=start + datetime.timedelta(hours=1))
+            event.save()
+            event = Event.objects.get(pk=event.pk)
+            occurrences += event.get_occurrences(start,
+                start + datetime.timedelta(days=max(size // 20, 1)))
+        user = User(username='benchmark', is_active=True)
+
+        def one_by_one():
+            for occurrence in occurrences:
+                occurrence.get_absolute_url()
+                if CHECK_PERMISSION_FUNC(occurrence.event, user):
+                    occurrence.get_edit_url()
+                    occurrence.get_cancel_url()
+                    reverse('delete_event', args=(occurrence.event.id,))
+                    reverse('edit_event', args=(occurrence.event.calendar.slug,
+                        occurrence.event.id,))
+
+        def batched():
+            attach_occurrence_options(occurrences, user)
+
+        return [
+            ('reverse', best_of(one_by_one), len(occurrences)),
+            ('batched', best_of(batched), len(occurrences)),
+        ]
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark('occurrence_urls', 10000)
+def occurrence_urls(size):
+    """
+    Builds the view, edit and cancel urls of ``size`` unpersisted
+    occurrences with ``reverse()`` and with ``Occurrence.get_absolute_url``,
+    ``get_edit_url`` and ``get_cancel_url``, which use URLBuilders.
+    """
+    from django.core.urlresolvers import reverse
+    from schedule.models import Event, Occurrence
+
+    event = Event(id=1, title='Benchmark', description='')
+    start = datetime.datetime(2009, 1, 1, 9)
+    occurrences = [Occurrence(event=event, title=event.title, description='',
+        start=start + datetime.timedelta(hours=i), end=start + datetime.timedelta(hours=i, minutes=30),
+        original_start=start + datetime.timedelta(hours=i),
+        original_end=start + datetime.timedelta(hours=i, minutes=30))
+        for i in xrange(size)]
+
+    def with_reverse():
+        for occurrence in occurrences:
+            for name in ('occurrence_by_date', 'edit_occurrence_by_date',
+                'cancel_occurrence_by_date'):
+                reverse(name, kwargs={
+                    'event_id': occurrence.event.id,
+                    'year': occurrence.start.year,
+                    'month': occurrence.start.month,
+                    'day': occurrence.start.day,
+                    'hour': occurrence.start.hour,
+                    'minute': occurrence.start.minute,
+                    'second': occurrence.start.second,
+                })
+
+    def built():
+        for occurrence in occurrences:
+            occurrence.get_absolute_url()
+            occurrence.get_edit_url()
+            occurrence.get_cancel_url()
+
+    return [
+        ('reverse', best_of(with_reverse), size),
+        ('builder', best_of(built), size),
+    ]
+
+
+# the rule shapes the expansion benchmarks run on, as (frequency, params)
+RULE_SHAPES = SortedDict([
+    ('once', None),
+    ('daily', ('DAILY', None)),
+    ('weekdays', ('WEEKLY', 'byweekday:0,1,2,3,4')),
+    ('monthly', ('MONTHLY', 'bymonthday:1,15')),
+    ('hourly', ('HOURLY', 'byhour:8,9,10,11,12,13,14,15,16,17')),
+])
+
+EXPANSION_START = datetime.datetime(2009, 1, 1)
+
+def create_shaped_events(size):
+    """
+    Creates ``size`` events of each of the RULE_SHAPES, starting over the
+    first ten days of 2009, one in ten with its first occurrence persisted
+    and moved by an hour.  Returns a dict mapping each shape to its events,
+    with their rules loaded.  Call it in a transaction that is rolled back.
+    """
+    from schedule.models import Calendar, Event, Occurrence, Rule
+    from schedule.utils import bulk_insert
+
+    calendar = Calendar(name='Benchmark', slug='benchmark')
+    calendar.save()
+    events = SortedDict()
+    hour = datetime.timedelta(hours=1)
+    for shape, rule in RULE_SHAPES.items():
+        if rule is not None:
+            rule = Rule(frequency=rule[0], params=rule[1], name=shape)
+            rule.save()
+        shaped = []
+        for i in xrange(size):
+            start = EXPANSION_START + datetime.timedelta(days=i % 10, hours=8 + i % 8)
+            event = Event(calendar=calendar, rule=rule, title='%s %d' % (shape, i),
+                description='', start=start, end=start + hour)
+            event.save()
+            shaped.append(event)
+        bulk_insert(Occurrence, [Occurrence(event=event, title=event.title,
+            description='', start=event.start + hour, end=event.end + hour,
+            original_start=event.start, original_end=event.end)
+            for event in shaped[::10]])
+        events[shape] = list(Event.objects.filter(
+            pk__in=[event.pk for event in shaped]).select_related('rule'))
+    return events
+
+
+@benchmark('get_occurrences', 50)
+def get_occurrences(size):
+    """
+    Calls ``Event.get_occurrences`` for January 2009 on ``size`` events of
+    each rule shape.  The count is the number of occurrences returned.
+    """
+    from django.db import transaction
+
+    end = EXPANSION_START + datetime.timedelta(days=31)
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        rows = []
+        for shape, events in create_shaped_events(size).items():
+            count = sum([len(event.get_occurrences(EXPANSION_START, end)) for event in events])
+            rows.append((shape, best_of(lambda: [event.get_occurrences(EXPANSION_START, end)
+                for event in events]), count))
+        return rows
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark('occurrences_after', 50)
+def occurrences_after(size):
+    """
+    Takes the first 100 occurrences of ``Event._occurrences_after_generator``
+    for ``size`` events of each rule shape, and then the first ``100 * size``
+    occurrences of ``EventListManager.occurrences_after`` on the events of
+    all the shapes together.
+    """
+    import itertools
+    from django.db import transaction
+    from schedule.utils import EventListManager
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        rows = []
+        shaped = create_shaped_events(size)
+        for shape, events in shaped.items():
+            def generate():
+                return sum([len(list(itertools.islice(
+                    event._occurrences_after_generator(EXPANSION_START), 100)))
+                    for event in events])
+            rows.append(('generator %s' % shape, best_of(generate), generate()))
+        events = []
+        for shape_events in shaped.values():
+            events += shape_events
+        def merged():
+            return len(list(itertools.islice(
+                EventListManager(events).occurrences_after(EXPANSION_START), 100 * size)))
+        rows.append(('event list', best_of(merged), merged()))
+        return rows
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark('occurrence_replacer', 10000)
+def occurrence_replacer(size):
+    """
+    Builds an ``OccurrenceReplacer`` from ``size`` persisted occurrences of
+    100 events and looks up ``2 * size`` generated occurrences in it, half
+    of which are replaced.  Nothing touches the database.
+    """
+    from schedule.models import Event, Occurrence
+    from schedule.utils import OccurrenceReplacer
+
+    hour = datetime.timedelta(hours=1)
+    events = [Event(id=i + 1, title='Event %d' % i, description='') for i in range(100)]
+    def occurrence(i):
+        event = events[i % 100]
+        start = EXPANSION_START + hour * (i // 100)
+        return Occurrence(event=event, title=event.title, description='',
+            start=start, end=start + hour, original_start=start, original_end=start + hour)
+    persisted = [occurrence(i) for i in xrange(0, 2 * size, 2)]
+    generated = [occurrence(i) for i in xrange(2 * size)]
+
+    def build():
+        return OccurrenceReplacer(persisted)
+    def replace():
+        replacer = OccurrenceReplacer(persisted)
+        for occ in generated:
+            if replacer.has_occurrence(occ):
+                replacer.get_occurrence(occ)
+        replacer.get_additional_occurrences(EXPANSION_START, EXPANSION_START + hour)
+    return [
+        ('build', best_of(build), size),
+        ('build and replace', best_of(replace), 2 * size),
+    ]
+
+
+@benchmark('sub_periods', 50)
+def sub_periods(size):
+    """
+    Splits January 2009 into its weeks and days and 2009 into its months,
+    with ``size`` daily events whose occurrences are already expanded, so
+    only the creation of the sub periods is timed.
+    """
+    from django.db import transaction
+    from schedule.periods import Month, Year
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        events = create_shaped_events(size)['daily']
+        month = Month(events, EXPANSION_START)
+        year = Year(events, EXPANSION_START)
+        month.occurrences, year.occurrences
+        return [
+            ('month weeks', best_of(lambda: list(month.get_weeks())), len(list(month.get_weeks()))),
+            ('month days', best_of(lambda: list(month.get_days())), len(list(month.get_days()))),
+            ('year months', best_of(lambda: list(year.get_months())), 12),
+        ]
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark('cook_occurrences', 50)
+def cook_occurrences(size):
+    """
+    Lays out ``size`` and ``4 * size`` occurrences of one day with
+    ``_cook_occurrences``, as the ``daily_table`` tag does.  The
+    occurrences are 90 minutes long and start every 10 minutes, so many
+    overlap.
+    """
+    from schedule.models import Event, Occurrence
+    from schedule.periods import Period
+    from schedule.templatetags.scheduletags import _cook_occurrences
+
+    start = EXPANSION_START + datetime.timedelta(hours=8)
+    period = Period([], start, start + datetime.timedelta(hours=12))
+    event = Event(id=1, title='Benchmark', description='')
+    rows = []
+    for count in (size, 4 * size):
+        occurrences = []
+        for i in xrange(count):
+            o_start = start + datetime.timedelta(minutes=10 * (i % 66))
+            o_end = o_start + datetime.timedelta(minutes=90)
+            occurrences.append(Occurrence(event=event, title=event.title,
+                description='', start=o_start, end=o_end, original_start=o_start,
+                original_end=o_end))
+        rows.append(('%d occurrences' % count,
+            best_of(lambda: _cook_occurrences(period, list(occurrences), 600, 800)), count))
+    return rows
+
+
+@benchmark('rule_params', 10000)
+def rule_params(size):
+    """
+    Calls ``Rule.get_params`` ``size`` times for each rule shape, and for a
+    rule with many params.
+    """
+    from schedule.models import Rule
+
+    rules = [(shape, Rule(frequency=rule[0], params=rule[1]))
+        for shape, rule in RULE_SHAPES.items() if rule is not None]
+    rules.append(('many params', Rule(frequency='YEARLY',
+        params='bymonth:1,4,7,10;bymonthday:1,15;byhour:9,12,15;byminute:0,30')))
+    rows = []
+    for shape, rule in rules:
+        def get_params():
+            for i in xrange(size):
+                rule.get_params()
+        rows.append((shape, best_of(get_params), size))
+    return rows
+
+
+@benchmark('instrumentation', 50)
+def instrumentation(size):
+    """
+    Computes the occurrences of January 2009 and classifies them by day for
+    ``size`` events of each rule shape, without and with a collector of
+    schedule.instrumentation, to show what collecting costs.
+    """
+    from django.db import transaction
+    from schedule import instrumentation
+    from schedule.periods import Month
+
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        events = []
+        for shape_events in create_shaped_events(size).values():
+            events += shape_events
+        def month():
+            count = 0
+            for day in Month(events, EXPANSION_START).get_days():
+                count += len(day.get_occurrence_partials())
+            return count
+        def collected():
+            collector = instrumentation.start_collecting()
+            try:
+                return month()
+            finally:
+                instrumentation.stop_collecting(collector)
+        count = month()
+        return [
+            ('disabled', best_of(month), count),
+            ('collected', best_of(collected), count),
+        ]
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
@@ -43,5 +43,43 @@ if not GET_EVENTS_FUNC:
 
     GET_EVENTS_FUNC = get_events
 
+# Number of seconds the output of the month_table and day_cell template tags
+# is cached for.  The cache key contains the version of the calendar, so a
+# change to the calendar is seen right away.  Set to 0 to disable caching.
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 3600)
+
+# Callable used to sort users into classes that see the same cached fragments
+# of a calendar (e.g. editors and viewers).  It takes the calendar and the
+# user and returns a string.
+PERMISSION_CLASS_FUNC = getattr(settings, 'PERMISSION_CLASS_FUNC', None)
+if not PERMISSION_CLASS_FUNC:
+    def get_permission_class(calendar, user):
+        if user.is_authenticated():
+            return 'authenticated'
+        return 'anonymous'
+
+    PERMISSION_CLASS_FUNC = get_permission_class
+
+# Whether the cached fragments can be shared by the users of a permission
+# class.  A custom GET_EVENTS_FUNC or CHECK_PERMISSION_FUNC may show each user
+# other events or links, so fragments are then only cached when
+# PERMISSION_CLASS_FUNC is set too, to say which users see the same ones.
+FRAGMENT_CACHE_SHARED = getattr(settings, 'PERMISSION_CLASS_FUNC', None) is not None or (
+    getattr(settings, 'GET_EVENTS_FUNC', None) is None and
+    getattr(settings, 'CHECK_PERMISSION_FUNC', None) is None)
+
+# Number of seconds the next occurrences of a calendar, as shown in the
+# upcoming events feed, are cached for.  Set to 0 to disable caching.
+UPCOMING_CACHE_TIMEOUT = getattr(settings, 'UPCOMING_CACHE_TIMEOUT', 3600)
+
 # URL to redirect to to after an occurrence is canceled
 OCCURRENCE_CANCEL_REDIRECT = getattr(settings, 'OCCURRENCE_CANCEL_REDIRECT', None)
+
+# Callables the counters and timers of every request are passed to, as
+# sink(request, collector), when schedule.instrumentation.InstrumentationMiddleware
+# is installed.
+INSTRUMENTATION_SINKS = getattr(settings, 'INSTRUMENTATION_SINKS', ())
+
+# Number of seconds of rrule expansion above which ServerTimingMiddleware
+# flags a request as a slow expansion.
+SLOW_EXPANSION_THRESHOLD = getattr(settings, 'SLOW_EXPANSION_THRESHOLD', 0.5)
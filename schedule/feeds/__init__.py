@@ -1,18 +1,84 @@
-from schedule.models import Calendar
+from schedule.models import Calendar, Occurrence
 from django.contrib.syndication.feeds import FeedDoesNotExist
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from schedule.feeds.atom import Feed
-from schedule.feeds.icalendar import ICalendarFeed
-from django.http import HttpResponse
-import datetime, itertools
+from schedule.feeds.icalendar import ICalendarFeed, format_rrule
+from django.http import Http404, HttpResponse
+from django.views.decorators.http import condition
+from schedule.utils import make_etag
+import datetime
+
+def _upcoming_stamp(url):
+    """
+    The upcoming feed changes when its calendar changes, but also as time
+    passes and occurrences end.  The latter is approximated by the hour.
+    """
+    bits = url.split('/')
+    if len(bits) != 2:
+        return None
+    try:
+        stamp = Calendar.objects.get_version(pk=bits[1])
+    except ValueError:
+        return None
+    if stamp is None:
+        return None
+    return stamp[0], _upcoming_updated(stamp[1])
+
+def _upcoming_updated(last_modified):
+    hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    return max(last_modified, hour)
+
+def feed_etag(request, url, feed_dict=None):
+    stamp = _upcoming_stamp(url)
+    if stamp is not None:
+        return make_etag(url, *stamp)
+
+def feed_last_modified(request, url, feed_dict=None):
+    stamp = _upcoming_stamp(url)
+    if stamp is not None:
+        return stamp[1]
+
+def atom_feed(request, url, feed_dict=None):
+    """
+    Like django.contrib.syndication.views.feed, but the feeds that STREAM
+    are written to the response one entry at a time.
+    """
+    if not feed_dict:
+        raise Http404
+    try:
+        slug, param = url.split('/', 1)
+    except ValueError:
+        slug, param = url, ''
+    try:
+        f = feed_dict[slug]
+    except KeyError:
+        raise Http404
+    try:
+        feedgen = f(slug, request).get_feed(param)
+    except (FeedDoesNotExist, ObjectDoesNotExist):
+        raise Http404
+    if getattr(f, 'STREAM', False):
+        return HttpResponse(feedgen.iter_write('utf-8'), mimetype=feedgen.mime_type)
+    response = HttpResponse(mimetype=feedgen.mime_type)
+    feedgen.write(response, 'utf-8')
+    return response
+
+# answers 304 when the calendar of the feed has not changed
+feed = condition(etag_func=feed_etag, last_modified_func=feed_last_modified)(atom_feed)
 
 class UpcomingEventsFeed(Feed):
     feed_id = "upcoming"
+    STREAM = True
+    VALIDATE = settings.DEBUG
     
     def feed_title(self, obj):
         return "Upcoming Events for %s" % obj.name
     
+    def feed_updated(self, obj):
+        # known up front, so the head is written before any entry is built
+        return _upcoming_updated(obj.last_modified)
+    
     def get_object(self, bits):
         if len(bits) != 1:
             raise ObjectDoesNotExist
@@ -24,8 +90,7 @@ class UpcomingEventsFeed(Feed):
         return obj.get_absolute_url()
     
     def items(self, obj):
-        return itertools.islice(obj.occurrences_after(datetime.datetime.now()), 
-            getattr(settings, "FEED_LIST_LENGTH", 10))
+        return obj.get_upcoming_occurrences(getattr(settings, "FEED_LIST_LENGTH", 10))
     
     def item_id(self, item):
         return str(item.id)
@@ -45,24 +110,132 @@ class UpcomingEventsFeed(Feed):
         return "%s \n %s" % (item.event.title, item.event.description)
 
 
+def _next(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
+def _with_persisted_occurrences(events, occurrences):
+    """
+    Merge-joins ``events`` and ``occurrences``, both ordered by event, and
+    yields every event with the list of its persisted occurrences set as
+    ``persisted_occurrences``.
+    """
+    occurrence = _next(occurrences)
+    for event in events:
+        event.persisted_occurrences = []
+        while occurrence is not None and occurrence.event_id <= event.id:
+            if occurrence.event_id == event.id:
+                event.persisted_occurrences.append(occurrence)
+            occurrence = _next(occurrences)
+        yield event
+
+
 class CalendarICalendar(ICalendarFeed):
+    """
+    Writes every event of a calendar once.  Recurring events carry an RRULE
+    (or RDATEs when the rule cannot be written as one), their cancelled
+    occurrences become EXDATEs and their moved or edited occurrences become
+    RECURRENCE-ID overrides, so the size of the feed does not depend on how
+    far ahead the events recur.
+    """
+    # how far past now RDATEs are listed for rules that never end
+    rdate_horizon = datetime.timedelta(days=5 * 365)
+
     def items(self):
         cal_id = self.args[1]
         cal = Calendar.objects.get(pk=cal_id)
-        
-        return cal.events.all()
+        events = cal.event_set.select_related('rule').order_by('id')
+        occurrences = Occurrence.objects.filter(event__calendar=cal).select_related(
+            'event').order_by('event', 'original_start')
+        return self._recurring_items(_with_persisted_occurrences(
+            events.iterator(), occurrences.iterator()))
+
+    def _recurring_items(self, events):
+        """
+        Yields the item written for each event: the event itself, or the
+        persisted occurrence that replaces a one time only event.  Events
+        without any occurrence are left out.
+        """
+        for event in events:
+            if event.rule is None:
+                if event.persisted_occurrences:
+                    yield event.persisted_occurrences[0]
+                else:
+                    yield event
+                continue
+            first = event.get_rrule_object().after(event.start, inc=True)
+            if first is None or (event.end_recurring_period is not None and
+                first > event.end_recurring_period):
+                continue
+            # DTSTART has to be the first instance of the recurrence
+            event.first_start = first
+            yield event
+
+    def etag(self):
+        stamp = Calendar.objects.get_version(pk=self.args[1])
+        if stamp is not None:
+            return make_etag(*stamp)
+
+    def last_modified(self):
+        stamp = Calendar.objects.get_version(pk=self.args[1])
+        if stamp is not None:
+            return stamp[1]
 
     def item_uid(self, item):
+        if isinstance(item, Occurrence):
+            return str(item.event_id)
         return str(item.id)
 
     def item_start(self, item):
-        return item.start
+        return getattr(item, 'first_start', item.start)
 
     def item_end(self, item):
-        return item.end
+        return self.item_start(item) + (item.end - item.start)
 
     def item_summary(self, item):
         return item.title
-        
+
     def item_created(self, item):
-        return item.created_on
\ No newline at end of file
+        if isinstance(item, Occurrence):
+            return item.event.created_on
+        return item.created_on
+
+    def item_status(self, item):
+        if isinstance(item, Occurrence) and item.cancelled:
+            return 'CANCELLED'
+
+    def item_rrule(self, item):
+        if isinstance(item, Occurrence) or item.rule is None:
+            return None
+        params = item.rule.get_params()
+        until = item.end_recurring_period
+        if until is not None and 'count' in params:
+            # RRULE may not have both, so keep whichever ends it first
+            if list(item.get_rrule_object())[-1] <= until:
+                until = None
+            else:
+                del params['count']
+        return format_rrule(item.rule.frequency, params, until)
+
+    def item_rdate(self, item):
+        if isinstance(item, Occurrence) or item.rule is None or \
+            self.item_rrule(item) is not None:
+            return None
+        end = max(datetime.datetime.now(), item.start) + self.rdate_horizon
+        if item.end_recurring_period is not None:
+            end = min(end, item.end_recurring_period)
+        return item.get_rrule_object().between(item.first_start, end)
+
+    def item_exdate(self, item):
+        if isinstance(item, Occurrence) or item.rule is None:
+            return None
+        return [occ.original_start for occ in item.persisted_occurrences
+            if occ.cancelled]
+
+    def item_overrides(self, item):
+        if isinstance(item, Occurrence) or item.rule is None:
+            return []
+        return [(occ.original_start, occ) for occ in item.persisted_occurrences
+            if not occ.cancelled and (occ.moved or occ.title != item.title)]
@@ -30,6 +30,7 @@
 
 from xml.sax.saxutils import XMLGenerator
 from datetime import datetime
+import itertools
 
 
 GENERATOR_TEXT = 'django-atompub'
@@ -52,6 +53,28 @@ class SimplerXMLGenerator(XMLGenerator):
 
 
 
+class BufferedXMLGenerator(SimplerXMLGenerator):
+    """
+    Collects the markup and writes it to ``out`` in one piece on ``flush``.
+    The plain XMLGenerator of Python 2.7 encodes and flushes every tag and
+    every string on its own, which is most of the cost of writing a feed.
+    """
+    def __init__(self, out, encoding):
+        SimplerXMLGenerator.__init__(self, out, encoding)
+        self._out = out
+        self._encoding = encoding
+        self._chunks = []
+        self._write = self._chunks.append
+        self._flush = self.flush
+    
+    def flush(self):
+        if self._chunks:
+            data = u''.join(self._chunks)
+            del self._chunks[:]
+            self._out.write(data.encode(self._encoding, 'xmlcharrefreplace'))
+
+
+
 ## based on django.utils.feedgenerator.rfc3339_date
 def rfc3339_date(date):
     return date.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -69,19 +92,82 @@ def get_tag_uri(url, date):
 
 
 
+class ChunkBuffer(object):
+    """
+    A file-like object that keeps what is written until it is popped.
+    """
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(data)
+    
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+
 ## based on django.contrib.syndication.feeds.Feed
 class Feed(object):
     
     
     VALIDATE = True
     
+    # validate only the first VALIDATE_SAMPLE entries (None for all of them)
+    VALIDATE_SAMPLE = None
+    
+    # build the entries while they are written instead of all of them first
+    STREAM = False
+    
+    # (feed class, attribute name) -> how the attribute is read, worked out
+    # once per class by __resolve_attr
+    _accessors = {}
+    
     
     def __init__(self, slug, feed_url):
         # @@@ slug and feed_url are not used yet
         pass
     
     
+    def __resolve_attr(self, attname):
+        """
+        Works out how the class attribute ``attname`` is read: returns
+        ('missing', None), ('value', value), ('method', function) for a
+        method taking the object, ('method0', function) for one that does
+        not, or None when it has to be looked up on every call.
+        """
+        try:
+            attr = getattr(self.__class__, attname)
+        except AttributeError:
+            return ('missing', None)
+        if not callable(attr):
+            return ('value', attr)
+        func = getattr(attr, 'im_func', None)
+        if func is None or getattr(attr, 'im_self', None) is not None:
+            return None
+        if func.func_code.co_argcount == 2: # one argument is 'self'
+            return ('method', func)
+        return ('method0', func)
+    
+    
     def __get_dynamic_attr(self, attname, obj, default=None):
+        if attname not in self.__dict__:
+            key = (self.__class__, attname)
+            try:
+                accessor = Feed._accessors[key]
+            except KeyError:
+                accessor = Feed._accessors[key] = self.__resolve_attr(attname)
+            if accessor is not None:
+                kind, attr = accessor
+                if kind == 'method':
+                    return attr(self, obj)
+                elif kind == 'method0':
+                    return attr(self)
+                elif kind == 'value':
+                    return attr
+                return default
         try:
             attr = getattr(self, attname)
         except AttributeError:
@@ -132,8 +218,24 @@ class Feed(object):
         if items is None:
             raise LookupError('Feed has no items field')
         
-        for item in items:
-            feed.add_item(
+        entries = itertools.imap(self.__make_item, itertools.repeat(feed), items)
+        if self.STREAM:
+            if self.VALIDATE:
+                sample = list(itertools.islice(entries, self.VALIDATE_SAMPLE))
+                feed.items = sample
+                feed.validate()
+                entries = itertools.chain(sample, entries)
+            feed.items = entries
+            return feed
+        
+        feed.items = list(entries)
+        if self.VALIDATE:
+            feed.validate(self.VALIDATE_SAMPLE)
+        return feed
+    
+    
+    def __make_item(self, feed, item):
+        return feed.make_item(
                 atom_id = self.__get_dynamic_attr('item_id', item), 
                 title = self.__get_dynamic_attr('item_title', item),
                 updated = self.__get_dynamic_attr('item_updated', item),
@@ -148,10 +250,6 @@ class Feed(object):
                 links = self.__get_dynamic_attr('item_links', item, default=[]),
                 extra_attrs = self.__get_dynamic_attr('item_extra_attrs', None, default={}),
             )
-        
-        if self.VALIDATE:
-            feed.validate()
-        return feed
 
 
 
@@ -193,7 +291,11 @@ class AtomFeed(object):
         self.items = []
     
     
-    def add_item(self, atom_id, title, updated, content=None, published=None, rights=None, source=None, summary=None,
+    def add_item(self, *args, **kwargs):
+        self.items.append(self.make_item(*args, **kwargs))
+    
+    
+    def make_item(self, atom_id, title, updated, content=None, published=None, rights=None, source=None, summary=None,
         authors=[], categories=[], contributors=[], links=[], extra_attrs={}):
         if atom_id is None:
             raise LookupError('Feed has no item_id method')
@@ -201,7 +303,7 @@ class AtomFeed(object):
             raise LookupError('Feed has no item_title method')
         if updated is None:
             raise LookupError('Feed has no item_updated method')
-        self.items.append({
+        return {
             'id': atom_id,
             'title': title,
             'updated': updated,
@@ -215,13 +317,15 @@ class AtomFeed(object):
             'contributors': contributors,
             'links': links,
             'extra_attrs': extra_attrs,
-        })
+        }
     
     
     def latest_updated(self):
         """
         Returns the latest item's updated or the current time if there are no items.
+        Streamed items have to be built first for this.
         """
+        self.items = list(self.items)
         updates = [item['updated'] for item in self.items]
         if len(updates) > 0:
             updates.sort()
@@ -305,6 +409,31 @@ class AtomFeed(object):
     
     def write(self, outfile, encoding):
         handler = SimplerXMLGenerator(outfile, encoding)
+        self.write_head(handler)
+        self.write_items(handler)
+        handler.endElement(u'feed')
+    
+    
+    def iter_write(self, encoding):
+        """
+        Like write, but yields the document a piece at a time: the head of
+        the feed, then every entry as soon as it is written.
+        """
+        buf = ChunkBuffer()
+        handler = BufferedXMLGenerator(buf, encoding)
+        self.write_head(handler)
+        handler.flush()
+        yield buf.pop()
+        for item in self.items:
+            self.write_item(handler, item)
+            handler.flush()
+            yield buf.pop()
+        handler.endElement(u'feed')
+        handler.flush()
+        yield buf.pop()
+    
+    
+    def write_head(self, handler):
         handler.startDocument()
         feed_attrs = {u'xmlns': self.ns}
         if self.feed.get('extra_attrs'):
@@ -334,44 +463,48 @@ class AtomFeed(object):
             self.write_text_construct(handler, u'rights', self.feed['rights'])
         if not self.feed.get('hide_generator'):
             handler.addQuickElement(u'generator', GENERATOR_TEXT, GENERATOR_ATTR)
-        
-        self.write_items(handler)
-        
-        handler.endElement(u'feed')
     
     
     def write_items(self, handler):
         for item in self.items:
-            entry_attrs = item.get('extra_attrs', {})
-            handler.startElement(u'entry', entry_attrs)
-            
-            handler.addQuickElement(u'id', item['id'])
-            self.write_text_construct(handler, u'title', item['title'])
-            handler.addQuickElement(u'updated', rfc3339_date(item['updated']))
-            if item.get('published'):
-                handler.addQuickElement(u'published', rfc3339_date(item['published']))
-            if item.get('rights'):
-                self.write_text_construct(handler, u'rights', item['rights'])
-            if item.get('source'):
-                self.write_source(handler, item['source'])
-            
-            for author in item['authors']:
-                self.write_person_construct(handler, u'author', author)
-            for contributor in item['contributors']:
-                self.write_person_construct(handler, u'contributor', contributor)
-            for category in item['categories']:
-                self.write_category_construct(handler, category)
-            for link in item['links']:
-                self.write_link_construct(handler, link)
-            if item.get('summary'):
-                self.write_text_construct(handler, u'summary', item['summary'])
-            if item.get('content'):
-                self.write_content(handler, item['content'])
-            
-            handler.endElement(u'entry')
+            self.write_item(handler, item)
+    
+    
+    def write_item(self, handler, item):
+        entry_attrs = item.get('extra_attrs', {})
+        handler.startElement(u'entry', entry_attrs)
+        
+        handler.addQuickElement(u'id', item['id'])
+        self.write_text_construct(handler, u'title', item['title'])
+        handler.addQuickElement(u'updated', rfc3339_date(item['updated']))
+        if item.get('published'):
+            handler.addQuickElement(u'published', rfc3339_date(item['published']))
+        if item.get('rights'):
+            self.write_text_construct(handler, u'rights', item['rights'])
+        if item.get('source'):
+            self.write_source(handler, item['source'])
+        
+        for author in item['authors']:
+            self.write_person_construct(handler, u'author', author)
+        for contributor in item['contributors']:
+            self.write_person_construct(handler, u'contributor', contributor)
+        for category in item['categories']:
+            self.write_category_construct(handler, category)
+        for link in item['links']:
+            self.write_link_construct(handler, link)
+        if item.get('summary'):
+            self.write_text_construct(handler, u'summary', item['summary'])
+        if item.get('content'):
+            self.write_content(handler, item['content'])
+        
+        handler.endElement(u'entry')
     
     
-    def validate(self):
+    def validate(self, sample=None):
+        """
+        Validates the feed and its items, or only the first ``sample`` of
+        them.
+        """
         
         def validate_text_construct(obj):
             if isinstance(obj, tuple):
@@ -404,7 +537,7 @@ class AtomFeed(object):
         else:
             feed_author = False
         
-        for item in self.items:
+        for item in itertools.islice(self.items, sample):
             if not feed_author and not item.get('authors'):
                 if item.get('source') and item['source'].get('authors'):
                     pass
@@ -1,6 +1,12 @@
-import vobject
+import datetime
 
+from dateutil import tz
+from django.conf import settings
 from django.http import HttpResponse
+from django.utils.encoding import force_unicode
+from django.views.decorators.http import condition
+
+from schedule.models.rules import freqs
 
 EVENT_ITEMS = (
     ('uid', 'uid'),
@@ -10,29 +16,361 @@ EVENT_ITEMS = (
     ('location', 'location'),
     ('last_modified', 'last_modified'),
     ('created', 'created'),
+    ('status', 'status'),
 )
 
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# the dateutil rrule params that RRULE can express, in the order they are
+# written
+RRULE_PARAMS = ('count', 'interval', 'bysetpos', 'bymonth', 'bymonthday',
+    'byyearday', 'byweekno', 'byweekday', 'byhour', 'byminute', 'bysecond',
+    'wkst')
+
+# the FREQ values a Rule can hold
+FREQUENCIES = [frequency for frequency, label in freqs]
+
+PRODID = '-//django-schedule//NONSGML Calendar//EN'
+
+def escape_text(value):
+    """
+    Escapes a TEXT value as described in RFC 5545 section 3.3.11.
+    """
+    value = force_unicode(value)
+    for char, escaped in (('\\', '\\\\'), (';', '\\;'), (',', '\\,'),
+        ('\r\n', '\\n'), ('\r', '\\n'), ('\n', '\\n')):
+        value = value.replace(char, escaped)
+    return value
+
+def format_datetime(value):
+    """
+    Formats a datetime as a DATE-TIME value. Aware datetimes are converted to
+    UTC, naive ones are written as floating times.
+    """
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+        return value.strftime('%Y%m%dT%H%M%SZ')
+    return value.strftime('%Y%m%dT%H%M%S')
+
+def fold_line(line):
+    """
+    Encodes a content line to UTF-8 and folds it so that no physical line is
+    longer than 75 octets (RFC 5545 section 3.1).  A multi-octet character
+    is never split.
+    """
+    line = line.encode('utf-8')
+    parts = []
+    limit = 75
+    while len(line) > limit:
+        cut = limit
+        while (ord(line[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        # the leading space of a continuation line counts
+        limit = 74
+    parts.append(line)
+    return '\r\n '.join(parts) + '\r\n'
+
+def format_rrule(frequency, params, until=None):
+    """
+    Returns the value of an RRULE property for a rule of ``frequency`` with
+    the dateutil ``params`` from ``Rule.get_params``, ending at ``until``.
+    Returns None when a param cannot be written as an RRULE (byeaster is a
+    dateutil extension).
+    """
+    for key in params:
+        if key not in RRULE_PARAMS:
+            return None
+    parts = ['FREQ=%s' % frequency]
+    if until is not None:
+        parts.append('UNTIL=%s' % format_datetime(until))
+    for key in RRULE_PARAMS:
+        if key not in params:
+            continue
+        values = params[key]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        if key in ('byweekday', 'wkst'):
+            values = [WEEKDAYS[v] for v in values]
+        name = key.upper()
+        if key == 'byweekday':
+            name = 'BYDAY'
+        parts.append('%s=%s' % (name, ','.join([str(v) for v in values])))
+    return ';'.join(parts)
+
+def content_line(name, value, raw=False):
+    """
+    Returns the folded content line for a property.  Datetimes, dates and
+    lists of them are formatted, anything else is escaped as TEXT unless
+    ``raw`` is True.
+    """
+    name = name.upper().replace('_', '-')
+    if raw:
+        return fold_line(u'%s:%s' % (name, value))
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    if isinstance(value[0], datetime.datetime):
+        value = ','.join([format_datetime(v) for v in value])
+    elif isinstance(value[0], datetime.date):
+        name += ';VALUE=DATE'
+        value = ','.join([v.strftime('%Y%m%d') for v in value])
+    else:
+        value = ','.join([escape_text(v) for v in value])
+    return fold_line(u'%s:%s' % (name, value))
+
+
+def unescape_text(value):
+    """
+    Reverses ``escape_text``.
+    """
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append(char in 'nN' and '\n' or char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+    return u''.join(chars)
+
+_zones = {}
+
+def get_zone(name):
+    """
+    Returns the dateutil time zone called ``name``, or None if there is no
+    such zone.  Zones are looked up once.
+    """
+    if name not in _zones:
+        _zones[name] = tz.gettz(name)
+    return _zones[name]
+
+def parse_datetime(value, tzid=None):
+    """
+    Parses a DATE or DATE-TIME value into a naive datetime in the TIME_ZONE
+    of the project.  UTC times and times with a known ``tzid`` are converted
+    to it, floating times and times of an unknown zone keep their wall time.
+    """
+    value = value.strip()
+    if 'T' not in value:
+        return datetime.datetime.strptime(value, '%Y%m%d')
+    zone = None
+    if value.endswith('Z'):
+        value = value[:-1]
+        zone = tz.tzutc()
+    elif tzid:
+        zone = get_zone(tzid)
+    parsed = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+    local = get_zone(settings.TIME_ZONE)
+    if zone is None or local is None:
+        return parsed
+    return parsed.replace(tzinfo=zone).astimezone(local).replace(tzinfo=None)
+
+def parse_duration(value):
+    """
+    Parses a DURATION value like ``P1D``, ``PT1H30M`` or ``-P2W``.
+    """
+    sign = 1
+    if value.startswith('-'):
+        sign = -1
+    value = value.lstrip('+-').lstrip('P')
+    units = {'W': 'weeks', 'D': 'days', 'H': 'hours', 'M': 'minutes', 'S': 'seconds'}
+    kwargs = {}
+    number = ''
+    for char in value:
+        if char.isdigit():
+            number += char
+        elif char in units:
+            kwargs[units[char]] = int(number)
+            number = ''
+        elif char != 'T':
+            raise ValueError("invalid duration %r" % value)
+    return sign * datetime.timedelta(**kwargs)
+
+def parse_rrule(value):
+    """
+    Parses an RRULE value into a frequency, a dict of dateutil params in the
+    format of ``Rule.get_params`` and the UNTIL datetime (or None).  Raises
+    ValueError for parts that a Rule cannot hold, like ``BYDAY=1MO`` or an
+    unknown FREQ.
+    """
+    frequency = None
+    params = {}
+    until = None
+    names = dict([(key.upper(), key) for key in RRULE_PARAMS])
+    names['BYDAY'] = 'byweekday'
+    for part in value.split(';'):
+        if not part:
+            continue
+        name, values = part.split('=', 1)
+        name = name.upper()
+        if name == 'FREQ':
+            frequency = values.upper()
+            if frequency not in FREQUENCIES:
+                raise ValueError("unsupported RRULE frequency %r" % values)
+        elif name == 'UNTIL':
+            until = parse_datetime(values)
+            if 'T' not in values:
+                # the whole last day is part of the series
+                until += datetime.timedelta(days=1, seconds=-1)
+        elif name in names:
+            key = names[name]
+            if key in ('byweekday', 'wkst'):
+                values = [WEEKDAYS.index(v.upper()) for v in values.split(',')]
+            else:
+                values = [int(v) for v in values.split(',')]
+            if len(values) == 1:
+                values = values[0]
+            params[key] = values
+        else:
+            raise ValueError("unsupported RRULE part %r" % part)
+    if frequency is None:
+        raise ValueError("RRULE without FREQ")
+    return frequency, params, until
+
+def unfold_lines(lines):
+    """
+    Joins the folded physical lines of ``lines`` back into content lines,
+    decoded from UTF-8.  ``lines`` can be any iterable, like an open file,
+    so a file is read one line at a time.
+    """
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current:
+            yield current.decode('utf-8', 'replace')
+        current = line
+    if current:
+        yield current.decode('utf-8', 'replace')
+
+def parse_content_line(line):
+    """
+    Splits a content line into its upper cased name, a dict of params and
+    the raw value.
+    """
+    quoted = False
+    for index, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            break
+    else:
+        raise ValueError("invalid content line %r" % line)
+    head, value = line[:index], line[index + 1:]
+    parts = head.split(';')
+    params = {}
+    for param in parts[1:]:
+        if '=' in param:
+            key, param_value = param.split('=', 1)
+            params[key.upper()] = param_value.strip('"')
+    return parts[0].upper(), params, value
+
+def read_vevents(lines):
+    """
+    Reads the VEVENTs of an iCalendar stream one at a time.  Each VEVENT is
+    yielded as a dict mapping property names to lists of (params, value)
+    tuples.  Components nested in a VEVENT (like VALARM) are skipped.
+    """
+    vevent = None
+    depth = 0
+    for line in unfold_lines(lines):
+        try:
+            name, params, value = parse_content_line(line)
+        except ValueError:
+            continue
+        if name == 'BEGIN':
+            if vevent is None and value.upper() == 'VEVENT':
+                vevent = {}
+            elif vevent is not None:
+                depth += 1
+        elif name == 'END' and vevent is not None:
+            if depth:
+                depth -= 1
+            elif value.upper() == 'VEVENT':
+                yield vevent
+                vevent = None
+        elif vevent is not None and not depth:
+            vevent.setdefault(name, []).append((params, value))
+
+
 class ICalendarFeed(object):
+    """
+    A view that writes its ``items`` as the VEVENTs of an iCalendar file.
+    The file is streamed: every VEVENT is written as soon as its item is
+    read, so even a very large calendar never sits in memory at once.
+    """
 
     def __call__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
-        
-        cal = vobject.iCalendar()
+        view = condition(etag_func=lambda *args, **kwargs: self.etag(),
+            last_modified_func=lambda *args, **kwargs: self.last_modified())
+        return view(self.render)(*args, **kwargs)
 
-        for item in self.items():
+    def render(self, *args, **kwargs):
+        response = HttpResponse(self.stream(self.items()))
+        response['Content-Type'] = 'text/calendar; charset=utf-8'
+        return response
 
-            event = cal.add('vevent')
+    def stream(self, items):
+        """
+        Generates the iCalendar file a few lines at a time.  Querysets are
+        read with ``iterator()`` so their rows are not cached.
+        """
+        yield 'BEGIN:VCALENDAR\r\n'
+        yield 'VERSION:2.0\r\n'
+        yield content_line('prodid', PRODID)
+        dtstamp = content_line('dtstamp', datetime.datetime.utcnow().replace(
+            microsecond=0).strftime('%Y%m%dT%H%M%SZ'))
+        if hasattr(items, 'iterator'):
+            items = items.iterator()
+        for item in items:
+            yield self.vevent(item, dtstamp)
+            for recurrence_id, override in self.item_overrides(item):
+                yield self.vevent(override, dtstamp, recurrence_id)
+        yield 'END:VCALENDAR\r\n'
 
-            for vkey, key in EVENT_ITEMS:
-                value = getattr(self, 'item_' + key)(item)
+    def vevent(self, item, dtstamp, recurrence_id=None):
+        """
+        Returns the VEVENT block of one item.  With a ``recurrence_id`` the
+        block overrides that instance of a recurring item, otherwise it
+        carries the recurrence of the item.
+        """
+        lines = ['BEGIN:VEVENT\r\n', dtstamp]
+        for vkey, key in EVENT_ITEMS:
+            value = getattr(self, 'item_' + key)(item)
+            if value:
+                lines.append(content_line(vkey, value))
+        if recurrence_id is not None:
+            lines.append(content_line('recurrence_id', recurrence_id))
+        else:
+            rrule = self.item_rrule(item)
+            if rrule:
+                lines.append(content_line('rrule', rrule, raw=True))
+            for vkey in ('rdate', 'exdate'):
+                value = getattr(self, 'item_' + vkey)(item)
                 if value:
-                    event.add(vkey).value = value
+                    lines.append(content_line(vkey, value))
+        lines.append('END:VEVENT\r\n')
+        return ''.join(lines)
 
-        response = HttpResponse(cal.serialize())
-        response['Content-Type'] = 'text/calendar'
+    def etag(self):
+        """
+        Returns the ETag of the feed, or None to always render it.
+        """
+        return None
 
-        return response
+    def last_modified(self):
+        """
+        Returns when the feed last changed, or None to always render it.
+        """
+        return None
 
     def items(self):
         return []
@@ -56,4 +394,32 @@ class ICalendarFeed(object):
         pass
 
     def item_created(self, item):
-        pass
\ No newline at end of file
+        pass
+
+    def item_status(self, item):
+        pass
+
+    def item_rrule(self, item):
+        """
+        Returns the RRULE value of the item (see ``format_rrule``).
+        """
+        pass
+
+    def item_rdate(self, item):
+        """
+        Returns a list of extra start datetimes of the item.
+        """
+        pass
+
+    def item_exdate(self, item):
+        """
+        Returns a list of the start datetimes excluded from the recurrence.
+        """
+        pass
+
+    def item_overrides(self, item):
+        """
+        Returns a list of (recurrence id, override) tuples. Each override is
+        written as its own VEVENT, through the same ``item_*`` methods.
+        """
+        return []
@@ -1,5 +1,6 @@
 from django import forms
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ugettext, ugettext_lazy as _
+from schedule.freebusy import find_conflicts
 from schedule.models import Event, Occurrence
 import datetime
 import time
@@ -10,25 +11,93 @@ class SpanForm(forms.ModelForm):
     start = forms.DateTimeField(widget=forms.SplitDateTimeWidget)
     end = forms.DateTimeField(widget=forms.SplitDateTimeWidget, help_text = _("The end time must be later than start time."))
 
+    def __init__(self, *args, **kwargs):
+        """
+        If ``check_conflicts`` is True the form will not validate when the
+        span overlaps an occurrence of another event in ``calendar``.  The
+        overlapping occurrences are then available as ``form.conflicts``.
+        """
+        self.check_conflicts = kwargs.pop('check_conflicts', False)
+        self.calendar = kwargs.pop('calendar', None)
+        self.conflicts = []
+        super(SpanForm, self).__init__(*args, **kwargs)
+
     def clean_end(self):
         if self.cleaned_data['end'] <= self.cleaned_data['start']:
             raise forms.ValidationError(_("The end time must be later than start time."))
         return self.cleaned_data['end']
 
+    def clean(self):
+        if self.check_conflicts and not self._errors:
+            self.conflicts = self.get_conflicts()
+            if self.conflicts:
+                raise forms.ValidationError(ugettext(
+                    "This conflicts with %(count)d other occurrence(s), the first one being %(first)s.") % {
+                    'count': len(self.conflicts),
+                    'first': self.conflicts[0].title,
+                })
+        return self.cleaned_data
+
+    def get_conflicts(self):
+        """
+        Returns the occurrences in ``self.calendar`` that overlap the span
+        described by the cleaned data, or none when there is no calendar.
+        Subclasses extend it to the occurrences of a recurring span and to
+        leave out the object being edited.
+        """
+        if self.calendar is None:
+            return []
+        data = self.cleaned_data
+        return find_conflicts(self.calendar,
+            [Occurrence(start=data['start'], end=data['end'])])
+
 
 class EventForm(SpanForm):
     def __init__(self, hour24=False, *args, **kwargs):
+        """
+        ``conflict_horizon`` limits how far ahead the occurrences of an
+        event that recurs forever are checked for conflicts.
+        """
+        self.conflict_horizon = kwargs.pop('conflict_horizon',
+            datetime.timedelta(days=365))
         super(EventForm, self).__init__(*args, **kwargs)
-    
+
     end_recurring_period = forms.DateTimeField(help_text = _("This date is ignored for one time only events."), required=False)
-    
+
     class Meta:
         model = Event
         exclude = ('creator', 'created_on', 'calendar')
-        
+
+    def get_conflicts(self):
+        data = self.cleaned_data
+        calendar = self.calendar
+        if calendar is None and self.instance.pk is not None:
+            calendar = self.instance.calendar
+        if calendar is None:
+            return []
+        event = Event(start=data['start'], end=data['end'],
+            rule=data.get('rule'),
+            end_recurring_period=data.get('end_recurring_period'))
+        if event.rule is None:
+            horizon = event.end
+        else:
+            horizon = event.end_recurring_period or \
+                event.start + self.conflict_horizon
+        occurrences = event._get_occurrence_list(event.start, horizon)
+        return find_conflicts(calendar, occurrences, exclude_event=self.instance)
+
 
 class OccurrenceForm(SpanForm):
-    
+
     class Meta:
         model = Occurrence
         exclude = ('original_start', 'original_end', 'event', 'cancelled')
+
+    def get_conflicts(self):
+        data = self.cleaned_data
+        calendar = self.calendar or self.instance.event.calendar
+        occurrence = Occurrence(event=self.instance.event, start=data['start'],
+            end=data['end'], original_start=self.instance.original_start,
+            original_end=self.instance.original_end)
+        return find_conflicts(calendar, [occurrence],
+            exclude_occurrence=self.instance)
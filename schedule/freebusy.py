@@ -0,0 +1,247 @@
+import bisect
+import datetime
+from django.db.models import F, Q
+from schedule.models import Event, Occurrence
+from schedule.utils import EventListManager, recurring_events_q
+
+
+def merge_intervals(intervals):
+    """
+    Takes an iterable of (start, end) tuples and sweeps over them in order of
+    their start, merging every interval that overlaps or touches the previous
+    one.  Returns a sorted list of disjoint (start, end) tuples.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_busy_intervals(events, start, end):
+    """
+    Returns the sorted list of (start, end) tuples during which at least one
+    of ``events`` has an occurrence between ``start`` and ``end``.  Cancelled
+    occurrences do not make anybody busy, and every interval is trimmed to
+    the window.
+    """
+    occurrences = EventListManager(events).get_occurrences(start, end)
+    return merge_intervals([
+        (max(occ.start, start), min(occ.end, end)) for occ in occurrences
+        if not occ.cancelled and occ.start < end and occ.end > start])
+
+
+def get_free_intervals(events, start, end):
+    """
+    The complement of ``get_busy_intervals``: the sorted list of (start, end)
+    tuples between ``start`` and ``end`` during which none of ``events`` has
+    an occurrence.
+    """
+    free = []
+    cursor = start
+    for busy_start, busy_end in get_busy_intervals(events, start, end):
+        if busy_start > cursor:
+            free.append((cursor, busy_start))
+        cursor = max(cursor, busy_end)
+    if cursor < end:
+        free.append((cursor, end))
+    return free
+
+
+def get_events_for_calendars(calendars):
+    """
+    Returns a single queryset with the events of every calendar in
+    ``calendars``, so that a whole group of calendars can be expanded in one
+    batch instead of one Period per calendar.
+    """
+    return Event.objects.filter(calendar__in = calendars).select_related('rule')
+
+
+def get_free_busy(calendars, start, end):
+    """
+    Returns the busy intervals of all the ``calendars`` together between
+    ``start`` and ``end``.  See ``get_busy_intervals``.
+    """
+    return get_busy_intervals(get_events_for_calendars(calendars), start, end)
+
+
+def _busy_after(events, after):
+    """
+    Returns a generator that lazily produces the merged busy intervals of
+    ``events`` that end after ``after``, in order.  Occurrences are read from
+    ``EventListManager.occurrences_after`` only as far as needed.
+
+    The heap merge orders occurrences by their original start, so persisted
+    occurrences that were moved are taken out of that stream and merged back
+    in from a separate query at their new position.
+    """
+    moved = list(Occurrence.objects.filter(event__in = events,
+        end__gt = after, cancelled = False).exclude(start = F('original_start'),
+        end = F('original_end')).select_related('event').order_by('-start'))
+
+    def occurrences():
+        for occ in EventListManager(events).occurrences_after(after):
+            if occ.cancelled or occ.moved:
+                continue
+            while moved and moved[-1].start <= occ.start:
+                yield moved.pop()
+            yield occ
+        while moved:
+            yield moved.pop()
+
+    current = None
+    for occ in occurrences():
+        if current and occ.start <= current[1]:
+            current = (current[0], max(current[1], occ.end))
+        else:
+            if current:
+                yield current
+            current = (occ.start, occ.end)
+    if current:
+        yield current
+
+
+def _working_windows(start, end, working_hours, weekdays):
+    """
+    Returns a generator of the (start, end) tuples between ``start`` and
+    ``end`` that fall within ``working_hours`` on one of ``weekdays``.  An
+    ``end`` of None means the gap is open ended.
+    """
+    if working_hours is None:
+        yield start, end
+        return
+    day_start, day_end = working_hours
+    day = start.date()
+    while end is None or datetime.datetime.combine(day, day_start) < end:
+        if weekdays is None or day.weekday() in weekdays:
+            window_start = max(start, datetime.datetime.combine(day, day_start))
+            window_end = datetime.datetime.combine(day, day_end)
+            if end is not None:
+                window_end = min(window_end, end)
+            if window_start < window_end:
+                yield window_start, window_end
+        day += datetime.timedelta(days=1)
+
+
+def find_free_slots(events, duration, after=None, count=1, working_hours=None,
+    weekdays=None, until=None, max_days=366):
+    """
+    Returns a list of up to ``count`` (start, end) tuples, each ``duration``
+    long, during which none of ``events`` has an occurrence.  The slots are
+    the earliest ones after ``after`` (which defaults to now).
+
+    ``working_hours`` is an optional tuple of two datetime.time objects that
+    every slot has to fit in, and ``weekdays`` an optional list of the
+    weekdays (0 is Monday) slots may fall on.  ``until`` stops the search at
+    that datetime, and the search never goes further than ``max_days`` days
+    after ``after`` either, since the constraints may never be met.  A
+    ``duration`` longer than the working hours raises a ValueError.
+
+    The occurrences are streamed in order, so the search only expands the
+    events as far as the last slot it returns.
+    """
+    if duration <= datetime.timedelta(0):
+        raise ValueError("duration must be positive")
+    if working_hours is not None and working_hours[0] >= working_hours[1]:
+        raise ValueError("working hours must end after they start")
+    if working_hours is not None:
+        day = datetime.date.today()
+        if duration > datetime.datetime.combine(day, working_hours[1]) - \
+            datetime.datetime.combine(day, working_hours[0]):
+            raise ValueError("duration must fit in the working hours")
+    if after is None:
+        after = datetime.datetime.now()
+    horizon = after + datetime.timedelta(days=max_days)
+    if until is None or until > horizon:
+        until = horizon
+    if count < 1:
+        return []
+    if weekdays is not None and not [day for day in weekdays if 0 <= day <= 6]:
+        return []
+    slots = []
+
+    def gaps():
+        cursor = after
+        for busy_start, busy_end in _busy_after(events, after):
+            if busy_start > cursor:
+                yield cursor, busy_start
+            cursor = max(cursor, busy_end)
+            if cursor >= until:
+                return
+        yield cursor, until
+
+    for gap_start, gap_end in gaps():
+        if gap_end > until:
+            gap_end = until
+        for window_start, window_end in _working_windows(gap_start, gap_end,
+            working_hours, weekdays):
+            if window_start >= until:
+                return slots
+            slot_start = window_start
+            while slot_start + duration <= window_end:
+                slots.append((slot_start, slot_start + duration))
+                if len(slots) >= count:
+                    return slots
+                slot_start += duration
+    return slots
+
+
+def get_conflict_candidates(calendar, start, end, exclude_event=None):
+    """
+    Returns a queryset of the events of ``calendar`` that may have an
+    occurrence between ``start`` and ``end``, found with range queries on the
+    indexed ``start``, ``end`` and ``end_recurring_period`` columns instead of
+    expanding every event of the calendar.  Events with a persisted
+    occurrence that was moved into the range are candidates too.
+
+    The series that ended before ``start`` are kept when their last
+    occurrence runs past it (see ``recurring_events_q``).
+    """
+    events = Event.objects.filter(calendar = calendar)
+    moved_in = Occurrence.objects.filter(event__calendar = calendar,
+        start__lt = end, end__gt = start, cancelled = False).values('event')
+    candidates = events.filter(
+        Q(rule__isnull = True, start__lt = end, end__gt = start) |
+        Q(recurring_events_q(events, start), start__lt = end) |
+        Q(id__in = moved_in)).select_related('rule')
+    if exclude_event is not None and exclude_event.pk is not None:
+        candidates = candidates.exclude(pk = exclude_event.pk)
+    return candidates
+
+
+def find_conflicts(calendar, occurrences, exclude_event=None,
+    exclude_occurrence=None):
+    """
+    Returns the sorted list of the occurrences of ``calendar`` that overlap
+    any of ``occurrences``.  Only the candidates from
+    ``get_conflict_candidates`` are expanded, once over the span of
+    ``occurrences``, and each of their occurrences is then matched against
+    the merged windows with a binary search.
+
+    ``exclude_event`` is left out of the candidates (the event being edited)
+    and so is ``exclude_occurrence`` (the occurrence being edited).
+    """
+    windows = merge_intervals([(occ.start, occ.end) for occ in occurrences
+        if not occ.cancelled and occ.end > occ.start])
+    if not windows:
+        return []
+    window_starts = [window_start for window_start, window_end in windows]
+    span_start, span_end = windows[0][0], windows[-1][1]
+    candidates = get_conflict_candidates(calendar, span_start, span_end,
+        exclude_event)
+    conflicts = []
+    for occ in EventListManager(candidates).get_occurrences(span_start, span_end):
+        if occ.cancelled or occ.end <= occ.start:
+            continue
+        if exclude_occurrence is not None and \
+            occ.event.pk == exclude_occurrence.event.pk and \
+            occ.original_start == exclude_occurrence.original_start:
+            continue
+        index = bisect.bisect_left(window_starts, occ.end) - 1
+        if index >= 0 and windows[index][1] > occ.start:
+            conflicts.append(occ)
+    conflicts.sort()
+    return conflicts
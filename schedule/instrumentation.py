@@ -0,0 +1,195 @@
+"""
+Counts and times the hot paths of django-schedule, so that a slow calendar
+page can be told apart as time spent in SQL, in dateutil or elsewhere.
+
+Nothing is collected unless a Collector is started, by
+``InstrumentationMiddleware`` for every request or by ``start_collecting``.
+When none is, every instrumented call costs a thread local lookup.
+
+The counters are:
+
+``rrule_expansions``
+    rrules expanded by ``Event.get_occurrences``, ``occurrences_after`` and
+    ``get_occurrence``.
+``occurrences_generated``
+    occurrences created from rules (or from events without a rule).
+``persisted_lookups``
+    queries for persisted occurrences, and ``persisted_occurrences`` the
+    rows they read.
+``replacer_hits``
+    generated occurrences an ``OccurrenceReplacer`` replaced by a persisted
+    one.
+``periods``
+    Periods constructed.
+``classifications``
+    calls to ``Period.classify_occurrence``.
+
+The timers, in seconds, are ``events`` for reading the events of periods,
+``expansion`` for the rrule expansions, ``persisted`` for the persisted
+occurrence queries and ``layout`` for ``_cook_occurrences``.
+
+At the end of a request the collector is sent with the
+``request_instrumented`` signal and passed to every callable of the
+INSTRUMENTATION_SINKS setting, as ``sink(request, collector)``.
+``ServerTimingMiddleware`` also reports the timers of a request in its
+``Server-Timing`` header and in a log line.
+"""
+import logging
+import threading
+import time
+
+from django.dispatch import Signal
+from django.utils.http import urlquote
+
+from schedule.conf.settings import INSTRUMENTATION_SINKS, SLOW_EXPANSION_THRESHOLD
+
+request_instrumented = Signal(providing_args=['request', 'collector'])
+
+_local = threading.local()
+
+
+class Collector(object):
+    """
+    The counters and timers collected while it is the current collector.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.counts = {}
+        self.timings = {}
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def as_dict(self):
+        return {'counts': dict(self.counts), 'timings': dict(self.timings)}
+
+
+def current_collector():
+    """
+    Returns the collector of this thread, or None when nothing is collected.
+    """
+    return getattr(_local, 'collector', None)
+
+def start_collecting():
+    """
+    Starts a new collector in this thread and returns it.  Collectors nest:
+    what is collected goes to the newest one only.
+    """
+    collector = Collector(current_collector())
+    _local.collector = collector
+    return collector
+
+def stop_collecting(collector):
+    """
+    Stops ``collector``, and any collector started after it, and returns it.
+    """
+    _local.collector = collector.parent
+    return collector
+
+def count(name, n=1):
+    collector = getattr(_local, 'collector', None)
+    if collector is not None:
+        collector.count(name, n)
+
+def start_timer():
+    """
+    Returns the time to give to ``stop_timer``, or None when nothing is
+    collected.
+    """
+    if getattr(_local, 'collector', None) is not None:
+        return time.time()
+
+def stop_timer(name, started):
+    """
+    Adds the time since ``started`` to the timer ``name``.
+    """
+    if started is not None:
+        collector = getattr(_local, 'collector', None)
+        if collector is not None:
+            collector.add_time(name, time.time() - started)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Collects the counters and timers of every request.  The views that stream
+    their response, like the feeds, are only collected up to the point where
+    they return it.
+
+    A collector left on the thread by a request that never got to
+    ``process_response`` is dropped when the next request starts, so that
+    request does not nest under it.
+    """
+    def process_request(self, request):
+        _local.collector = None
+        request._schedule_collector = start_collecting()
+
+    def process_exception(self, request, exception):
+        # the response built for the exception still reaches process_response,
+        # which sends the collector
+        collector = getattr(request, '_schedule_collector', None)
+        if collector is not None:
+            stop_collecting(collector)
+
+    def process_response(self, request, response):
+        collector = getattr(request, '_schedule_collector', None)
+        if collector is not None:
+            del request._schedule_collector
+            stop_collecting(collector)
+            request_instrumented.send(sender=self.__class__, request=request,
+                collector=collector)
+            for sink in INSTRUMENTATION_SINKS:
+                sink(request, collector)
+        return response
+
+
+# the timers of ServerTimingMiddleware, in the order they are reported
+SERVER_TIMINGS = ('events', 'expansion', 'persisted', 'layout')
+
+logger = logging.getLogger('schedule.timing')
+
+
+class ServerTimingMiddleware(InstrumentationMiddleware):
+    """
+    Adds a ``Server-Timing`` header to the responses of the requests that
+    expanded occurrences, or read events or persisted occurrences, and logs
+    a line of ``key=value`` pairs for them to the ``schedule.timing`` logger.
+
+    The time is split into the timers of SERVER_TIMINGS, ``render`` for the
+    rest of the request, which is mostly template rendering, and ``total``.
+    Requests whose expansion took longer than SLOW_EXPANSION_THRESHOLD
+    seconds are flagged with ``slow-expansion`` in the header and logged as
+    warnings with ``slow_expansion=1``.
+    """
+    def process_request(self, request):
+        request._schedule_started = time.time()
+        super(ServerTimingMiddleware, self).process_request(request)
+
+    def process_response(self, request, response):
+        collector = getattr(request, '_schedule_collector', None)
+        started = getattr(request, '_schedule_started', None)
+        response = super(ServerTimingMiddleware, self).process_response(request, response)
+        if collector is None or started is None or not collector.timings:
+            return response
+        total = time.time() - started
+        timings = [(name, collector.timings.get(name, 0.0)) for name in SERVER_TIMINGS]
+        timings.append(('render', max(total - sum([t for name, t in timings]), 0.0)))
+        timings.append(('total', total))
+        slow = collector.timings.get('expansion', 0.0) > SLOW_EXPANSION_THRESHOLD
+        metrics = ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in timings]
+        if slow:
+            metrics.append('slow-expansion;desc="%d rrule expansions"' % (
+                collector.counts.get('rrule_expansions', 0)))
+        response['Server-Timing'] = ', '.join(metrics)
+        fields = [('path', urlquote(request.path)), ('status', response.status_code)]
+        fields += [('%s_ms' % name, '%.1f' % (seconds * 1000)) for name, seconds in timings]
+        fields += sorted(collector.counts.items())
+        fields.append(('slow_expansion', int(slow)))
+        line = ' '.join(['%s=%s' % field for field in fields])
+        if slow:
+            logger.warning(line)
+        else:
+            logger.info(line)
+        return response
@@ -0,0 +1,68 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from schedule.benchmarks import BENCHMARKS, compare_results, run_benchmark
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--size', dest='size',
+            help='Run the benchmarks at this size instead of their own. Give several sizes separated by commas to compare them.'),
+        make_option('--json', dest='json',
+            help='Store the results in this JSON file.'),
+        make_option('--baseline', dest='baseline',
+            help='Compare the results with the ones stored in this JSON file, and fail if one regressed.'),
+        make_option('--tolerance', dest='tolerance', type='float', default=0.2,
+            help='How much slower per item, as a fraction, a result can get before it regressed. Defaults to 0.2.'),
+    )
+    help = "Runs the django-schedule benchmarks and reports the cost per item. Runs all of them unless some names are given."
+    args = '[name name ...]'
+
+    def handle(self, *names, **options):
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark %r, choose from %s." % (
+                    name, ', '.join(BENCHMARKS.keys())))
+        sizes = None
+        if options.get('size'):
+            try:
+                sizes = [int(size) for size in options['size'].split(',')]
+            except ValueError:
+                raise CommandError("--size takes integers separated by commas.")
+        baseline = None
+        if options.get('baseline'):
+            f = open(options['baseline'])
+            try:
+                baseline = simplejson.load(f)['results']
+            finally:
+                f.close()
+        results = []
+        regressions = 0
+        for name in names or BENCHMARKS.keys():
+            for size in sizes or [BENCHMARKS[name].default_size]:
+                print "%s (size %d)" % (name, size)
+                run = run_benchmark(name, size)
+                results += run
+                for result, before, ratio, regressed in compare_results(run,
+                    baseline or [], options['tolerance']):
+                    line = "    %-24s %10.4f s %10.2f us per item" % (
+                        result['label'], result['seconds'], result['us_per_item'])
+                    if ratio is not None:
+                        line += " %7.2fx baseline" % ratio
+                        if regressed:
+                            line += " REGRESSED"
+                            regressions += 1
+                    elif baseline is not None:
+                        line += "      no baseline"
+                    print line
+        if options.get('json'):
+            f = open(options['json'], 'w')
+            try:
+                simplejson.dump({'results': results}, f, indent=2)
+            finally:
+                f.close()
+        if regressions:
+            raise CommandError("%d results regressed by more than %d%%." % (
+                regressions, options['tolerance'] * 100))
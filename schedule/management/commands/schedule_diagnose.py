@@ -0,0 +1,169 @@
+import datetime
+import time
+from optparse import make_option
+
+from dateutil import rrule
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from schedule import instrumentation
+from schedule.models import Calendar, Event, Occurrence, Rule
+from schedule.utils import EventListManager
+
+SUB_DAILY = ('HOURLY', 'MINUTELY', 'SECONDLY')
+
+def month_range(date):
+    start = datetime.datetime(date.year, date.month, 1)
+    if date.month == 12:
+        return start, datetime.datetime(date.year + 1, 1, 1)
+    return start, datetime.datetime(date.year, date.month + 1, 1)
+
+
+class Diagnosis(object):
+    """
+    Measures what the calendars cost to render for the month starting at
+    ``start``.
+
+    The counts and the estimated occurrences per month are read with a few
+    aggregate queries for all the calendars at once.  The estimate is the
+    number of occurrences a rule has in 30 days times the number of events
+    recurring by it during the month, plus the one time events of the month.
+    Unless ``measure`` is False, the occurrences of the month of every
+    calendar are then expanded with EventListManager.get_occurrences, and
+    timed.
+    """
+    def __init__(self, start, end, calendars=None, measure=True):
+        self.start = start
+        self.end = end
+        self.calendars = calendars
+        self.measure = measure
+
+    def run(self):
+        calendars = Calendar.objects.order_by('slug')
+        if self.calendars is not None:
+            calendars = calendars.filter(slug__in=self.calendars)
+        reports = [{'calendar': calendar, 'events': 0, 'open_ended': 0,
+            'sub_daily': 0, 'sub_daily_rules': [], 'overrides': 0,
+            'estimated': 0.0} for calendar in calendars]
+        by_pk = dict([(report['calendar'].pk, report) for report in reports])
+
+        def add(key, queryset, field='calendar'):
+            for row in queryset.values(field).annotate(n=Count('id')):
+                if row[field] in by_pk:
+                    by_pk[row[field]][key] += row['n']
+
+        events = Event.objects.all()
+        add('events', events)
+        recurring = events.filter(rule__isnull=False)
+        add('open_ended', recurring.filter(end_recurring_period__isnull=True))
+        add('sub_daily', recurring.filter(rule__frequency__in=SUB_DAILY))
+        add('overrides', Occurrence.objects.all(), 'event__calendar')
+        add('estimated', events.filter(rule__isnull=True, start__lt=self.end,
+            end__gte=self.start))
+
+        rates = self.rule_rates()
+        active = recurring.filter(start__lt=self.end).exclude(
+            end_recurring_period__lt=self.start)
+        for row in active.values('calendar', 'rule').annotate(n=Count('id')):
+            if row['calendar'] in by_pk:
+                by_pk[row['calendar']]['estimated'] += rates.get(row['rule'], 0) * row['n']
+        sub_daily = Rule.objects.filter(frequency__in=SUB_DAILY)
+        for calendar_pk, name in recurring.filter(rule__in=sub_daily).values_list(
+            'calendar', 'rule__name').distinct():
+            if calendar_pk in by_pk:
+                by_pk[calendar_pk]['sub_daily_rules'].append(name)
+
+        if self.measure:
+            for report in reports:
+                self.measure_calendar(report)
+        return reports
+
+    def rule_rates(self):
+        """
+        Returns the number of occurrences of every rule in 30 days, by rule id.
+        """
+        rates = {}
+        window = datetime.timedelta(days=30)
+        for rule in Rule.objects.all():
+            try:
+                dates = rrule.rrule(getattr(rrule, rule.frequency),
+                    dtstart=self.start, until=self.start + window, **rule.get_params())
+                rates[rule.pk] = len(list(dates))
+            except (AttributeError, TypeError, ValueError):
+                rates[rule.pk] = 0
+        return rates
+
+    def measure_calendar(self, report):
+        collector = instrumentation.start_collecting()
+        try:
+            started = time.time()
+            occurrences = EventListManager(report['calendar'].event_set.all()
+                ).get_occurrences(self.start, self.end)
+            report['seconds'] = time.time() - started
+        finally:
+            instrumentation.stop_collecting(collector)
+        report['occurrences'] = len(occurrences)
+        report['rrule_expansions'] = collector.counts.get('rrule_expansions', 0)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--month', dest='month',
+            help='The month to measure, as YYYY-MM. Defaults to the current month.'),
+        make_option('--calendar', dest='calendars', action='append',
+            help='The slug of a calendar to diagnose. Can be given several times. Defaults to all of them.'),
+        make_option('--top', dest='top', type='int', default=10,
+            help='How many of the worst calendars to list. Defaults to 10.'),
+        make_option('--no-measure', dest='measure', action='store_false', default=True,
+            help='Only count and estimate, without expanding the occurrences of any calendar.'),
+    )
+    help = "Reports what every calendar costs to render: its events, open ended recurring events, estimated occurrences per month, persisted occurrences, sub daily rules and the time to expand a month. Lists the worst calendars last."
+
+    def handle(self, *args, **options):
+        if options.get('month'):
+            try:
+                date = datetime.datetime.strptime(options['month'], '%Y-%m')
+            except ValueError:
+                raise CommandError("--month takes a month as YYYY-MM.")
+        else:
+            date = datetime.datetime.now()
+        if options['top'] < 0:
+            raise CommandError("--top must not be negative.")
+        start, end = month_range(date)
+        measure = options['measure']
+        reports = Diagnosis(start, end, options.get('calendars'), measure).run()
+        header = "%-30s %7s %10s %9s %10s %9s" % ('calendar', 'events',
+            'open ended', 'sub daily', 'overrides', 'est/month')
+        if measure:
+            header += " %11s %10s" % ('occurrences', 'ms')
+        print header
+        for report in reports:
+            print self.format(report, measure)
+        if not reports:
+            return
+        if measure:
+            key = lambda report: report['seconds']
+            title = "expansion time for %s" % start.strftime('%Y-%m')
+        else:
+            key = lambda report: report['estimated']
+            title = "estimated occurrences per month"
+        worst = sorted(reports, key=key, reverse=True)[:options['top']]
+        print
+        print "Worst %d calendars by %s:" % (len(worst), title)
+        for report in worst:
+            line = "    %-30s" % report['calendar'].slug
+            if measure:
+                line += " %8.1f ms, %d rrule expansions," % (report['seconds'] * 1000,
+                    report['rrule_expansions'])
+            line += " %d occurrences per month estimated" % report['estimated']
+            if report['sub_daily_rules']:
+                line += ", sub daily rules: %s" % ', '.join(report['sub_daily_rules'])
+            print line
+
+    def format(self, report, measure):
+        line = "%-30s %7d %10d %9d %10d %9d" % (report['calendar'].slug[:30],
+            report['events'], report['open_ended'], report['sub_daily'],
+            report['overrides'], report['estimated'])
+        if measure:
+            line += " %11d %10.1f" % (report['occurrences'], report['seconds'] * 1000)
+        return line
@@ -0,0 +1,272 @@
+import datetime
+import math
+import random
+import time
+from optparse import make_option
+
+from dateutil import rrule
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from schedule.models import Calendar, Event, EventRelation, Occurrence, Rule
+from schedule.utils import bulk_insert
+
+DEFAULT_RULE_MIX = 'once:40,daily:25,weekly:25,monthly:5,hourly:5'
+
+RULES = {
+    'hourly': ('HOURLY', 'Generated hourly', ''),
+    'daily': ('DAILY', 'Generated daily', ''),
+    'weekdays': ('WEEKLY', 'Generated weekdays', 'byweekday:0,1,2,3,4'),
+    'weekly': ('WEEKLY', 'Generated weekly', ''),
+    'monthly': ('MONTHLY', 'Generated monthly', ''),
+    'yearly': ('YEARLY', 'Generated yearly', ''),
+}
+
+# the rules without params whose occurrences are evenly spaced
+STEPS = {
+    'HOURLY': datetime.timedelta(hours=1),
+    'DAILY': datetime.timedelta(days=1),
+    'WEEKLY': datetime.timedelta(weeks=1),
+}
+
+def parse_rule_mix(value):
+    """
+    Parses a rule mix like ``once:40,daily:60`` into a list of (kind, weight)
+    tuples.  ``once`` stands for the events without a rule.
+    """
+    mix = []
+    for part in value.split(','):
+        try:
+            kind, weight = part.split(':')
+            weight = float(weight)
+        except ValueError:
+            raise ValueError("invalid rule mix part %r" % part)
+        if kind != 'once' and kind not in RULES:
+            raise ValueError("unknown rule kind %r, choose from once, %s" % (
+                kind, ', '.join(sorted(RULES))))
+        if weight < 0:
+            raise ValueError("negative weight in %r" % part)
+        mix.append((kind, weight))
+    if not sum([weight for kind, weight in mix]):
+        raise ValueError("the rule mix %r has no weight" % value)
+    return mix
+
+
+class Generator(object):
+    """
+    Writes a reproducible synthetic dataset: ``calendars`` calendars of
+    ``events`` events each, their rules drawn from ``rule_mix``, a share
+    ``override_ratio`` of the occurrences of the recurring events persisted
+    as moved or cancelled overrides, and ``fan_out`` EventRelations per
+    event to a pool of ``users`` users.
+
+    Every table is written with ``bulk_insert`` and each calendar is
+    committed on its own, so millions of rows fit in memory and in minutes.
+    The same ``seed`` always produces the same rows.
+    """
+    def __init__(self, calendars=10, events=100, rule_mix=DEFAULT_RULE_MIX,
+        override_ratio=0.01, fan_out=0, users=100, seed=0, start=None,
+        days=365, open_ended=0.5, prefix='generated'):
+        self.calendars = calendars
+        self.events = events
+        self.rule_mix = parse_rule_mix(rule_mix)
+        self.override_ratio = override_ratio
+        self.fan_out = fan_out
+        self.users = users
+        self.random = random.Random(seed)
+        self.start = start or datetime.datetime(2009, 1, 1)
+        self.days = days
+        self.open_ended = open_ended
+        self.prefix = prefix
+        self.counts = {'calendars': 0, 'events': 0, 'occurrences': 0,
+            'relations': 0, 'users': 0}
+
+    def run(self):
+        if Calendar.objects.filter(slug__startswith='%s-' % self.prefix).count():
+            raise ValueError("calendars prefixed %r already exist" % self.prefix)
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            try:
+                self.rules = self.get_rules()
+                self.user_ids = self.get_users()
+                transaction.commit()
+                for i in range(self.calendars):
+                    self.generate_calendar(i)
+                    transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            transaction.leave_transaction_management()
+        return self.counts
+
+    def get_rules(self):
+        rules = {}
+        for kind, weight in self.rule_mix:
+            if kind == 'once':
+                rules[kind] = None
+                continue
+            frequency, name, params = RULES[kind]
+            rule, created = Rule.objects.get_or_create(name=name, defaults={
+                'frequency': frequency, 'params': params or None,
+                'description': name})
+            rules[kind] = rule
+        return rules
+
+    def get_users(self):
+        if not self.fan_out:
+            return []
+        prefix = '%s_user' % self.prefix
+        existing = User.objects.filter(username__startswith=prefix).count()
+        if existing < self.users:
+            self.counts['users'] = bulk_insert(User, (User(username='%s%d' % (prefix, i))
+                for i in xrange(existing, self.users)))
+        return list(User.objects.filter(username__startswith=prefix
+            ).order_by('id').values_list('id', flat=True)[:self.users])
+
+    def pick_kind(self):
+        point = self.random.uniform(0, sum([weight for kind, weight in self.rule_mix]))
+        for kind, weight in self.rule_mix:
+            point -= weight
+            if point <= 0:
+                break
+        return kind
+
+    def generate_calendar(self, index):
+        rand = self.random
+        calendar = Calendar(name='%s %d' % (self.prefix.capitalize(), index),
+            slug='%s-%d' % (self.prefix, index))
+        calendar.save()
+        self.counts['calendars'] += 1
+        events = []
+        for i in xrange(self.events):
+            kind = self.pick_kind()
+            rule = self.rules[kind]
+            start = self.start + datetime.timedelta(days=rand.randrange(self.days),
+                hours=rand.randrange(6, 20), minutes=rand.choice((0, 15, 30, 45)))
+            minutes = kind == 'hourly' and 30 or rand.choice((30, 60, 90, 120, 180))
+            end_recurring_period = None
+            if rule is not None and rand.random() >= self.open_ended:
+                end_recurring_period = start + datetime.timedelta(
+                    days=rand.randrange(1, self.days + 1))
+            events.append(Event(calendar=calendar, rule=rule,
+                title='%s event %d.%d' % (kind.capitalize(), index, i),
+                description='', start=start,
+                end=start + datetime.timedelta(minutes=minutes),
+                end_recurring_period=end_recurring_period))
+        self.counts['events'] += bulk_insert(Event, events)
+        # bulk_insert does not set the ids
+        saved = Event.objects.filter(calendar=calendar).order_by('id').values_list(
+            'id', 'start', 'end', 'rule', 'end_recurring_period', 'title')
+        self.counts['occurrences'] += bulk_insert(Occurrence, self.overrides(saved))
+        self.counts['relations'] += bulk_insert(EventRelation, self.relations(saved))
+
+    def overrides(self, events):
+        if not self.override_ratio:
+            return
+        rand = self.random
+        rules = dict([(rule.pk, rule) for rule in self.rules.values() if rule])
+        window_end = self.start + datetime.timedelta(days=self.days * 2)
+        for pk, start, end, rule_id, end_recurring_period, title in events:
+            if rule_id is None:
+                continue
+            until = min(end_recurring_period or window_end, window_end)
+            for original_start in self.override_starts(rules[rule_id], start, until):
+                original_end = original_start + (end - start)
+                cancelled = rand.random() < 0.5
+                shift = datetime.timedelta(minutes=not cancelled and rand.choice((-60, -30, 30, 60)) or 0)
+                yield Occurrence(event_id=pk, title=title, description='',
+                    start=original_start + shift, end=original_end + shift,
+                    original_start=original_start, original_end=original_end,
+                    cancelled=cancelled)
+
+    def override_indexes(self):
+        """
+        Yields the increasing indexes of the occurrences to override, each
+        drawn with probability ``override_ratio``.  The gaps between them
+        are drawn instead of every index, so dense rules stay cheap.
+        """
+        index = -1
+        log = math.log(1.0 - min(self.override_ratio, 0.999999))
+        while True:
+            index += 1 + int(math.log(1.0 - self.random.random()) / log)
+            yield index
+
+    def override_starts(self, rule, start, until):
+        indexes = self.override_indexes()
+        step = not rule.params and STEPS.get(rule.frequency)
+        if step:
+            # evenly spaced occurrences are computed rather than expanded
+            for index in indexes:
+                original_start = start + step * index
+                if original_start > until:
+                    return
+                yield original_start
+        else:
+            wanted = indexes.next()
+            for index, original_start in enumerate(rrule.rrule(
+                getattr(rrule, rule.frequency), dtstart=start, until=until,
+                **rule.get_params())):
+                if index == wanted:
+                    yield original_start
+                    wanted = indexes.next()
+
+    def relations(self, events):
+        if not self.fan_out or not self.user_ids:
+            return
+        content_type = ContentType.objects.get_for_model(User)
+        fan_out = min(self.fan_out, len(self.user_ids))
+        for event in events:
+            for user_id in self.random.sample(self.user_ids, fan_out):
+                yield EventRelation(event_id=event[0], content_type=content_type,
+                    object_id=user_id, distinction='attendee')
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--calendars', dest='calendars', type='int', default=10,
+            help='How many calendars to create.'),
+        make_option('--events', dest='events', type='int', default=100,
+            help='How many events to create per calendar.'),
+        make_option('--rule-mix', dest='rule_mix', default=DEFAULT_RULE_MIX,
+            help='The weights of the rules of the events, like %s. The kinds are once, %s.' % (
+                DEFAULT_RULE_MIX, ', '.join(sorted(RULES)))),
+        make_option('--override-ratio', dest='override_ratio', type='float', default=0.01,
+            help='The share of the occurrences of the recurring events that are persisted as moved or cancelled.'),
+        make_option('--fan-out', dest='fan_out', type='int', default=0,
+            help='How many users each event is related to.'),
+        make_option('--users', dest='users', type='int', default=100,
+            help='The size of the pool of users the events are related to.'),
+        make_option('--days', dest='days', type='int', default=365,
+            help='Over how many days, from 2009-01-01, the events start.'),
+        make_option('--open-ended', dest='open_ended', type='float', default=0.5,
+            help='The share of the recurring events that never end.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='The seed of the random generator. The same seed produces the same data.'),
+        make_option('--prefix', dest='prefix', default='generated',
+            help='The prefix of the slugs of the calendars and of the user names.'),
+    )
+    help = "Generates a reproducible synthetic dataset for load testing."
+
+    def handle(self, *args, **options):
+        for name in ('calendars', 'events', 'users', 'days'):
+            if options[name] < 1:
+                raise CommandError("--%s must be positive." % name)
+        if not 0 <= options['override_ratio'] <= 1 or not 0 <= options['open_ended'] <= 1:
+            raise CommandError("--override-ratio and --open-ended are between 0 and 1.")
+        try:
+            generator = Generator(options['calendars'], options['events'],
+                options['rule_mix'], options['override_ratio'], options['fan_out'],
+                options['users'], options['seed'], days=options['days'],
+                open_ended=options['open_ended'], prefix=options['prefix'])
+            started = time.time()
+            counts = generator.run()
+        except ValueError, e:
+            raise CommandError(str(e))
+        elapsed = max(time.time() - started, 0.001)
+        rows = sum(counts.values())
+        print "Created %(calendars)d calendars, %(events)d events, %(occurrences)d occurrences, %(relations)d relations and %(users)d users." % counts
+        print "%.1f seconds, %.0f rows per second." % (elapsed, rows / elapsed)
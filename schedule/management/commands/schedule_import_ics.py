@@ -0,0 +1,202 @@
+import datetime
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from schedule.feeds.icalendar import parse_datetime, parse_duration, parse_rrule, read_vevents, unescape_text
+from schedule.models import Calendar, Event, Occurrence, Rule
+from schedule.signals import defer_version_bumps, flush_version_bumps
+from schedule.utils import bulk_insert
+
+
+def rule_key(frequency, params):
+    """
+    The key Rules are deduplicated by: their frequency and their params in
+    the canonical ``Rule.params`` format.
+    """
+    parts = []
+    for key in sorted(params):
+        values = params[key]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        parts.append('%s:%s' % (key, ','.join([str(v) for v in values])))
+    return frequency, ';'.join(parts)
+
+
+class Importer(object):
+    """
+    Writes the VEVENTs of iCalendar streams into a calendar.
+
+    Events are inserted one by one, as their ids are needed by their
+    occurrences, but the occurrences are inserted with ``bulk_insert`` and
+    every ``batch_size`` events are committed in a single transaction.  The
+    calendar version is bumped once at the end.
+    """
+    def __init__(self, calendar, batch_size=1000):
+        self.calendar = calendar
+        self.batch_size = batch_size
+        self.rules = {}
+        for rule in Rule.objects.all():
+            self.rules.setdefault(rule_key(rule.frequency, rule.get_params()), rule)
+        # the masters of recurring events by UID, for the RECURRENCE-IDs
+        self.masters = {}
+        # RECURRENCE-IDs read before their master
+        self.orphans = {}
+        self.occurrences = []
+        self.pending = 0
+        self.events = self.occurrences_written = self.rules_created = self.skipped = 0
+
+    def run(self, lines):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        defer_version_bumps()
+        try:
+            try:
+                for vevent in read_vevents(lines):
+                    self.add(vevent)
+                    if self.pending >= self.batch_size:
+                        self.commit()
+                self.skipped += sum([len(o) for o in self.orphans.values()])
+                self.orphans = {}
+                self.commit()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            # the batches committed so far are bumped even if the import fails
+            flush_version_bumps()
+            transaction.commit()
+            transaction.leave_transaction_management()
+
+    def commit(self):
+        bulk_insert(Occurrence, self.occurrences)
+        self.occurrences_written += len(self.occurrences)
+        self.occurrences = []
+        self.pending = 0
+        transaction.commit()
+
+    def get_rule(self, frequency, params):
+        key = rule_key(frequency, params)
+        rule = self.rules.get(key)
+        if rule is None:
+            name = frequency.capitalize()
+            if key[1]:
+                name = ('%s %s' % (name, key[1]))[:32]
+            rule = Rule(frequency=frequency, params=key[1] or None, name=name,
+                description='%s %s' % (frequency, key[1]))
+            rule.save()
+            self.rules[key] = rule
+            self.rules_created += 1
+        return rule
+
+    def add(self, vevent):
+        def first(name, default=None):
+            return vevent.get(name, [({}, default)])[0]
+
+        def moment(name):
+            params, value = first(name)
+            return parse_datetime(value, params.get('TZID'))
+
+        if 'DTSTART' not in vevent:
+            self.skipped += 1
+            return
+        try:
+            params, value = first('DTSTART')
+            start = parse_datetime(value, params.get('TZID'))
+            if 'DTEND' in vevent:
+                end = moment('DTEND')
+            elif 'DURATION' in vevent:
+                end = start + parse_duration(first('DURATION')[1])
+            elif params.get('VALUE') == 'DATE' or 'T' not in value:
+                end = start + datetime.timedelta(days=1)
+            else:
+                end = start
+            title = unescape_text(first('SUMMARY', '')[1])[:255]
+            description = unescape_text(first('DESCRIPTION', '')[1]) or None
+            uid = first('UID', '')[1]
+            if 'RECURRENCE-ID' in vevent:
+                self.add_override(uid, moment('RECURRENCE-ID'),
+                    start, end, title, description,
+                    first('STATUS', '')[1].upper() == 'CANCELLED')
+                return
+            rule = end_recurring_period = None
+            if 'RRULE' in vevent:
+                frequency, rule_params, end_recurring_period = parse_rrule(first('RRULE')[1])
+                rule = self.get_rule(frequency, rule_params)
+            exdates = []
+            for params, value in vevent.get('EXDATE', []):
+                exdates.extend([parse_datetime(v, params.get('TZID')) for v in value.split(',')])
+        except (TypeError, ValueError):
+            self.skipped += 1
+            return
+        event = Event(calendar=self.calendar, title=title, description=description,
+            start=start, end=end, rule=rule, end_recurring_period=end_recurring_period)
+        event.save(force_insert=True)
+        self.events += 1
+        self.pending += 1
+        for exdate in exdates:
+            self.add_occurrence(event, exdate, exdate + (end - start), cancelled=True)
+        if rule is not None and uid:
+            self.masters[uid] = event
+            for override in self.orphans.pop(uid, []):
+                self.add_override(uid, *override)
+
+    def add_override(self, uid, recurrence_id, start, end, title, description,
+        cancelled):
+        event = self.masters.get(uid)
+        if event is None:
+            self.orphans.setdefault(uid, []).append(
+                (recurrence_id, start, end, title, description, cancelled))
+            return
+        self.add_occurrence(event, recurrence_id,
+            recurrence_id + (event.end - event.start), start, end,
+            title or event.title, description or event.description, cancelled)
+
+    def add_occurrence(self, event, original_start, original_end, start=None,
+        end=None, title=None, description=None, cancelled=False):
+        self.occurrences.append(Occurrence(event=event,
+            original_start=original_start, original_end=original_end,
+            start=start or original_start, end=end or original_end,
+            title=title or event.title, description=description or event.description,
+            cancelled=cancelled))
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--calendar', dest='calendar',
+            help='The slug of the calendar to import into. It is created if needed.'),
+        make_option('--name', dest='name',
+            help='The name of the calendar, if it has to be created.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='How many events are committed per transaction.'),
+    )
+    help = "Imports the VEVENTs of iCalendar files into a calendar. RRULEs become Rules, EXDATEs cancelled occurrences and RECURRENCE-IDs moved occurrences. Use - to read stdin."
+    args = '<file file ...>'
+
+    def handle(self, *paths, **options):
+        if not paths or not options.get('calendar'):
+            raise CommandError("Give a --calendar and at least one file.")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        calendar, created = Calendar.objects.get_or_create(
+            slug=options['calendar'],
+            defaults={'name': options.get('name') or options['calendar']})
+        importer = Importer(calendar, options['batch_size'])
+        started = time.time()
+        for path in paths:
+            if path == '-':
+                importer.run(sys.stdin)
+            else:
+                f = open(path)
+                try:
+                    importer.run(f)
+                finally:
+                    f.close()
+        elapsed = max(time.time() - started, 0.001)
+        print "Imported %d events and %d occurrences into %s, created %d rules, skipped %d." % (
+            importer.events, importer.occurrences_written, calendar.slug,
+            importer.rules_created, importer.skipped)
+        print "%.1f seconds, %.0f events per second." % (elapsed, importer.events / elapsed)
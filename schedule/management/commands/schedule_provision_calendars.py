@@ -0,0 +1,51 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+
+from schedule.models import Calendar
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--distinction', dest='distinction',
+            help='The distinction of the relations between the objects and their calendars.'),
+        make_option('--filter', dest='filters', action='append', default=[],
+            help='Only provision the objects matching this field=value lookup. Can be repeated.'),
+        make_option('--name', dest='name', default='%(object)s',
+            help='The name of the new calendars, %(object)s being the object. Defaults to the object.'),
+    )
+    help = "Creates a calendar for every object of a model that does not have one yet. Running it again only creates the calendars of the new objects."
+    args = '<app_label.model>'
+
+    def handle(self, *labels, **options):
+        if len(labels) != 1 or '.' not in labels[0]:
+            raise CommandError("Give one model, as app_label.model.")
+        model = get_model(*labels[0].split('.', 1))
+        if model is None:
+            raise CommandError("Unknown model %r." % labels[0])
+        objects = model._default_manager.all()
+        for lookup in options['filters']:
+            if '=' not in lookup:
+                raise CommandError("Filters look like field=value, not %r." % lookup)
+            field, value = lookup.split('=', 1)
+            objects = objects.filter(**{str(field): value})
+        name = options['name']
+        started = time.time()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            try:
+                calendars, created = Calendar.objects.provision_calendars_for_objects(
+                    objects, options.get('distinction'),
+                    lambda obj: name % {'object': unicode(obj)})
+            except:
+                transaction.rollback()
+                raise
+            transaction.commit()
+        finally:
+            transaction.leave_transaction_management()
+        print "%d objects, created %d calendars in %.1f seconds." % (
+            len(calendars), created, time.time() - started)
@@ -1,3 +1,5 @@
 from schedule.models.calendars import *
 from schedule.models.events import *
-from schedule.models.rules import *
\ No newline at end of file
+from schedule.models.rules import *
+
+import schedule.signals
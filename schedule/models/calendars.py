@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 from django.contrib.contenttypes import generic
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Q
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.defaultfilters import slugify
 import datetime
+import itertools
 from dateutil import rrule
-from schedule.utils import EventListManager
+from schedule.conf.settings import UPCOMING_CACHE_TIMEOUT
+from schedule.utils import EventListManager, bulk_delete, bulk_insert, content_objects_q, group_content_objects, make_etag, read_persisted_occurrences, recurring_events_q
 
 class CalendarManager(models.Manager):
     """
@@ -97,6 +100,138 @@ class CalendarManager(models.Manager):
             dist_q = Q()
         return self.filter(dist_q, Q(calendarrelation__object_id=obj.id, calendarrelation__content_type=ct))
 
+    def get_calendars_for_objects(self, objects, distinction = None):
+        """
+        Like get_calendars_for_object, for many objects at once, with one
+        query.  ``objects`` is a list of model instances or a queryset.
+        Returns a dict mapping every object to the list of its calendars,
+        which is empty for the objects without any.  The objects of a
+        queryset are never loaded: only their ids are read, and the dict is
+        keyed by them.
+        """
+        # a queryset is matched with a subquery rather than a list of ids
+        groups = group_content_objects(objects)
+        if hasattr(objects, 'values_list'):
+            content_type, ids = groups[0]
+            by_key = dict([((content_type.pk, pk), pk) for pk in ids])
+        else:
+            by_key = dict([((ContentType.objects.get_for_model(type(obj)).pk,
+                obj.pk), obj) for obj in objects])
+        result = dict([(obj, []) for obj in by_key.values()])
+        if not result:
+            return result
+        relations = CalendarRelation.objects.filter(content_objects_q(groups))
+        if distinction:
+            relations = relations.filter(distinction=distinction)
+        seen = set()
+        for relation in relations.select_related('calendar').order_by('calendar'):
+            key = (relation.content_type_id, relation.object_id)
+            if (key, relation.calendar_id) in seen or key not in by_key:
+                continue
+            seen.add((key, relation.calendar_id))
+            result[by_key[key]].append(relation.calendar)
+        return result
+
+    def provision_calendars_for_objects(self, objects, distinction = None,
+        name_func = unicode, batch_size = 500):
+        """
+        Like get_or_create_calendar_for_object, for many objects at once.
+        ``objects`` is a list of model instances or a queryset.  The objects
+        that already have calendars are found with one query, and the
+        missing calendars and relations are created with bulk inserts, so it
+        is safe to run again.  The new calendars are named by ``name_func``
+        and get unique slugs.  Returns a dict mapping every object to its
+        calendar (the first one, when an object has several) and the number
+        of calendars created.  Like in get_calendars_for_objects, the dict of
+        a queryset is keyed by ids, and only the objects that get a calendar
+        are loaded.
+        """
+        existing = self.get_calendars_for_objects(objects, distinction)
+        result = {}
+        missing = []
+        for obj, calendars in existing.items():
+            if calendars:
+                result[obj] = calendars[0]
+            else:
+                missing.append(obj)
+        if not missing:
+            return result, 0
+        by_id = hasattr(objects, 'values_list')
+        if by_id:
+            missing.sort()
+            missing = [obj for offset in range(0, len(missing), batch_size)
+                for obj in objects.filter(pk__in=missing[offset:offset + batch_size]).order_by('pk')]
+        names = [name_func(obj)[:200] for obj in missing]
+        slugs = self._unique_slugs([slugify(name)[:180] or 'calendar' for name in names],
+            [obj.pk for obj in missing], batch_size)
+        now = datetime.datetime.now()
+        new_calendars = [Calendar(name=name, slug=slug, version=1, last_modified=now)
+            for name, slug in zip(names, slugs)]
+        bulk_insert(Calendar, new_calendars)
+        ids = {}
+        for offset in range(0, len(slugs), batch_size):
+            ids.update(self.filter(slug__in=slugs[offset:offset + batch_size]
+                ).values_list('slug', 'pk'))
+        relations = []
+        for obj, calendar in zip(missing, new_calendars):
+            calendar.pk = ids[calendar.slug]
+            result[by_id and obj.pk or obj] = calendar
+            relations.append(CalendarRelation(calendar=calendar,
+                content_type=ContentType.objects.get_for_model(type(obj)),
+                object_id=obj.pk, distinction=distinction, inheritable=True))
+        bulk_insert(CalendarRelation, relations)
+        return result, len(missing)
+
+    def _unique_slugs(self, slugs, suffixes, batch_size):
+        """
+        Returns ``slugs`` made unique, among themselves and against the
+        existing calendars, by appending the matching ``suffixes`` (and then
+        a counter) to the slugs that are taken.
+        """
+        result = list(slugs)
+        pending = range(len(result))
+        attempt = 0
+        taken = set()
+        while pending:
+            candidates = [result[i] for i in pending]
+            for offset in range(0, len(candidates), batch_size):
+                taken.update(self.filter(slug__in=candidates[offset:offset + batch_size]
+                    ).values_list('slug', flat=True))
+            attempt += 1
+            retry = []
+            for i in pending:
+                if result[i] in taken:
+                    retry.append(i)
+                    result[i] = '%s-%s' % (slugs[i], suffixes[i])
+                    if attempt > 1:
+                        result[i] = '%s-%d' % (result[i], attempt)
+                else:
+                    taken.add(result[i])
+            pending = retry
+        return result
+
+    def bump_version(self, calendar_ids):
+        """
+        Marks the calendars with the given ids as modified by incrementing
+        their version and setting their last_modified to now, in a single
+        query.  See schedule.signals for what calls this.
+        """
+        calendar_ids = list(calendar_ids)
+        if calendar_ids:
+            self.filter(pk__in=calendar_ids).update(version=F('version') + 1,
+                last_modified=datetime.datetime.now())
+
+    def get_version(self, **kwargs):
+        """
+        Returns a (version, last_modified) tuple for the calendar matching
+        ``kwargs`` without loading the calendar, or None if there is no such
+        calendar.  This is all the conditional views need to know.
+        """
+        stamps = self.filter(**kwargs).values_list('version', 'last_modified')[:1]
+        if stamps:
+            return tuple(stamps[0])
+        return None
+
 class Calendar(models.Model):
     '''
     This is for grouping events so that batch relations can be made to all
@@ -134,6 +269,8 @@ class Calendar(models.Model):
 
     name = models.CharField(_("name"), max_length = 200)
     slug = models.SlugField(_("slug"),max_length = 200)
+    version = models.PositiveIntegerField(_("version"), default = 0, editable = False)
+    last_modified = models.DateTimeField(_("last modified"), default = datetime.datetime.now, editable = False)
     objects = CalendarManager()
 
     class Meta:
@@ -144,6 +281,11 @@ class Calendar(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.version += 1
+        self.last_modified = datetime.datetime.now()
+        super(Calendar, self).save(*args, **kwargs)
+
     def events(self):
         return self.event_set.all()
     events = property(events)
@@ -157,6 +299,14 @@ class Calendar(models.Model):
         """
         CalendarRelation.objects.create_relation(self, obj, distinction, inheritable)
 
+    def bulk_create_relations(self, objects, distinction = None, inheritable = True):
+        """
+        Creates CalendarRelations between self and many objects at once.  See
+        CalendarRelationManager.bulk_create_relations.
+        """
+        return CalendarRelation.objects.bulk_create_relations(self, objects,
+            distinction, inheritable)
+
     def get_recent(self, amount=5, in_datetime = datetime.datetime.now):
         """
         This shortcut function allows you to get events that have started
@@ -173,6 +323,60 @@ class Calendar(models.Model):
     def occurrences_after(self, date=None):
         return EventListManager(self.events.all()).occurrences_after(date)
 
+    def get_upcoming_occurrences(self, count=10, now=None):
+        """
+        Returns a list of the next ``count`` occurrences of the calendar that
+        end after ``now``, including the ones in progress and the persisted
+        ones moved there, with the events and their creators loaded.
+
+        The occurrences are kept in the cache, along with as many spare ones,
+        under a key that changes with the version of the calendar.  So they
+        are only computed again when the calendar changes, or when so many of
+        them have ended that fewer than ``count`` are left.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        key = 'schedule.upcoming.%s' % make_etag(self.pk, self.version,
+            self.last_modified, count)
+        cached = None
+        if UPCOMING_CACHE_TIMEOUT:
+            cached = cache.get(key)
+        if cached is not None:
+            computed, occurrences = cached
+            if computed <= now:
+                exhausted = len(occurrences) < 2 * count
+                occurrences = [occ for occ in occurrences if occ.end > now]
+                if len(occurrences) >= count or exhausted:
+                    return occurrences[:count]
+        occurrences = self._compute_upcoming_occurrences(2 * count, now)
+        if UPCOMING_CACHE_TIMEOUT:
+            cache.set(key, (now, occurrences), UPCOMING_CACHE_TIMEOUT)
+        return occurrences[:count]
+
+    def _compute_upcoming_occurrences(self, count, now):
+        from schedule.models import Occurrence
+        # occurrences_after follows the original times, so the occurrences
+        # moved after now from a time that was over by then are read apart
+        moved_in = read_persisted_occurrences(Occurrence.objects.filter(
+            event__calendar = self, end__gt = now, original_end__lte = now))
+        # only the events that can still occur after now are expanded
+        events = self.event_set.all()
+        events = events.filter(
+            Q(rule__isnull = True, end__gt = now) |
+            recurring_events_q(events, now) |
+            Q(id__in = [occ.event_id for occ in moved_in])
+            ).select_related('rule', 'creator')
+        occurrences = list(itertools.islice(
+            EventListManager(events).occurrences_after(now), count))
+        occurrences = sorted([occ for occ in occurrences + moved_in
+            if occ.end > now])[:count]
+        # persisted occurrences come with an event of their own, without its
+        # creator
+        events = dict([(event.pk, event) for event in events])
+        for occ in occurrences:
+            occ.event = events[occ.event_id]
+        return occurrences
+
     def get_absolute_url(self):
         return reverse('calendar_home', kwargs={'calendar_slug':self.slug})
 
@@ -193,11 +397,52 @@ class CalendarRelationManager(models.Manager):
             object_id = object_id,
             calendar = calendar,
             distinction = distinction,
+            inheritable = inheritable,
             content_object = content_object
         )
         cr.save()
         return cr
 
+    def bulk_create_relations(self, calendar, objects, distinction=None, inheritable=True):
+        """
+        Relates every object of ``objects``, a list of model instances or a
+        queryset, to calendar with bulk inserts.  The content type of each
+        model is looked up once, and the objects of a queryset are never
+        loaded.  Returns the number of relations created.
+        """
+        from schedule.signals import bump_calendars
+        count = bulk_insert(CalendarRelation, (CalendarRelation(content_type=ct,
+            object_id=object_id, calendar=calendar, distinction=distinction,
+            inheritable=inheritable)
+            for ct, ids in group_content_objects(objects) for object_id in ids))
+        bump_calendars([calendar.pk])
+        return count
+
+    def change_distinction(self, distinction, new_distinction):
+        """
+        Changes the relations with one distinction to another with a single
+        UPDATE.
+        """
+        from schedule.signals import bump_calendars
+        relations = self.filter(distinction=distinction)
+        bump_calendars(relations.values_list('calendar', flat=True).distinct())
+        relations.update(distinction=new_distinction)
+
+    def remove_relations(self, calendar, objects=None, distinction=None):
+        """
+        Deletes the relations of calendar to ``objects`` (every object if it
+        is None) under ``distinction`` (every distinction if it is None) with
+        a single DELETE.
+        """
+        from schedule.signals import bump_calendars
+        relations = self.filter(calendar=calendar)
+        if distinction:
+            relations = relations.filter(distinction=distinction)
+        if objects is not None:
+            relations = relations.filter(content_objects_q(group_content_objects(objects)))
+        bulk_delete(relations)
+        bump_calendars([calendar.pk])
+
 class CalendarRelation(models.Model):
     '''
     This is for relating data to a Calendar, and possible all of the events for
@@ -217,8 +462,8 @@ class CalendarRelation(models.Model):
     inheritable: a boolean that decides if events of the calendar should also
     inherit this relation
 
-    DISCLAIMER: while this model is a nice out of the box feature to have, it
-    may not scale well.  If you use this, keep that in mind.
+    Relations are looked up by object through a (content_type, object_id,
+    distinction) index created by sql/calendarrelation.sql.
     '''
 
     calendar = models.ForeignKey(Calendar, verbose_name=_("calendar"))
@@ -10,8 +10,9 @@ from django.utils.translation import ugettext, ugettext_lazy as _
 import datetime
 from dateutil import rrule
 from schedule.models.rules import Rule
-from schedule.models.calendars import Calendar
-from schedule.utils import OccurrenceReplacer
+from schedule.models.calendars import Calendar, CalendarRelation
+from schedule.instrumentation import count, start_timer, stop_timer
+from schedule.utils import OccurrenceReplacer, bulk_delete, bulk_insert, content_objects_q, group_content_objects, occurrence_url, read_persisted_occurrences
 
 class EventManager(models.Manager):
 
@@ -23,14 +24,14 @@ class Event(models.Model):
     This model stores meta data for a date.  You can relate this data to many
     other models.
     '''
-    start = models.DateTimeField(_("start"))
-    end = models.DateTimeField(_("end"),help_text=_("The end time must be later than the start time."))
+    start = models.DateTimeField(_("start"), db_index = True)
+    end = models.DateTimeField(_("end"), db_index = True, help_text=_("The end time must be later than the start time."))
     title = models.CharField(_("title"), max_length = 255)
     description = models.TextField(_("description"), null = True, blank = True)
     creator = models.ForeignKey(User, null = True, verbose_name=_("creator"))
     created_on = models.DateTimeField(_("created on"), default = datetime.datetime.now)
     rule = models.ForeignKey(Rule, null = True, blank = True, verbose_name=_("rule"), help_text=_("Select '----' for a one time only event."))
-    end_recurring_period = models.DateTimeField(_("end recurring period"), null = True, blank = True, help_text=_("This date is ignored for one time only events."))
+    end_recurring_period = models.DateTimeField(_("end recurring period"), null = True, blank = True, db_index = True, help_text=_("This date is ignored for one time only events."))
     calendar = models.ForeignKey(Calendar)
     objects = EventManager()
 
@@ -56,7 +57,14 @@ class Event(models.Model):
         """
         EventRelation.objects.create_relation(self, obj, distinction)
 
-    def get_occurrences(self, start, end):
+    def bulk_create_relations(self, objects, distinction = None):
+        """
+        Creates EventRelations between self and many objects at once.  See
+        EventRelationManager.bulk_create_relations.
+        """
+        return EventRelation.objects.bulk_create_relations(self, objects, distinction)
+
+    def get_occurrences(self, start, end, persisted_occurrences=None):
         """
         >>> rule = Rule(frequency = "MONTHLY", name = "Monthly")
         >>> rule.save()
@@ -74,8 +82,12 @@ class Event(models.Model):
         >>> ["%s to %s" %(o.start, o.end) for o in occurrences]
         []
 
+        The persisted occurrences of the event are read unless they are given
+        as ``persisted_occurrences``, like Period does for all of its events
+        with one query.
         """
-        persisted_occurrences = self.occurrence_set.all()
+        if persisted_occurrences is None:
+            persisted_occurrences = self.get_persisted_occurrences()
         occ_replacer = OccurrenceReplacer(persisted_occurrences)
         occurrences = self._get_occurrence_list(start, end)
         final_occurrences = []
@@ -94,6 +106,16 @@ class Event(models.Model):
         final_occurrences += occ_replacer.get_additional_occurrences(start, end)
         return final_occurrences
 
+    def get_persisted_occurrences(self):
+        """
+        Returns the list of the persisted occurrences of this event, with the
+        event set on each of them.
+        """
+        occurrences = read_persisted_occurrences(self.occurrence_set.all())
+        for occurrence in occurrences:
+            occurrence.set_event(self)
+        return occurrences
+
     def get_rrule_object(self):
         if self.rule is not None:
             params = self.rule.get_params()
@@ -108,14 +130,20 @@ class Event(models.Model):
     def get_occurrence(self, date):
         rule = self.get_rrule_object()
         if rule:
+            started = start_timer()
             next_occurrence = rule.after(date, inc=True)
+            stop_timer('expansion', started)
+            count('rrule_expansions')
         else:
             next_occurrence = self.start
         if next_occurrence == date:
-            try:
-                return Occurrence.objects.get(event = self, original_start = date)
-            except Occurrence.DoesNotExist:
-                return self._create_occurrence(next_occurrence)
+            occurrences = read_persisted_occurrences(Occurrence.objects.filter(
+                event = self, original_start = date)[:1])
+            if occurrences:
+                occurrences[0].set_event(self)
+                return occurrences[0]
+            count('occurrences_generated')
+            return self._create_occurrence(next_occurrence)
 
 
     def _get_occurrence_list(self, start, end):
@@ -128,14 +156,19 @@ class Event(models.Model):
             if self.end_recurring_period and self.end_recurring_period < end:
                 end = self.end_recurring_period
             rule = self.get_rrule_object()
+            started = start_timer()
             o_starts = rule.between(start-difference, end, inc=True)
+            stop_timer('expansion', started)
+            count('rrule_expansions')
             for o_start in o_starts:
                 o_end = o_start + difference
                 occurrences.append(self._create_occurrence(o_start, o_end))
+            count('occurrences_generated', len(occurrences))
             return occurrences
         else:
             # check if event is in the period
             if self.start < end and self.end >= start:
+                count('occurrences_generated')
                 return [self._create_occurrence(self.start)]
             else:
                 return []
@@ -151,16 +184,19 @@ class Event(models.Model):
         rule = self.get_rrule_object()
         if rule is None:
             if self.end > after:
+                count('occurrences_generated')
                 yield self._create_occurrence(self.start, self.end)
             raise StopIteration
+        count('rrule_expansions')
         date_iter = iter(rule)
         difference = self.end - self.start
         while True:
             o_start = date_iter.next()
-            if o_start > self.end_recurring_period:
+            if self.end_recurring_period and o_start > self.end_recurring_period:
                 raise StopIteration
             o_end = o_start + difference
             if o_end > after:
+                count('occurrences_generated')
                 yield self._create_occurrence(o_start, o_end)
 
 
@@ -169,7 +205,7 @@ class Event(models.Model):
         returns a generator that produces occurrences after the datetime
         ``after``.  Includes all of the persisted Occurrences.
         """
-        occ_replacer = OccurrenceReplacer(self.occurrence_set.all())
+        occ_replacer = OccurrenceReplacer(self.get_persisted_occurrences())
         generator = self._occurrences_after_generator(after)
         while True:
             next = generator.next()
@@ -260,33 +296,58 @@ class EventRelationManager(models.Manager):
         [<Event: Test1: Tuesday, Jan. 1, 2008-Friday, Jan. 11, 2008>, <Event: Test2: Tuesday, Jan. 1, 2008-Friday, Jan. 11, 2008>]
         '''
         ct = ContentType.objects.get_for_model(type(content_object))
+        # Each side is an IN subquery on the (content_type, object_id,
+        # distinction) index of its relation table, so the events are never
+        # joined to the relations and no duplicate rows come back.
+        lookup = dict(content_type=ct, object_id=content_object.id)
         if distinction:
-            dist_q = Q(eventrelation__distinction = distinction)
-            cal_dist_q = Q(calendar__calendarrelation__distinction = distinction)
-        else:
-            dist_q = Q()
-            cal_dist_q = Q()
+            lookup['distinction'] = distinction
+        q = Q(id__in=EventRelation.objects.filter(**lookup).values('event'))
         if inherit:
-            inherit_q = Q(
-                cal_dist_q,
-                calendar__calendarrelation__object_id = content_object.id,
-                calendar__calendarrelation__content_type = ct,
-                calendar__calendarrelation__inheritable = True,
-            )
-        else:
-            inherit_q = Q()
-        event_q = Q(dist_q, Q(eventrelation__object_id=content_object.id),Q(eventrelation__content_type=ct))
-        return Event.objects.filter(inherit_q|event_q)
+            q |= Q(calendar__in=CalendarRelation.objects.filter(
+                inheritable=True, **lookup).values('calendar'))
+        return Event.objects.filter(q)
 
     def change_distinction(self, distinction, new_distinction):
         '''
         This function is for change the a group of eventrelations from an old
         distinction to a new one. It should only be used for managerial stuff.
-        It is also expensive so it should be used sparingly.
+        The relations are changed with a single UPDATE.
+        '''
+        from schedule.signals import bump_calendars
+        relations = self.filter(distinction = distinction)
+        bump_calendars(Event.objects.filter(id__in=relations.values('event')
+            ).values_list('calendar', flat=True).distinct())
+        relations.update(distinction = new_distinction)
+
+    def bulk_create_relations(self, event, objects, distinction=None):
+        '''
+        Relates every object of ``objects``, a list of model instances or a
+        queryset, to event with bulk inserts.  The content type of each model
+        is looked up once, and the objects of a queryset are never loaded.
+        Returns the number of relations created.
         '''
-        for relation in self.filter(distinction = distinction):
-            relation.distinction = new_distinction
-            relation.save()
+        from schedule.signals import bump_calendars
+        count = bulk_insert(EventRelation, (EventRelation(content_type=ct,
+            object_id=object_id, event=event, distinction=distinction)
+            for ct, ids in group_content_objects(objects) for object_id in ids))
+        bump_calendars([event.calendar_id])
+        return count
+
+    def remove_relations(self, event, objects=None, distinction=None):
+        '''
+        Deletes the relations of event to ``objects`` (every object if it is
+        None) under ``distinction`` (every distinction if it is None) with a
+        single DELETE.
+        '''
+        from schedule.signals import bump_calendars
+        relations = self.filter(event=event)
+        if distinction:
+            relations = relations.filter(distinction=distinction)
+        if objects is not None:
+            relations = relations.filter(content_objects_q(group_content_objects(objects)))
+        bulk_delete(relations)
+        bump_calendars([event.calendar_id])
 
     def create_relation(self, event, content_object, distinction=None):
         """
@@ -321,8 +382,8 @@ class EventRelation(models.Model):
     distinction: a string representing a distinction of the relation, User could
     have a 'veiwer' relation and an 'owner' relation for example.
 
-    DISCLAIMER: while this model is a nice out of the box feature to have, it
-    may not scale well.  If you use this keep that in mindself.
+    Relations are looked up by object through a (content_type, object_id,
+    distinction) index created by sql/eventrelation.sql.
     '''
     event = models.ForeignKey(Event, verbose_name=_("event"))
     content_type = models.ForeignKey(ContentType)
@@ -343,12 +404,34 @@ class EventRelation(models.Model):
 
 
 
+class EventDefault(object):
+    """
+    Stands for a field of Occurrence that, when it is None, reads the same
+    field of the event.  The event is only loaded when the value is read, so
+    reading rows does not query each event.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.name)
+        if value is None and (instance.event_id is not None or
+            hasattr(instance, '_event_cache')):
+            value = getattr(instance.event, self.name)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
 class Occurrence(models.Model):
     event = models.ForeignKey(Event, verbose_name=_("event"))
     title = models.CharField(_("title"), max_length=255, blank=True, null=True)
     description = models.TextField(_("description"), blank=True, null=True)
-    start = models.DateTimeField(_("start"))
-    end = models.DateTimeField(_("end"))
+    start = models.DateTimeField(_("start"), db_index = True)
+    end = models.DateTimeField(_("end"), db_index = True)
     cancelled = models.BooleanField(_("cancelled"), default=False)
     original_start = models.DateTimeField(_("original start"))
     original_end = models.DateTimeField(_("original end"))
@@ -358,13 +441,12 @@ class Occurrence(models.Model):
         verbose_name_plural = _("occurrences")
         app_label = 'schedule'
 
-    def __init__(self, *args, **kwargs):
-        super(Occurrence, self).__init__(*args, **kwargs)
-        if self.title is None:
-            self.title = self.event.title
-        if self.description is None:
-            self.description = self.event.description
-
+    def set_event(self, event):
+        """
+        Sets the event of this occurrence without a query, so that the title
+        and description it takes from ``event`` are read without one either.
+        """
+        self.event = event
 
     def moved(self):
         return self.original_start != self.start or self.original_end != self.end
@@ -384,46 +466,13 @@ class Occurrence(models.Model):
         self.save()
 
     def get_absolute_url(self):
-        if self.pk is not None:
-            return reverse('occurrence', kwargs={'occurrence_id': self.pk,
-                'event_id': self.event.id})
-        return reverse('occurrence_by_date', kwargs={
-            'event_id': self.event.id,
-            'year': self.start.year,
-            'month': self.start.month,
-            'day': self.start.day,
-            'hour': self.start.hour,
-            'minute': self.start.minute,
-            'second': self.start.second,
-        })
+        return occurrence_url('view', self)
 
     def get_cancel_url(self):
-        if self.pk is not None:
-            return reverse('cancel_occurrence', kwargs={'occurrence_id': self.pk,
-                'event_id': self.event.id})
-        return reverse('cancel_occurrence_by_date', kwargs={
-            'event_id': self.event.id,
-            'year': self.start.year,
-            'month': self.start.month,
-            'day': self.start.day,
-            'hour': self.start.hour,
-            'minute': self.start.minute,
-            'second': self.start.second,
-        })
+        return occurrence_url('cancel', self)
 
     def get_edit_url(self):
-        if self.pk is not None:
-            return reverse('edit_occurrence', kwargs={'occurrence_id': self.pk,
-                'event_id': self.event.id})
-        return reverse('edit_occurrence_by_date', kwargs={
-            'event_id': self.event.id,
-            'year': self.start.year,
-            'month': self.start.month,
-            'day': self.start.day,
-            'hour': self.start.hour,
-            'minute': self.start.minute,
-            'second': self.start.second,
-        })
+        return occurrence_url('edit', self)
 
     def __unicode__(self):
         return ugettext("%(start)s to %(end)s") % {
@@ -439,3 +488,7 @@ class Occurrence(models.Model):
 
     def __eq__(self, other):
         return self.event == other.event and self.original_start == other.original_start and self.original_end == other.original_end
+
+# the model fields are plain attributes, which these replace on the class
+Occurrence.title = EventDefault('title')
+Occurrence.description = EventDefault('description')
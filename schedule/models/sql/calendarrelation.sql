@@ -0,0 +1,3 @@
+-- CalendarManager.get_calendars_for_object and
+-- EventRelationManager.get_events_for_object look relations up by object.
+CREATE INDEX schedule_calendarrelation_object ON schedule_calendarrelation (content_type_id, object_id, distinction);
@@ -0,0 +1,2 @@
+-- EventRelationManager.get_events_for_object looks relations up by object.
+CREATE INDEX schedule_eventrelation_object ON schedule_eventrelation (content_type_id, object_id, distinction);
@@ -0,0 +1,11 @@
+-- Adds the version stamp of calendars (Calendar.version and
+-- Calendar.last_modified) to a database created before it existed.  Django
+-- does not run this file; feed it to the database once, for instance with
+-- ./manage.py dbshell < schedule/models/sql/upgrade/calendar_version.sql
+--
+-- The column types are the ones of SQLite and MySQL. On PostgreSQL, write
+-- "timestamp with time zone" instead of "datetime", and on Oracle use
+-- "NUMBER(11)" and "TIMESTAMP".
+ALTER TABLE schedule_calendar ADD COLUMN version integer NOT NULL DEFAULT 0;
+ALTER TABLE schedule_calendar ADD COLUMN last_modified datetime NOT NULL DEFAULT '2000-01-01 00:00:00';
+UPDATE schedule_calendar SET last_modified = CURRENT_TIMESTAMP;
@@ -1,11 +1,13 @@
 import datetime
+from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.template.defaultfilters import date
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils.dates import WEEKDAYS, WEEKDAYS_ABBR
 from schedule.conf.settings import FIRST_DAY_OF_WEEK, SHOW_CANCELLED_OCCURRENCES
 from schedule.models import Occurrence
-from schedule.utils import OccurrenceReplacer
+from schedule.instrumentation import count, start_timer, stop_timer
+from schedule.utils import OccurrenceReplacer, read_persisted_occurrences, select_rules
 
 weekday_names = []
 weekday_abbrs = []
@@ -30,9 +32,10 @@ class Period(object):
     '''
     def __init__(self, events, start, end, parent_persisted_occurrences = None,
         occurrence_pool=None):
+        count('periods')
         self.start = start
         self.end = end
-        self.events = events
+        self.events = select_rules(events)
         self.occurrence_pool = occurrence_pool
         if parent_persisted_occurrences is not None:
             self._persisted_occurrences = parent_persisted_occurrences
@@ -47,9 +50,17 @@ class Period(object):
                 if occurrence.start <= self.end and occurrence.end >= self.start:
                     occurrences.append(occurrence)
             return occurrences
-        for event in self.events:
-            event_occurrences = event.get_occurrences(self.start, self.end)
-            occurrences += event_occurrences
+        started = start_timer()
+        events = list(self.events)
+        stop_timer('events', started)
+        persisted = {}
+        for occurrence in self.get_persisted_occurrences():
+            persisted.setdefault(occurrence.event_id, []).append(occurrence)
+        for event in events:
+            event_persisted = persisted.get(event.id, [])
+            for occurrence in event_persisted:
+                occurrence.set_event(event)
+            occurrences += event.get_occurrences(self.start, self.end, event_persisted)
         return sorted(occurrences)
 
     def cached_get_sorted_occurrences(self):
@@ -61,13 +72,21 @@ class Period(object):
     occurrences = property(cached_get_sorted_occurrences)
 
     def get_persisted_occurrences(self):
-        if hasattr(self, '_persisted_occurrenes'):
-            return self._persisted_occurrences
-        else:
-            self._persisted_occurrences = Occurrence.objects.filter(event__in = self.events)
-            return self._persisted_occurrences
+        """
+        Returns the list of the persisted occurrences of the events that are
+        or were (before they moved) in this period, read with one query and
+        shared with the sub periods.
+        """
+        if not hasattr(self, '_persisted_occurrences'):
+            self._persisted_occurrences = read_persisted_occurrences(
+                Occurrence.objects.filter(
+                Q(start__lt=self.end, end__gte=self.start) |
+                Q(original_start__lte=self.end, original_end__gte=self.start),
+                event__in=self.events))
+        return self._persisted_occurrences
 
     def classify_occurrence(self, occurrence):
+        count('classifications')
         if occurrence.cancelled and not SHOW_CANCELLED_OCCURRENCES:
             return
         if occurrence.start > self.end or occurrence.end < self.start:
@@ -113,7 +132,11 @@ class Period(object):
 
     def create_sub_period(self, cls, start=None):
         start = start or self.start
-        return cls(self.events, start, self.get_persisted_occurrences(), self.occurrences)
+        occurrences = self.occurrences
+        # the persisted occurrences are shared once they have been read, which
+        # they are unless the occurrences came from an occurrence pool
+        return cls(self.events, start, getattr(self, '_persisted_occurrences', None),
+            occurrences)
 
     def get_periods(self, cls):
         period = self.create_sub_period(cls)
@@ -0,0 +1,85 @@
+"""
+Keeps the version of every calendar up to date.
+
+Whenever an event, an occurrence, a rule or a relation changes, the version
+of the calendars it affects is bumped (see CalendarManager.bump_version).
+The conditional views and feeds compare that version with what the client
+already has, so they can answer 304 without expanding any occurrences.
+
+Bulk operations can call ``defer_version_bumps`` before writing and
+``flush_version_bumps`` afterwards, so that every calendar they touch is
+bumped once instead of once per row.
+"""
+import threading
+from django.db.models import signals
+from schedule.models import Calendar, CalendarRelation, Event, EventRelation, Occurrence, Rule
+
+_deferred = threading.local()
+
+def defer_version_bumps():
+    """
+    Collects the calendars to bump, in this thread, until
+    ``flush_version_bumps`` is called.
+    """
+    if getattr(_deferred, 'calendar_ids', None) is None:
+        _deferred.calendar_ids = set()
+
+def flush_version_bumps():
+    """
+    Bumps every calendar collected since ``defer_version_bumps`` with one
+    query and stops deferring.
+    """
+    calendar_ids = getattr(_deferred, 'calendar_ids', None)
+    _deferred.calendar_ids = None
+    if calendar_ids:
+        Calendar.objects.bump_version(calendar_ids)
+
+def bump_calendars(calendar_ids):
+    calendar_ids = [pk for pk in calendar_ids if pk is not None]
+    deferred = getattr(_deferred, 'calendar_ids', None)
+    if deferred is not None:
+        deferred.update(calendar_ids)
+    else:
+        Calendar.objects.bump_version(calendar_ids)
+
+
+def event_post_init(sender, instance, **kwargs):
+    # the calendar the event was loaded or last saved with
+    instance._original_calendar_id = instance.calendar_id
+
+def event_pre_save(sender, instance, **kwargs):
+    # remember the calendar the event is moved away from
+    instance._previous_calendar_id = None
+    if instance.pk is not None and instance.calendar_id != instance._original_calendar_id:
+        instance._previous_calendar_id = instance._original_calendar_id
+
+def event_changed(sender, instance, **kwargs):
+    bump_calendars([instance.calendar_id,
+        getattr(instance, '_previous_calendar_id', None)])
+    instance._original_calendar_id = instance.calendar_id
+
+def occurrence_changed(sender, instance, **kwargs):
+    bump_calendars(Event.objects.filter(pk=instance.event_id).values_list('calendar', flat=True))
+
+def rule_changed(sender, instance, **kwargs):
+    bump_calendars(Event.objects.filter(rule=instance).values_list('calendar', flat=True).distinct())
+
+def event_relation_changed(sender, instance, **kwargs):
+    occurrence_changed(sender, instance, **kwargs)
+
+def calendar_relation_changed(sender, instance, **kwargs):
+    bump_calendars([instance.calendar_id])
+
+
+signals.post_init.connect(event_post_init, sender=Event)
+signals.pre_save.connect(event_pre_save, sender=Event)
+signals.post_save.connect(event_changed, sender=Event)
+signals.post_delete.connect(event_changed, sender=Event)
+signals.post_save.connect(occurrence_changed, sender=Occurrence)
+signals.post_delete.connect(occurrence_changed, sender=Occurrence)
+signals.post_save.connect(rule_changed, sender=Rule)
+signals.pre_delete.connect(rule_changed, sender=Rule)
+signals.post_save.connect(event_relation_changed, sender=EventRelation)
+signals.post_delete.connect(event_relation_changed, sender=EventRelation)
+signals.post_save.connect(calendar_relation_changed, sender=CalendarRelation)
+signals.post_delete.connect(calendar_relation_changed, sender=CalendarRelation)
@@ -1,15 +1,99 @@
 import datetime
 from django.conf import settings
 from django import template
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.template.loader import get_template
 from django.utils.dateformat import format
-from schedule.conf.settings import CHECK_PERMISSION_FUNC
+from django.utils.translation import get_language
+from schedule.conf.settings import CHECK_PERMISSION_FUNC, FRAGMENT_CACHE_SHARED, FRAGMENT_CACHE_TIMEOUT, PERMISSION_CLASS_FUNC
+from schedule.instrumentation import start_timer, stop_timer
 from schedule.models import Calendar
 from schedule.periods import weekday_names, weekday_abbrs,  Month
+from schedule.utils import attach_occurrence_options, get_request_cache, make_etag
 
 register = template.Library()
 
-@register.inclusion_tag("schedule/_month_table.html",  takes_context=True)
+# the number of calendarN classes in schedule.css
+CALENDAR_COLOURS = 6
+
+def fragment_cache_timeout():
+    """
+    Returns FRAGMENT_CACHE_TIMEOUT as set on schedule.templatetags.scheduletags,
+    or 0 when the fragments cannot be shared (see FRAGMENT_CACHE_SHARED).
+    Django imports this file a second time, as django.templatetags.scheduletags,
+    for {% load %}, and both copies read the values of the first.
+    """
+    from schedule.templatetags import scheduletags
+    if not scheduletags.FRAGMENT_CACHE_SHARED:
+        return 0
+    return scheduletags.FRAGMENT_CACHE_TIMEOUT
+
+class CachedInclusionNode(template.Node):
+    """
+    Renders like an inclusion tag that takes the context, but keeps the
+    output in the cache under the key returned by ``key_func``, which is
+    called with the same arguments as ``func``.  Nothing is cached when
+    ``key_func`` returns None.
+    """
+    def __init__(self, func, key_func, template_name, vars_to_resolve):
+        self.func = func
+        self.key_func = key_func
+        self.template_name = template_name
+        self.vars_to_resolve = [template.Variable(var) for var in vars_to_resolve]
+
+    def render(self, context):
+        args = [context] + [var.resolve(context) for var in self.vars_to_resolve]
+        key = None
+        timeout = fragment_cache_timeout()
+        if timeout:
+            key = self.key_func(*args)
+        if key is not None:
+            output = cache.get(key)
+            if output is not None:
+                return output
+        if not hasattr(self, 'nodelist'):
+            self.nodelist = get_template(self.template_name).nodelist
+        new_context = template.Context(self.func(*args), autoescape=context.autoescape)
+        output = self.nodelist.render(new_context)
+        if key is not None:
+            cache.set(key, output, timeout)
+        return output
+
+def cached_inclusion_tag(template_name, key_func):
+    def dec(func):
+        def compile_func(parser, token):
+            return CachedInclusionNode(func, key_func, template_name,
+                token.split_contents()[1:])
+        register.tag(func.__name__, compile_func)
+        return func
+    return dec
+
+def fragment_cache_key(name, context, calendar, *args):
+    """
+    The cache key of a fragment of ``calendar``: it changes with the version
+    of the calendar, the permission class of the user and the language.
+    """
+    if calendar is None or 'request' not in context:
+        return None
+    user = context['request'].user
+    return 'schedule.%s.%s' % (name, make_etag(calendar.pk, calendar.version,
+        calendar.last_modified, PERMISSION_CLASS_FUNC(calendar, user),
+        get_language(), *args))
+
+def month_table_cache_key(context, calendar, month, size="regular", shift=None):
+    return fragment_cache_key('month_table', context, calendar, month.start,
+        size, shift)
+
+def day_cell_cache_key(context, calendar, day, month, size="regular", calendars=None):
+    if calendars is not None:
+        # a merged cell changes with every one of the calendars
+        return None
+    return fragment_cache_key('day_cell', context, calendar, day.start,
+        month.start, size)
+
+@cached_inclusion_tag("schedule/_month_table.html", month_table_cache_key)
 def month_table(context,  calendar, month, size="regular", shift=None):
     if shift:
         if shift == -1:
@@ -25,16 +109,27 @@ def month_table(context,  calendar, month, size="regular", shift=None):
     context['size'] = size
     return context
 
-@register.inclusion_tag("schedule/_day_cell.html",  takes_context=True)
-def day_cell(context,  calendar, day, month, size="regular" ):
+@cached_inclusion_tag("schedule/_day_cell.html", day_cell_cache_key)
+def day_cell(context,  calendar, day, month, size="regular", calendars=None):
     context.update({
         'calendar' : calendar,
+        'calendars' : calendars,
         'day' : day,
         'month' : month,
         'size' : size
     })
     return context
 
+@register.filter
+def calendar_colour(index):
+    """
+    The CSS class that colours the calendar at position ``index`` of merged
+    calendars.  The classes are reused in turn past the last one.
+    """
+    if index is None or index == '':
+        return ''
+    return 'calendar%d' % (int(index) % CALENDAR_COLOURS)
+
 
 @register.inclusion_tag("schedule/_daily_table.html", takes_context=True)
 def daily_table( context, day, width, width_slot, height, start=8, end=20, increment=30):
@@ -53,7 +148,10 @@ def daily_table( context, day, width, width_slot, height, start=8, end=20, incre
     width_occ = width - width_slot
     day_part = day.get_time_slot(day.start  + datetime.timedelta(hours=start), day.start  + datetime.timedelta(hours=end))
     occurrences = day_part.get_occurrences()
+    started = start_timer()
     occurrences = _cook_occurrences(day_part, occurrences, width_occ, height)
+    stop_timer('layout', started)
+    attach_occurrence_options(occurrences, user, get_request_cache(context['request']))
     # get slots to display on the left
     slots = _cook_slots(day_part, increment, width, height)
     context['occurrences'] = occurrences
@@ -77,16 +175,11 @@ def options(context, occurrence ):
         'occurrence' : occurrence,
         'MEDIA_URL' : getattr(settings, "MEDIA_URL"),
     })
-    context['view_occurrence'] = occurrence.get_absolute_url()
-    user = context['request'].user
-    if CHECK_PERMISSION_FUNC(occurrence.event, user):
-        context['edit_occurrence'] = occurrence.get_edit_url()
-        print context['edit_occurrence']
-        context['cancel_occurrence'] = occurrence.get_cancel_url()
-        context['delete_event'] = reverse('delete_event', args=(occurrence.event.id,))
-        context['edit_event'] = reverse('edit_event', args=(occurrence.event.calendar.slug, occurrence.event.id,))
-    else:
-        context['edit_event'] = context['delete_event'] = ''
+    if not hasattr(occurrence, 'options'):
+        request = context['request']
+        attach_occurrence_options([occurrence], request.user,
+            get_request_cache(request))
+    context.update(occurrence.options)
     return context
 
 @register.inclusion_tag("schedule/_create_event_options.html", takes_context=True)
@@ -103,6 +196,26 @@ def create_event_url(context, calendar, slot ):
         querystring_for_date(slot))
     return context
 
+def get_cached_calendars(context, objects, distinction):
+    """
+    Returns a dict mapping each of ``objects`` to its calendars under
+    ``distinction``, looked up with one query for the objects that are not
+    in the request cache yet.
+    """
+    if 'request' in context:
+        request_cache = get_request_cache(context['request'])
+    else:
+        request_cache = {}
+    def key(obj):
+        return ('calendars', ContentType.objects.get_for_model(type(obj)).pk,
+            obj.pk, distinction)
+    missing = [obj for obj in objects if key(obj) not in request_cache]
+    if missing:
+        for obj, calendars in Calendar.objects.get_calendars_for_objects(
+            missing, distinction).items():
+            request_cache[key(obj)] = calendars
+    return dict([(obj, request_cache[key(obj)]) for obj in objects])
+
 class CalendarNode(template.Node):
     def __init__(self, content_object, distinction, context_var, create=False):
         self.content_object = template.Variable(content_object)
@@ -110,8 +223,13 @@ class CalendarNode(template.Node):
         self.context_var = context_var
 
     def render(self, context):
-        calendar = Calendar.objects.get_calendar_for_object(self.content_object.resolve(context), self.distinction)
-        context[self.context_var] = Calendar.objects.get_calendar_for_object(self.content_object.resolve(context), self.distinction)
+        obj = self.content_object.resolve(context)
+        calendars = get_cached_calendars(context, [obj], self.distinction)[obj]
+        if len(calendars) == 0:
+            raise Calendar.DoesNotExist, "Calendar does not exist."
+        elif len(calendars) > 1:
+            raise AssertionError, "More than one calendars were found."
+        context[self.context_var] = calendars[0]
         return ''
 
 def do_get_calendar_for_object(parser, token):
@@ -133,7 +251,15 @@ class CreateCalendarNode(template.Node):
         self.name = name
 
     def render(self, context):
-        context[self.context_var] = Calendar.objects.get_or_create_calendar_for_object(self.content_object.resolve(context), self.distinction, name = self.name)
+        obj = self.content_object.resolve(context)
+        calendars = get_cached_calendars(context, [obj], self.distinction)[obj]
+        if len(calendars) > 1:
+            raise AssertionError, "More than one calendars were found."
+        if not calendars:
+            # the new calendar goes into the list held by the request cache
+            calendars.append(Calendar.objects.get_or_create_calendar_for_object(
+                obj, self.distinction, name = self.name))
+        context[self.context_var] = calendars[0]
         return ''
 
 def do_get_or_create_calendar_for_object(parser, token):
@@ -162,8 +288,46 @@ def do_get_or_create_calendar_for_object(parser, token):
         raise template.TemplateSyntaxError, "%r tag follows form %r <content_object> [named <calendar name>] [by <distinction>] as <context_var>" % (token.split_contents()[0], token.split_contents()[0])
     return CreateCalendarNode(obj, distinction, context_var, name)
 
+class PrefetchCalendarsNode(template.Node):
+    def __init__(self, objects, distinction, context_var):
+        self.objects = template.Variable(objects)
+        self.distinction = distinction
+        self.context_var = context_var
+
+    def render(self, context):
+        calendars = get_cached_calendars(context, list(self.objects.resolve(context)),
+            self.distinction)
+        if self.context_var:
+            context[self.context_var] = calendars
+        return ''
+
+def do_prefetch_calendars(parser, token):
+    """
+    {% prefetch_calendars <objects> [by <distinction>] [as <context_var>] %}
+
+    Looks up the calendars of all of ``objects`` with one query, so that the
+    ``get_calendar`` tags that follow for those objects do not query again.
+    With ``as`` the dict mapping each object to its calendars is put in the
+    context.
+    """
+    contents = token.split_contents()
+    if len(contents) < 2:
+        raise template.TemplateSyntaxError, "%r tag follows form %r <objects> [by <distinction>] [as <context_var>]" % (contents[0], contents[0])
+    distinction = context_var = None
+    options = contents[2:]
+    while options:
+        if len(options) < 2 or options[0] not in ('by', 'as'):
+            raise template.TemplateSyntaxError, "%r tag follows form %r <objects> [by <distinction>] [as <context_var>]" % (contents[0], contents[0])
+        if options[0] == 'by':
+            distinction = options[1]
+        else:
+            context_var = options[1]
+        options = options[2:]
+    return PrefetchCalendarsNode(contents[1], distinction, context_var)
+
 register.tag('get_calendar', do_get_calendar_for_object)
 register.tag('get_or_create_calendar', do_get_or_create_calendar_for_object)
+register.tag('prefetch_calendars', do_prefetch_calendars)
 
 @register.simple_tag
 def querystring_for_date(date, num=6):
@@ -217,12 +381,13 @@ def _cook_occurrences(period, occs, width, height):
         height - height of the table (px)
     """
     last = {}
+    cooked = []
     # find out which occurrences overlap
     for o in occs:
         o.data = period.classify_occurrence(o)
         if not o.data:
-            occs.remove(o)
             continue
+        cooked.append(o)
         o.level = -1
         o.max = 0
         if not last:
@@ -238,6 +403,7 @@ def _cook_occurrences(period, occs, width, height):
                 k = k + 1
                 last[k] = o
                 o.level = k
+    occs = cooked
     # calculate position and dimensions
     for o in occs:
         # number of overlapping occurrences
@@ -3,4 +3,6 @@ from test_utils import *
 from test_periods import *
 from test_templatetags import *
 from test_views import *
-
+from test_freebusy import *
+from test_feeds import *
+from test_queries import *
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import StringIO
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase
+from django.test import Client
+
+from schedule.feeds import UpcomingEventsFeed
+from schedule.feeds.atom import ChunkBuffer, Feed, ValidationError
+from schedule.feeds.icalendar import content_line, escape_text, fold_line, format_rrule, parse_datetime, parse_rrule
+from schedule.models import Calendar, Event, Rule
+
+class TestICalendarWriter(TestCase):
+
+    def test_escape_text(self):
+        self.assertEqual(escape_text(u'a;b,c\\d\ne'), u'a\;b\\,c\\\\d\\ne')
+
+    def test_fold_line(self):
+        line = u'SUMMARY:' + u'x' * 200
+        folded = fold_line(line)
+        physical = folded.split('\r\n')
+        self.assertEqual(physical[-1], '')
+        for part in physical[:-1]:
+            self.assertTrue(len(part) <= 75)
+        for part in physical[1:-1]:
+            self.assertTrue(part.startswith(' '))
+        self.assertEqual(''.join([physical[0]] + [p[1:] for p in physical[1:]]),
+            line.encode('utf-8'))
+
+    def test_fold_does_not_split_characters(self):
+        line = u'SUMMARY:' + u'\xe9' * 100
+        for part in fold_line(line).split('\r\n'):
+            part.decode('utf-8')
+            self.assertTrue(len(part) <= 75)
+
+    def test_short_line_is_not_folded(self):
+        self.assertEqual(fold_line(u'SUMMARY:short'), 'SUMMARY:short\r\n')
+
+    def test_content_line_values(self):
+        self.assertEqual(content_line('dtstart', datetime.datetime(2008, 1, 5, 8, 30)),
+            'DTSTART:20080105T083000\r\n')
+        self.assertEqual(content_line('dtstart', datetime.date(2008, 1, 5)),
+            'DTSTART;VALUE=DATE:20080105\r\n')
+        self.assertEqual(content_line('last_modified', datetime.datetime(2008, 1, 5)),
+            'LAST-MODIFIED:20080105T000000\r\n')
+
+    def test_format_rrule(self):
+        self.assertEqual(format_rrule('WEEKLY', {'byweekday': [0, 2], 'count': 4}),
+            'FREQ=WEEKLY;COUNT=4;BYDAY=MO,WE')
+        self.assertEqual(format_rrule('MONTHLY', {'bymonthday': -1},
+            datetime.datetime(2008, 6, 1)),
+            'FREQ=MONTHLY;UNTIL=20080601T000000;BYMONTHDAY=-1')
+        self.assertEqual(format_rrule('YEARLY', {'byeaster': 0}), None)
+
+
+class TestCalendarICalendar(TestCase):
+
+    def test_export(self):
+        calendar = Calendar(name="Export", slug="export")
+        calendar.save()
+        for day in range(1, 4):
+            Event(calendar=calendar, title=u"Caf\xe9, day %s" % day,
+                start=datetime.datetime(2008, 1, day, 8, 0),
+                end=datetime.datetime(2008, 1, day, 9, 0)).save()
+        response = Client().get('/schedule/ical/calendar/%s/' % calendar.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/calendar'))
+        content = response.content
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(content.endswith('END:VCALENDAR\r\n'))
+        self.assertEqual(content.count('BEGIN:VEVENT\r\n'), 3)
+        self.assertTrue('DTSTART:20080102T080000\r\n' in content)
+        self.assertTrue(u'SUMMARY:Caf\xe9\\, day 3\r\n'.encode('utf-8') in content)
+
+    def get_feed(self, calendar):
+        return Client().get('/schedule/ical/calendar/%s/' % calendar.pk).content
+
+    def test_recurring_export(self):
+        calendar = Calendar(name="Recurring", slug="recurring")
+        calendar.save()
+        rule = Rule(frequency="WEEKLY", name="weekly", params="byweekday:0")
+        rule.save()
+        # starts on a Tuesday, so the first instance is the next Monday
+        event = Event(calendar=calendar, title="Weekly", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 6, 1))
+        event.save()
+        event.get_occurrence(datetime.datetime(2008, 1, 14, 8, 0)).cancel()
+        moved = event.get_occurrence(datetime.datetime(2008, 1, 21, 8, 0))
+        moved.move(datetime.datetime(2008, 1, 22, 8, 0),
+            datetime.datetime(2008, 1, 22, 9, 0))
+        content = self.get_feed(calendar)
+        self.assertEqual(content.count('BEGIN:VEVENT\r\n'), 2)
+        self.assertTrue('DTSTART:20080107T080000\r\n' in content)
+        self.assertTrue('RRULE:FREQ=WEEKLY;UNTIL=20080601T000000;BYDAY=MO\r\n' in content)
+        self.assertTrue('EXDATE:20080114T080000\r\n' in content)
+        self.assertTrue('RECURRENCE-ID:20080121T080000\r\n' in content)
+        self.assertTrue('DTSTART:20080122T080000\r\n' in content)
+        self.assertEqual(content.count('UID:%s\r\n' % event.id), 2)
+
+    def test_count_and_until(self):
+        calendar = Calendar(name="Counted", slug="counted")
+        calendar.save()
+        rule = Rule(frequency="DAILY", name="three days", params="count:3")
+        rule.save()
+        Event(calendar=calendar, title="Counted", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 6, 1)).save()
+        Event(calendar=calendar, title="Cut short", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0),
+            end_recurring_period=datetime.datetime(2008, 1, 2, 8, 0)).save()
+        content = self.get_feed(calendar)
+        self.assertTrue('RRULE:FREQ=DAILY;COUNT=3\r\n' in content)
+        self.assertTrue('RRULE:FREQ=DAILY;UNTIL=20080102T080000\r\n' in content)
+
+    def test_rdate_fallback(self):
+        calendar = Calendar(name="Easter", slug="easter")
+        calendar.save()
+        rule = Rule(frequency="YEARLY", name="easter", params="byeaster:0")
+        rule.save()
+        Event(calendar=calendar, title="Easter", rule=rule,
+            start=datetime.datetime(2008, 3, 23, 10, 0),
+            end=datetime.datetime(2008, 3, 23, 11, 0),
+            end_recurring_period=datetime.datetime(2010, 12, 31)).save()
+        content = self.get_feed(calendar)
+        self.assertFalse('RRULE' in content)
+        self.assertTrue('RDATE:20090412T100000,20100404T100000\r\n' in content)
+
+
+SAMPLE_ICS = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+BEGIN:VEVENT\r
+UID:override-first\r
+RECURRENCE-ID:20080108T090000\r
+DTSTART:20080108T100000\r
+DTEND:20080108T101500\r
+SUMMARY:Late standup\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:override-first\r
+DTSTART:20080101T090000\r
+DURATION:PT15M\r
+SUMMARY:Standup\\, daily\r
+DESCRIPTION:A long description that is folded over more than one line so\r
+  that unfolding is exercised\r
+RRULE:FREQ=DAILY;UNTIL=20080131T090000\r
+EXDATE:20080105T090000,20080106T090000\r
+BEGIN:VALARM\r
+ACTION:DISPLAY\r
+DESCRIPTION:Not an event\r
+END:VALARM\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:single\r
+DTSTART;VALUE=DATE:20080214\r
+SUMMARY:Valentine\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:broken\r
+SUMMARY:No start\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:weekly\r
+DTSTART:20080107T120000\r
+DTEND:20080107T130000\r
+SUMMARY:Lunch\r
+RRULE:FREQ=DAILY;UNTIL=20080301T000000\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+class TestImportICalendar(TestCase):
+
+    def import_ics(self, content, slug="imported"):
+        path = tempfile.mktemp('.ics')
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+        try:
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                call_command('schedule_import_ics', path, calendar=slug, batch_size=2)
+            finally:
+                sys.stdout = stdout
+        finally:
+            os.remove(path)
+        return Calendar.objects.get(slug=slug)
+
+    def test_import(self):
+        calendar = self.import_ics(SAMPLE_ICS)
+        events = calendar.event_set.order_by('start')
+        self.assertEqual([e.title for e in events], [u"Standup, daily", u"Lunch", u"Valentine"])
+        standup = events[0]
+        self.assertTrue(standup.description.startswith(u"A long description"))
+        self.assertTrue(u"so that unfolding" in standup.description)
+        self.assertEqual(standup.end - standup.start, datetime.timedelta(minutes=15))
+        self.assertEqual(standup.rule.frequency, "DAILY")
+        # both daily events share one rule
+        self.assertEqual(standup.rule, events[1].rule)
+        self.assertEqual(standup.end_recurring_period, datetime.datetime(2008, 1, 31, 9, 0))
+        self.assertEqual(events[2].end - events[2].start, datetime.timedelta(days=1))
+        occurrences = standup.get_occurrences(datetime.datetime(2008, 1, 4),
+            datetime.datetime(2008, 1, 9))
+        self.assertEqual([(o.start.day, o.cancelled) for o in occurrences],
+            [(4, False), (5, True), (6, True), (7, False), (8, False)])
+        late = occurrences[-1]
+        self.assertEqual(late.start, datetime.datetime(2008, 1, 8, 10, 0))
+        self.assertEqual(late.title, u"Late standup")
+
+    def test_parse_rrule(self):
+        self.assertEqual(parse_rrule('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE'),
+            ('WEEKLY', {'interval': 2, 'byweekday': [0, 2]}, None))
+        self.assertEqual(parse_rrule('FREQ=daily')[0], 'DAILY')
+        for value in ('FREQ=FORTNIGHTLY', 'FREQ=dialy', 'INTERVAL=2'):
+            self.assertRaises(ValueError, parse_rrule, value)
+        # the events with an unknown frequency are skipped
+        calendar = self.import_ics(SAMPLE_ICS.replace('FREQ=DAILY', 'FREQ=FORTNIGHTLY'))
+        self.assertEqual([e.title for e in calendar.event_set.all()], [u"Valentine"])
+        self.assertEqual(Rule.objects.count(), 0)
+
+    def test_parse_datetime_zones(self):
+        time_zone = settings.TIME_ZONE
+        settings.TIME_ZONE = 'Europe/Paris'
+        try:
+            self.assertEqual(parse_datetime('20080107T090000Z'),
+                datetime.datetime(2008, 1, 7, 10, 0))
+            self.assertEqual(parse_datetime('20080707T090000', 'America/New_York'),
+                datetime.datetime(2008, 7, 7, 15, 0))
+            # floating times and unknown zones keep their wall time
+            self.assertEqual(parse_datetime('20080107T090000'),
+                datetime.datetime(2008, 1, 7, 9, 0))
+            self.assertEqual(parse_datetime('20080107T090000', 'Custom zone'),
+                datetime.datetime(2008, 1, 7, 9, 0))
+        finally:
+            settings.TIME_ZONE = time_zone
+        # a date UNTIL keeps its whole day
+        self.assertEqual(parse_rrule('FREQ=DAILY;UNTIL=20080131')[2],
+            datetime.datetime(2008, 1, 31, 23, 59, 59))
+
+    def test_round_trip(self):
+        calendar = Calendar(name="Source", slug="source")
+        calendar.save()
+        rule = Rule(frequency="WEEKLY", name="weekly", params="byweekday:0,2")
+        rule.save()
+        event = Event(calendar=calendar, title="Gym", rule=rule,
+            start=datetime.datetime(2008, 1, 7, 18, 0),
+            end=datetime.datetime(2008, 1, 7, 19, 0),
+            end_recurring_period=datetime.datetime(2008, 3, 1))
+        event.save()
+        event.get_occurrence(datetime.datetime(2008, 1, 9, 18, 0)).cancel()
+        content = Client().get('/schedule/ical/calendar/%s/' % calendar.pk).content
+        imported = self.import_ics(content, "copy").event_set.get()
+        self.assertEqual(imported.rule, rule)
+        window = (datetime.datetime(2008, 1, 1), datetime.datetime(2008, 4, 1))
+        self.assertEqual(
+            [(o.start, o.cancelled) for o in imported.get_occurrences(*window)],
+            [(o.start, o.cancelled) for o in event.get_occurrences(*window)])
+
+
+class TestUpcomingEventsFeed(TestCase):
+
+    def test_feed(self):
+        calendar = Calendar(name="Feed", slug="feed")
+        calendar.save()
+        rule = Rule(frequency="DAILY", name="daily")
+        rule.save()
+        Event(calendar=calendar, title="Every day", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0)).save()
+        response = Client().get('/schedule/feed/calendar/upcoming/%s/' % calendar.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count('<entry>'), 10)
+
+    def test_head_is_streamed_first(self):
+        calendar = Calendar(name="Feed", slug="feed")
+        calendar.save()
+        rule = Rule(frequency="DAILY", name="daily")
+        rule.save()
+        Event(calendar=calendar, title="Every day", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0)).save()
+        feed = UpcomingEventsFeed('upcoming', None).get_feed(str(calendar.pk))
+        consumed = []
+        def items(entries):
+            for entry in entries:
+                consumed.append(entry)
+                yield entry
+        feed.items = items(feed.items)
+        head = feed.iter_write('utf-8').next()
+        self.assertTrue('<updated>' in head)
+        self.assertEqual(consumed, [])
+
+
+class AtomItem(object):
+    def __init__(self, i):
+        self.id = i
+        self.title = u'Entry <%d> & caf\xe9' % i
+        self.updated = datetime.datetime(2009, 1, 1) + datetime.timedelta(hours=i)
+
+
+class AtomTestFeed(Feed):
+    feed_id = 'test'
+    feed_title = 'Test'
+
+    def items(self):
+        return [AtomItem(i) for i in range(5)]
+
+    def item_id(self, item):
+        return str(item.id)
+
+    def item_title(self, item):
+        return item.title
+
+    def item_updated(self, item):
+        return item.updated
+
+    def item_authors(self, item):
+        return [{'name': 'author'}]
+
+    def item_content(self, item):
+        return item.title
+
+
+class StreamedAtomTestFeed(AtomTestFeed):
+    STREAM = True
+
+
+class TestAtomFeed(TestCase):
+
+    def write(self, feed_class):
+        buf = ChunkBuffer()
+        feed_class(None, None).get_feed().write(buf, 'utf-8')
+        return buf.pop()
+
+    def test_streamed_output_is_the_same(self):
+        chunks = list(StreamedAtomTestFeed(None, None).get_feed().iter_write('utf-8'))
+        # the head, one chunk per entry and the end of the feed
+        self.assertEqual(len(chunks), 7)
+        self.assertEqual(''.join(chunks), self.write(AtomTestFeed))
+        self.assertEqual(''.join(chunks), self.write(StreamedAtomTestFeed))
+
+    def test_instance_attributes_are_not_cached(self):
+        feed = AtomTestFeed(None, None)
+        feed.feed_title = 'Changed'
+        buf = ChunkBuffer()
+        feed.get_feed().write(buf, 'utf-8')
+        self.assertTrue('<title>Changed</title>' in buf.pop())
+        self.assertTrue('<title>Test</title>' in self.write(AtomTestFeed))
+
+    def test_validation_sample(self):
+        class NoAuthorFeed(AtomTestFeed):
+            def item_authors(self, item):
+                if item.id == 3:
+                    return []
+                return [{'name': 'author'}]
+        self.assertRaises(ValidationError, NoAuthorFeed(None, None).get_feed)
+        NoAuthorFeed.VALIDATE_SAMPLE = 2
+        NoAuthorFeed(None, None).get_feed()
+        NoAuthorFeed.STREAM = True
+        NoAuthorFeed(None, None).get_feed()
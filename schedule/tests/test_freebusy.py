@@ -0,0 +1,285 @@
+import datetime
+
+from django.test import TestCase
+from django.core.urlresolvers import reverse
+from django.test import Client
+from django.utils import simplejson
+
+from schedule.models import Event, Rule, Occurrence, Calendar
+from schedule.forms import EventForm, OccurrenceForm, SpanForm
+from schedule.freebusy import merge_intervals, get_busy_intervals, get_free_intervals, get_free_busy, find_free_slots
+from schedule.freebusy import get_conflict_candidates, find_conflicts
+
+class TestFreeBusy(TestCase):
+    def setUp(self):
+        daily = Rule(frequency = "DAILY")
+        daily.save()
+        self.cal1 = Calendar(name="Room 1", slug="room-1")
+        self.cal1.save()
+        self.cal2 = Calendar(name="Room 2", slug="room-2")
+        self.cal2.save()
+        self.daily_event = Event(**{
+                'title': 'Standup',
+                'start': datetime.datetime(2008, 1, 1, 9, 0),
+                'end': datetime.datetime(2008, 1, 1, 10, 0),
+                'end_recurring_period' : datetime.datetime(2008, 2, 1, 0, 0),
+                'rule': daily,
+                'calendar': self.cal1
+               })
+        self.daily_event.save()
+        self.single_event = Event(**{
+                'title': 'Review',
+                'start': datetime.datetime(2008, 1, 2, 9, 30),
+                'end': datetime.datetime(2008, 1, 2, 11, 0),
+                'calendar': self.cal2
+               })
+        self.single_event.save()
+
+    def test_merge_intervals(self):
+        self.assertEqual(merge_intervals([
+                (datetime.datetime(2008, 1, 1, 10), datetime.datetime(2008, 1, 1, 11)),
+                (datetime.datetime(2008, 1, 1, 8), datetime.datetime(2008, 1, 1, 9)),
+                (datetime.datetime(2008, 1, 1, 8, 30), datetime.datetime(2008, 1, 1, 9, 30)),
+                (datetime.datetime(2008, 1, 1, 12), datetime.datetime(2008, 1, 1, 13)),
+            ]),
+            [(datetime.datetime(2008, 1, 1, 8), datetime.datetime(2008, 1, 1, 9, 30)),
+             (datetime.datetime(2008, 1, 1, 10), datetime.datetime(2008, 1, 1, 11)),
+             (datetime.datetime(2008, 1, 1, 12), datetime.datetime(2008, 1, 1, 13))])
+
+    def test_get_free_busy_merges_calendars(self):
+        busy = get_free_busy([self.cal1, self.cal2],
+            datetime.datetime(2008, 1, 1, 12), datetime.datetime(2008, 1, 3, 9, 30))
+        self.assertEqual(busy, [
+            (datetime.datetime(2008, 1, 2, 9), datetime.datetime(2008, 1, 2, 11)),
+            (datetime.datetime(2008, 1, 3, 9), datetime.datetime(2008, 1, 3, 9, 30))])
+
+    def test_cancelled_occurrences_are_free(self):
+        occurrence = self.daily_event.get_occurrence(datetime.datetime(2008, 1, 1, 9))
+        occurrence.cancel()
+        start, end = datetime.datetime(2008, 1, 1), datetime.datetime(2008, 1, 2)
+        self.assertEqual(get_busy_intervals(Event.objects.all(), start, end), [])
+        self.assertEqual(get_free_intervals(Event.objects.all(), start, end),
+            [(start, end)])
+
+    def test_moved_occurrences_are_busy(self):
+        occurrence = self.daily_event.get_occurrence(datetime.datetime(2008, 1, 1, 9))
+        occurrence.move(datetime.datetime(2008, 1, 1, 14), datetime.datetime(2008, 1, 1, 15))
+        busy = get_busy_intervals(Event.objects.all(),
+            datetime.datetime(2008, 1, 1), datetime.datetime(2008, 1, 2))
+        self.assertEqual(busy, [
+            (datetime.datetime(2008, 1, 1, 14), datetime.datetime(2008, 1, 1, 15))])
+
+    def test_free_busy_view(self):
+        response = Client().get(reverse('free_busy'), {
+            'calendar': ['room-1', 'room-2'],
+            'start': '2008-01-02',
+            'end': '2008-01-03'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(simplejson.loads(response.content)['busy'],
+            [['2008-01-02T09:00:00', '2008-01-02T11:00:00']])
+
+    def test_free_busy_view_ics(self):
+        response = Client().get(reverse('free_busy'), {
+            'calendar': 'room-2',
+            'start': '2008-01-02',
+            'end': '2008-01-03',
+            'format': 'ics'})
+        self.assertEqual(response['Content-Type'], 'text/calendar')
+        self.assertTrue('FREEBUSY:20080102T093000/20080102T110000' in response.content)
+
+    def test_free_busy_view_bad_window(self):
+        response = Client().get(reverse('free_busy'), {
+            'calendar': 'room-1', 'start': '2008-01-03', 'end': 'tomorrow'})
+        self.assertEqual(response.status_code, 404)
+
+
+class TestFindFreeSlots(TestCase):
+    def setUp(self):
+        daily = Rule(frequency = "DAILY")
+        daily.save()
+        self.cal = Calendar(name="Room", slug="room")
+        self.cal.save()
+        self.event = Event(**{
+                'title': 'Standup',
+                'start': datetime.datetime(2008, 1, 1, 9, 0),
+                'end': datetime.datetime(2008, 1, 1, 10, 0),
+                'rule': daily,
+                'calendar': self.cal
+               })
+        self.event.save()
+        self.working_hours = (datetime.time(9), datetime.time(11))
+
+    def test_slots_skip_busy_time(self):
+        slots = find_free_slots(Event.objects.all(), datetime.timedelta(minutes=30),
+            datetime.datetime(2008, 1, 1, 8, 30), count=3)
+        self.assertEqual(slots, [
+            (datetime.datetime(2008, 1, 1, 8, 30), datetime.datetime(2008, 1, 1, 9)),
+            (datetime.datetime(2008, 1, 1, 10), datetime.datetime(2008, 1, 1, 10, 30)),
+            (datetime.datetime(2008, 1, 1, 10, 30), datetime.datetime(2008, 1, 1, 11))])
+
+    def test_slots_respect_working_hours(self):
+        slots = find_free_slots(Event.objects.all(), datetime.timedelta(hours=1),
+            datetime.datetime(2008, 1, 1, 10, 30), count=2,
+            working_hours=self.working_hours, weekdays=[0, 1, 2, 3, 4])
+        # Jan 1st 2008 is a Tuesday, and the standup fills every morning
+        self.assertEqual(slots, [
+            (datetime.datetime(2008, 1, 2, 10), datetime.datetime(2008, 1, 2, 11)),
+            (datetime.datetime(2008, 1, 3, 10), datetime.datetime(2008, 1, 3, 11))])
+
+    def test_slots_use_moved_occurrences(self):
+        occurrence = self.event.get_occurrence(datetime.datetime(2008, 1, 2, 9))
+        occurrence.move(datetime.datetime(2008, 1, 1, 10), datetime.datetime(2008, 1, 1, 11))
+        slots = find_free_slots(Event.objects.all(), datetime.timedelta(hours=1),
+            datetime.datetime(2008, 1, 1, 9), count=2, working_hours=self.working_hours)
+        self.assertEqual(slots, [
+            (datetime.datetime(2008, 1, 2, 9), datetime.datetime(2008, 1, 2, 10)),
+            (datetime.datetime(2008, 1, 2, 10), datetime.datetime(2008, 1, 2, 11))])
+
+    def test_slots_stop_at_until(self):
+        slots = find_free_slots(Event.objects.all(), datetime.timedelta(hours=2),
+            datetime.datetime(2008, 1, 1), count=5, working_hours=self.working_hours,
+            until=datetime.datetime(2008, 1, 10))
+        self.assertEqual(slots, [])
+
+    def test_slots_stop_after_max_days(self):
+        # the standup fills the working hours of every day, forever
+        slots = find_free_slots(Event.objects.all(), datetime.timedelta(hours=1),
+            datetime.datetime(2008, 1, 1), working_hours=(datetime.time(9), datetime.time(10)),
+            max_days=30)
+        self.assertEqual(slots, [])
+
+    def test_slots_longer_than_working_hours(self):
+        self.assertRaises(ValueError, find_free_slots, Event.objects.all(),
+            datetime.timedelta(hours=3), datetime.datetime(2008, 1, 1),
+            working_hours=self.working_hours)
+        response = Client().get(reverse('next_available_slots'), {
+            'calendar': 'room', 'duration': '600', 'after': '2008-01-01T09:30:00',
+            'day_start': '09:00', 'day_end': '17:00'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_next_available_slots_view(self):
+        response = Client().get(reverse('next_available_slots'), {
+            'calendar': 'room', 'duration': '60', 'count': '1',
+            'after': '2008-01-01T09:30:00', 'day_start': '09:00', 'day_end': '17:00'})
+        self.assertEqual(simplejson.loads(response.content)['slots'],
+            [['2008-01-01T10:00:00', '2008-01-01T11:00:00']])
+
+
+class TestConflicts(TestCase):
+    def setUp(self):
+        self.weekly = Rule(frequency = "WEEKLY")
+        self.weekly.save()
+        self.cal = Calendar(name="Room", slug="room")
+        self.cal.save()
+        self.other_cal = Calendar(name="Other Room", slug="other-room")
+        self.other_cal.save()
+        self.event = Event(**{
+                'title': 'Weekly Meeting',
+                'start': datetime.datetime(2008, 1, 1, 9, 0),
+                'end': datetime.datetime(2008, 1, 1, 10, 0),
+                'rule': self.weekly,
+                'calendar': self.cal
+               })
+        self.event.save()
+        Event(**{
+                'title': 'Past Event',
+                'start': datetime.datetime(2007, 1, 1, 9, 0),
+                'end': datetime.datetime(2007, 1, 1, 10, 0),
+                'calendar': self.cal
+               }).save()
+        Event(**{
+                'title': 'Elsewhere',
+                'start': datetime.datetime(2008, 1, 8, 9, 0),
+                'end': datetime.datetime(2008, 1, 8, 10, 0),
+                'calendar': self.other_cal
+               }).save()
+
+    def form_data(self, start, end, **extra):
+        data = {
+            'title': 'New Event',
+            'start_0': start.strftime('%Y-%m-%d'),
+            'start_1': start.strftime('%H:%M:%S'),
+            'end_0': end.strftime('%Y-%m-%d'),
+            'end_1': end.strftime('%H:%M:%S'),
+        }
+        data.update(extra)
+        return data
+
+    def test_candidates_use_ranges(self):
+        candidates = get_conflict_candidates(self.cal,
+            datetime.datetime(2008, 1, 8), datetime.datetime(2008, 1, 9))
+        self.assertEqual(list(candidates), [self.event])
+
+    def test_candidates_include_the_last_occurrence(self):
+        # the last occurrence starts at the end of the series and runs past it
+        event = Event(title='Workshop', start=datetime.datetime(2008, 2, 1, 9, 0),
+            end=datetime.datetime(2008, 2, 1, 11, 0), rule=self.weekly,
+            end_recurring_period=datetime.datetime(2008, 2, 8, 10, 0), calendar=self.cal)
+        event.save()
+        window = (datetime.datetime(2008, 2, 8, 10, 30), datetime.datetime(2008, 2, 8, 11))
+        self.assertTrue(event in get_conflict_candidates(self.cal, *window))
+        conflicts = find_conflicts(self.cal, [Occurrence(start=window[0], end=window[1])])
+        self.assertEqual([(occ.event, occ.start) for occ in conflicts],
+            [(event, datetime.datetime(2008, 2, 8, 9, 0))])
+
+    def test_candidates_include_long_occurrences(self):
+        # a monthly retreat of ten days, whose last one started eight days ago
+        event = Event(title='Retreat', start=datetime.datetime(2008, 3, 1),
+            end=datetime.datetime(2008, 3, 11), rule=Rule.objects.create(frequency="MONTHLY"),
+            end_recurring_period=datetime.datetime(2008, 4, 1), calendar=self.cal)
+        event.save()
+        window = (datetime.datetime(2008, 4, 9), datetime.datetime(2008, 4, 10))
+        self.assertTrue(event in get_conflict_candidates(self.cal, *window))
+        window = (datetime.datetime(2008, 4, 11), datetime.datetime(2008, 4, 12))
+        self.assertFalse(event in get_conflict_candidates(self.cal, *window))
+
+    def test_recurring_event_conflicts(self):
+        event = Event(start=datetime.datetime(2008, 1, 14, 9, 30),
+            end=datetime.datetime(2008, 1, 14, 10, 30), rule=Rule(frequency="DAILY"),
+            end_recurring_period=datetime.datetime(2008, 1, 30))
+        occurrences = event._get_occurrence_list(event.start, event.end_recurring_period)
+        conflicts = find_conflicts(self.cal, occurrences)
+        self.assertEqual([occ.start for occ in conflicts], [
+            datetime.datetime(2008, 1, 15, 9, 0),
+            datetime.datetime(2008, 1, 22, 9, 0),
+            datetime.datetime(2008, 1, 29, 9, 0)])
+
+    def test_event_form_reports_conflicts(self):
+        form = EventForm(data=self.form_data(datetime.datetime(2008, 1, 8, 9, 30),
+            datetime.datetime(2008, 1, 8, 11)), check_conflicts=True, calendar=self.cal)
+        self.assertFalse(form.is_valid())
+        self.assertEqual([occ.start for occ in form.conflicts],
+            [datetime.datetime(2008, 1, 8, 9, 0)])
+        form = EventForm(data=self.form_data(datetime.datetime(2008, 1, 8, 10),
+            datetime.datetime(2008, 1, 8, 11)), check_conflicts=True, calendar=self.cal)
+        self.assertTrue(form.is_valid())
+
+    def test_event_form_ignores_edited_event(self):
+        form = EventForm(data=self.form_data(datetime.datetime(2008, 1, 1, 9, 30),
+            datetime.datetime(2008, 1, 1, 10, 30)), instance=self.event,
+            check_conflicts=True)
+        self.assertTrue(form.is_valid())
+
+    def test_span_form_reports_conflicts(self):
+        class MeetingForm(SpanForm):
+            class Meta:
+                model = Event
+                fields = ('title', 'start', 'end')
+        data = self.form_data(datetime.datetime(2008, 1, 8, 9, 30),
+            datetime.datetime(2008, 1, 8, 11))
+        form = MeetingForm(data=data, check_conflicts=True, calendar=self.cal)
+        self.assertFalse(form.is_valid())
+        self.assertEqual([occ.start for occ in form.conflicts],
+            [datetime.datetime(2008, 1, 8, 9, 0)])
+        self.assertTrue(MeetingForm(data=data, check_conflicts=True).is_valid())
+
+    def test_occurrence_form_ignores_itself(self):
+        occurrence = self.event.get_occurrence(datetime.datetime(2008, 1, 8, 9))
+        data = self.form_data(datetime.datetime(2008, 1, 8, 9, 30),
+            datetime.datetime(2008, 1, 8, 10, 30))
+        form = OccurrenceForm(data=data, instance=occurrence, check_conflicts=True)
+        self.assertTrue(form.is_valid())
+        data = self.form_data(datetime.datetime(2008, 1, 15, 9, 30),
+            datetime.datetime(2008, 1, 15, 10, 30))
+        form = OccurrenceForm(data=data, instance=occurrence, check_conflicts=True)
+        self.assertFalse(form.is_valid())
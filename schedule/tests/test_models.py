@@ -1,10 +1,14 @@
 import datetime
 import os
 
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 
-from schedule.models import Event, Rule, Occurrence, Calendar
+from django.contrib.auth.models import User
+
+from schedule.models import Event, EventRelation, Rule, Occurrence, Calendar, CalendarRelation
 from schedule.periods import Period, Month, Day
 from schedule.utils import EventListManager
 
@@ -129,3 +133,251 @@ class TestOccurrence(TestCase):
                                     end=self.end)
         self.assertFalse(occurrences[2].cancelled)
 
+    def test_title_from_event(self):
+        occurrence = self.recurring_event.get_occurrences(self.start, self.end)[0]
+        occurrence.save()
+        Occurrence.objects.filter(pk=occurrence.pk).update(title=None, description=None)
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            persisted = list(Occurrence.objects.all())
+            self.assertEqual(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = False
+        # read from the event when it is used
+        self.assertEqual(persisted[0].title, 'Recent Event')
+        self.assertEqual(Occurrence.objects.get(pk=occurrence.pk).description,
+            self.recurring_event.description)
+        self.assertEqual(Occurrence().title, None)
+        occurrences = self.recurring_event.get_occurrences(self.start, self.end)
+        self.assertEqual((occurrences[0].pk, occurrences[0].title), (occurrence.pk, 'Recent Event'))
+        occurrences = Period(Event.objects.all(), self.start, self.end).get_occurrences()
+        self.assertEqual((occurrences[0].pk, occurrences[0].title), (occurrence.pk, 'Recent Event'))
+
+
+
+class TestUpcomingOccurrences(TestCase):
+
+    def setUp(self):
+        self.calendar = Calendar(name="Upcoming", slug="upcoming")
+        self.calendar.save()
+        rule = Rule(frequency="DAILY", name="daily")
+        rule.save()
+        self.event = Event(calendar=self.calendar, title="Daily", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 8, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 0))
+        self.event.save()
+        # over long ago, never expanded
+        Event(calendar=self.calendar, title="Old",
+            start=datetime.datetime(2007, 1, 1, 8, 0),
+            end=datetime.datetime(2007, 1, 1, 9, 0)).save()
+        self.now = datetime.datetime(2008, 2, 1, 12, 0)
+
+    def upcoming(self, count=3, now=None):
+        calendar = Calendar.objects.get(pk=self.calendar.pk)
+        return calendar.get_upcoming_occurrences(count, now or self.now)
+
+    def test_upcoming(self):
+        occurrences = self.upcoming()
+        self.assertEqual([o.start for o in occurrences], [
+            datetime.datetime(2008, 2, 2, 8, 0),
+            datetime.datetime(2008, 2, 3, 8, 0),
+            datetime.datetime(2008, 2, 4, 8, 0)])
+        self.assertEqual([o.start for o in self.upcoming()],
+            [o.start for o in occurrences])
+
+    def test_cached_list_moves_with_time(self):
+        self.upcoming()
+        later = self.upcoming(now=datetime.datetime(2008, 2, 3, 12, 0))
+        self.assertEqual([o.start.day for o in later], [4, 5, 6])
+        much_later = self.upcoming(now=datetime.datetime(2008, 3, 1, 12, 0))
+        self.assertEqual([o.start.day for o in much_later], [2, 3, 4])
+
+    def test_change_is_seen(self):
+        self.upcoming()
+        self.event.get_occurrence(datetime.datetime(2008, 2, 2, 8, 0)).cancel()
+        occurrences = self.upcoming()
+        self.assertTrue(occurrences[0].cancelled)
+        self.assertEqual(occurrences[0].event.title, "Daily")
+
+
+    def test_occurrence_in_progress_and_moved_in(self):
+        rule = Rule.objects.get(name="daily")
+        # the last occurrence started at the end of the series and runs until 13:00
+        Event(calendar=self.calendar, title="Ending", rule=rule,
+            start=datetime.datetime(2008, 1, 20, 11, 0),
+            end=datetime.datetime(2008, 1, 20, 13, 0),
+            end_recurring_period=datetime.datetime(2008, 2, 1, 11, 0)).save()
+        # a one time event of last year, moved to tonight
+        past = Event(calendar=self.calendar, title="Postponed",
+            start=datetime.datetime(2007, 6, 1, 8, 0),
+            end=datetime.datetime(2007, 6, 1, 9, 0))
+        past.save()
+        past.get_occurrence(past.start).move(datetime.datetime(2008, 2, 1, 20, 0),
+            datetime.datetime(2008, 2, 1, 21, 0))
+        self.assertEqual([(o.event.title, o.start) for o in self.upcoming()], [
+            ("Ending", datetime.datetime(2008, 2, 1, 11, 0)),
+            ("Postponed", datetime.datetime(2008, 2, 1, 20, 0)),
+            ("Daily", datetime.datetime(2008, 2, 2, 8, 0))])
+
+
+class TestEventRelations(TestCase):
+
+    def setUp(self):
+        data = dict(start=datetime.datetime(2008, 1, 1),
+            end=datetime.datetime(2008, 1, 2))
+        self.calendar = Calendar(name="Project")
+        self.calendar.save()
+        self.other = Calendar(name="Other")
+        self.other.save()
+        self.owned = Event(title="Owned", calendar=self.other, **data)
+        self.owned.save()
+        self.viewed = Event(title="Viewed", calendar=self.other, **data)
+        self.viewed.save()
+        self.inherited = Event(title="Inherited", calendar=self.calendar, **data)
+        self.inherited.save()
+        self.user = User.objects.create(username="alice")
+        self.owned.create_relation(self.user, 'owner')
+        self.viewed.create_relation(self.user, 'viewer')
+        self.calendar.create_relation(self.user, 'viewer', True)
+
+    def get_titles(self, *args, **kwargs):
+        return sorted([e.title for e in EventRelation.objects.get_events_for_object(
+            self.user, *args, **kwargs)])
+
+    def test_get_events_for_object(self):
+        self.assertEqual(self.get_titles(), ["Inherited", "Owned", "Viewed"])
+        self.assertEqual(self.get_titles('viewer'), ["Inherited", "Viewed"])
+        self.assertEqual(self.get_titles('owner'), ["Owned"])
+        self.assertEqual(self.get_titles('viewer', inherit=False), ["Viewed"])
+
+    def test_no_duplicates(self):
+        # an event related both directly and through its calendar
+        self.inherited.create_relation(self.user, 'viewer')
+        self.assertEqual(self.get_titles('viewer'), ["Inherited", "Viewed"])
+
+    def test_not_inheritable(self):
+        other = User.objects.create(username="bob")
+        self.calendar.create_relation(other, 'viewer', False)
+        self.assertEqual(list(EventRelation.objects.get_events_for_object(other)), [])
+
+    def test_bulk_create_relations(self):
+        users = [User.objects.create(username="user%d" % i) for i in range(3)]
+        self.assertEqual(self.viewed.bulk_create_relations(users, 'viewer'), 3)
+        self.assertEqual(self.calendar.bulk_create_relations(
+            User.objects.filter(username__startswith="user"), 'member', False), 3)
+        for user in users:
+            self.assertEqual(list(EventRelation.objects.get_events_for_object(user, 'viewer')),
+                [self.viewed])
+            self.assertEqual(list(EventRelation.objects.get_events_for_object(user, 'member')), [])
+            self.assertEqual(list(Calendar.objects.get_calendars_for_object(user, 'member')),
+                [self.calendar])
+
+    def test_change_distinction(self):
+        version = Calendar.objects.get(pk=self.other.pk).version
+        EventRelation.objects.change_distinction('viewer', 'reader')
+        self.assertEqual(self.get_titles('reader', inherit=False), ["Viewed"])
+        self.assertEqual(self.get_titles('viewer', inherit=False), [])
+        self.assertEqual(Calendar.objects.get(pk=self.other.pk).version, version + 1)
+        CalendarRelation.objects.change_distinction('viewer', 'reader')
+        self.assertEqual(self.get_titles('reader'), ["Inherited", "Viewed"])
+
+    def test_remove_relations(self):
+        bob = User.objects.create(username="bob")
+        self.viewed.bulk_create_relations([bob], 'viewer')
+        EventRelation.objects.remove_relations(self.viewed, [self.user])
+        self.assertEqual(self.get_titles(inherit=False), ["Owned"])
+        self.assertEqual(list(EventRelation.objects.get_events_for_object(bob)), [self.viewed])
+        EventRelation.objects.remove_relations(self.owned, User.objects.all(), 'viewer')
+        self.assertEqual(self.get_titles(inherit=False), ["Owned"])
+        EventRelation.objects.remove_relations(self.viewed)
+        self.assertEqual(list(EventRelation.objects.get_events_for_object(bob)), [])
+        CalendarRelation.objects.remove_relations(self.calendar, [self.user], 'viewer')
+        self.assertEqual(self.get_titles(), ["Owned"])
+
+
+class TestProvisionCalendars(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=name)
+            for name in ("alice", "bob", "bob2", "carol")]
+        # a calendar already taking alice's slug, and carol's own calendar
+        Calendar.objects.create(name="alice", slug="alice")
+        self.carol = Calendar.objects.get_or_create_calendar_for_object(
+            self.users[3], 'owner')
+
+    def test_provision(self):
+        calendars, created = Calendar.objects.provision_calendars_for_objects(
+            User.objects.all(), 'owner', lambda user: user.username.rstrip('2'))
+        self.assertEqual(created, 3)
+        # a queryset gives a dict keyed by ids
+        self.assertEqual(calendars[self.users[3].pk], self.carol)
+        slugs = [calendars[user.pk].slug for user in self.users[:3]]
+        self.assertEqual(slugs[1], 'bob')
+        self.assertEqual(len(set(Calendar.objects.values_list('slug', flat=True))),
+            Calendar.objects.count())
+        for user in self.users:
+            self.assertEqual(Calendar.objects.get_calendar_for_object(user, 'owner'),
+                calendars[user.pk])
+        self.assertEqual(Calendar.objects.provision_calendars_for_objects(
+            User.objects.all(), 'owner'), (calendars, 0))
+
+
+class TestGenerateData(TestCase):
+
+    def generate(self, **kwargs):
+        from schedule.management.commands.schedule_generate_data import Generator
+        options = dict(calendars=2, events=20, override_ratio=0.05, fan_out=3,
+            users=10, seed=7, days=30)
+        options.update(kwargs)
+        return Generator(**options).run()
+
+    def test_generate(self):
+        counts = self.generate(rule_mix='once:1,daily:1,hourly:1')
+        self.assertEqual(counts['calendars'], 2)
+        self.assertEqual(Event.objects.filter(calendar__slug__startswith='generated-').count(), 40)
+        self.assertEqual(EventRelation.objects.count(), 120)
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(Occurrence.objects.count(), counts['occurrences'])
+        self.assertTrue(counts['occurrences'] > 0)
+        for occurrence in Occurrence.objects.select_related('event'):
+            self.assertNotEqual(occurrence.event.rule, None)
+        self.assertEqual(set(Rule.objects.values_list('name', flat=True)),
+            set(['Generated daily', 'Generated hourly']))
+
+    def test_seed(self):
+        def rows():
+            return list(Event.objects.order_by('id').values_list('title', 'start', 'end', 'end_recurring_period'))
+        self.generate()
+        first = rows()
+        Calendar.objects.all().delete()
+        self.generate()
+        self.assertEqual(rows(), first)
+        self.assertRaises(ValueError, self.generate)
+        self.assertRaises(ValueError, self.generate, prefix='other', rule_mix='sometimes:1')
+
+
+class TestDiagnose(TestCase):
+
+    def test_diagnose(self):
+        from schedule.management.commands.schedule_diagnose import Diagnosis
+        from schedule.management.commands.schedule_generate_data import Generator
+        Generator(calendars=1, events=5, rule_mix='hourly:1', override_ratio=0.01,
+            open_ended=1, days=10, prefix='dense').run()
+        Generator(calendars=1, events=5, rule_mix='once:1', days=10, prefix='sparse').run()
+        start, end = datetime.datetime(2009, 1, 1), datetime.datetime(2009, 2, 1)
+        dense, sparse = Diagnosis(start, end).run()
+        self.assertEqual(dense['calendar'].slug, 'dense-0')
+        self.assertEqual((dense['events'], dense['open_ended'], dense['sub_daily']), (5, 5, 5))
+        self.assertEqual(dense['sub_daily_rules'], ['Generated hourly'])
+        self.assertEqual(dense['overrides'], Occurrence.objects.filter(
+            event__calendar=dense['calendar']).count())
+        self.assertTrue(dense['overrides'] > 0)
+        # 721 hourly occurrences in 30 days for each of the 5 events
+        self.assertEqual(dense['estimated'], 5 * 721)
+        self.assertEqual(dense['rrule_expansions'], 5)
+        self.assertTrue(dense['occurrences'] > 5 * 500)
+        self.assertEqual((sparse['events'], sparse['open_ended'], sparse['sub_daily'],
+            sparse['overrides'], sparse['estimated'], sparse['occurrences']), (5, 0, 0, 0, 5, 5))
+        self.assertEqual([report['calendar'].slug for report in Diagnosis(start, end,
+            calendars=['sparse-0'], measure=False).run()], ['sparse-0'])
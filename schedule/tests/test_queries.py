@@ -0,0 +1,100 @@
+import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+
+from schedule.management.commands.schedule_generate_data import Generator
+from schedule.models import Calendar, Occurrence
+from schedule.templatetags import scheduletags
+
+# the sizes of the calendars the views are rendered for, in events
+SIZES = (4, 16, 64)
+
+DATE = {'year': 2009, 'month': 1, 'day': 14}
+
+def schedule_urls(calendar, event, occurrence):
+    """
+    The urls of schedule/urls.py that depend on the size of a calendar, for
+    ``calendar``, one of its recurring events and one of its persisted
+    occurrences.
+    """
+    query = '?year=%(year)d&month=%(month)d&day=%(day)d' % DATE
+    urls = [reverse('calendar_home', kwargs={'calendar_slug': calendar.slug})]
+    for name in ('year_calendar', 'tri_month_calendar', 'compact_calendar',
+        'month_calendar', 'week_calendar', 'day_calendar'):
+        urls.append(reverse(name, kwargs={'calendar_slug': calendar.slug}) + query)
+    urls += [
+        reverse('multi_month_calendar', kwargs={'calendar_slugs': calendar.slug}) + query,
+        reverse('event', kwargs={'event_id': event.pk}),
+        reverse('occurrence', kwargs={'event_id': event.pk,
+            'occurrence_id': occurrence.pk}),
+        reverse('occurrence_by_date', kwargs={'event_id': event.pk,
+            'year': event.start.year, 'month': event.start.month,
+            'day': event.start.day, 'hour': event.start.hour,
+            'minute': event.start.minute, 'second': event.start.second}),
+        reverse('occurrences_api', kwargs={'calendar_slug': calendar.slug}) +
+            '?start=2009-01-01&end=2009-02-01',
+        reverse('free_busy') + '?calendar=%s&start=2009-01-01&end=2009-02-01' % calendar.slug,
+        '/schedule/feed/calendar/upcoming/%s/' % calendar.pk,
+        '/schedule/ical/calendar/%s/' % calendar.pk,
+    ]
+    return urls
+
+
+class TestQueryCounts(TestCase):
+    """
+    Renders the views of every calendar size and fails when the number of
+    queries of a view grows with the number of events, like it does when
+    a template or a period loads something once per event or occurrence.
+    """
+
+    def setUp(self):
+        self.debug = settings.DEBUG
+        # every view is rendered in full, not from the fragment cache
+        self.fragment_cache_timeout = scheduletags.FRAGMENT_CACHE_TIMEOUT
+        scheduletags.FRAGMENT_CACHE_TIMEOUT = 0
+        user = User(username='alice', is_staff=True, is_superuser=True)
+        user.set_password('password')
+        user.save()
+        self.calendars = []
+        for size in SIZES:
+            Generator(calendars=1, events=size, rule_mix='once:1,daily:1,weekdays:1,weekly:1,monthly:1',
+                override_ratio=0.1, seed=size, start=datetime.datetime(2009, 1, 1),
+                days=28, open_ended=0.5, prefix='size%d' % size).run()
+            calendar = Calendar.objects.get(slug='size%d-0' % size)
+            occurrence = Occurrence.objects.filter(event__calendar=calendar
+                ).select_related('event').order_by('id')[0]
+            self.calendars.append((calendar, occurrence.event, occurrence))
+
+    def tearDown(self):
+        scheduletags.FRAGMENT_CACHE_TIMEOUT = self.fragment_cache_timeout
+        settings.DEBUG = self.debug
+
+    def count_queries(self, url):
+        settings.DEBUG = True
+        connection.queries = []
+        response = self.client.get(url)
+        # the feeds are streamed, and query as they are read
+        response.content
+        self.assertEqual(response.status_code, 200, url)
+        return len(connection.queries)
+
+    def assertConstantQueries(self):
+        counts = {}
+        for calendar, event, occurrence in self.calendars:
+            for i, url in enumerate(schedule_urls(calendar, event, occurrence)):
+                counts.setdefault(i, []).append((url, self.count_queries(url)))
+        growing = ['\n    ' + ', '.join(['%s: %d' % run for run in runs])
+            for i, runs in sorted(counts.items())
+            if len(set([count for url, count in runs])) > 1]
+        self.assertFalse(growing, "the queries grow with the events:%s" % ''.join(growing))
+
+    def test_anonymous(self):
+        self.assertConstantQueries()
+
+    def test_authenticated(self):
+        self.assertTrue(self.client.login(username='alice', password='password'))
+        self.assertConstantQueries()
@@ -1,7 +1,15 @@
 import datetime
 
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection
+from django.core.cache import cache
+from django.template import Context, Template
 from django.test import TestCase
 
+from schedule.models import Calendar, Event
+from schedule.periods import Month
+from schedule.templatetags import scheduletags
 from schedule.templatetags.scheduletags import querystring_for_date
 
 class TestTemplateTags(TestCase):
@@ -10,4 +18,141 @@ class TestTemplateTags(TestCase):
         date = datetime.datetime(2008,1,1,0,0,0)
         query_string=querystring_for_date(date)
         self.assertEqual("?year=2008&month=1&day=1&hour=0&minute=0&second=0",
-            query_string)
\ No newline at end of file
+            query_string)
+
+
+class FakeRequest(object):
+    user = AnonymousUser()
+
+
+class TestFragmentCache(TestCase):
+
+    def setUp(self):
+        self.calendar = Calendar.objects.create(name="Fragments", slug="fragments")
+        self.template = Template('{% load scheduletags %}{% month_table calendar month "small" %}')
+
+    def render(self):
+        calendar = Calendar.objects.get(pk=self.calendar.pk)
+        month = Month(calendar.event_set.all(), datetime.datetime(2008, 2, 7))
+        return self.template.render(Context({
+            'calendar': calendar,
+            'month': month,
+            'request': FakeRequest(),
+        }))
+
+    def add_event(self):
+        Event.objects.create(title="Fragment event", calendar=self.calendar,
+            start=datetime.datetime(2008, 2, 14, 8, 0),
+            end=datetime.datetime(2008, 2, 14, 9, 0))
+
+    def test_month_table_is_cached(self):
+        first = self.render()
+        key = scheduletags.month_table_cache_key(Context({'request': FakeRequest()}),
+            Calendar.objects.get(pk=self.calendar.pk),
+            Month([], datetime.datetime(2008, 2, 7)), "small")
+        self.assertEqual(cache.get(key), first)
+        self.assertEqual(self.render(), first)
+
+    def test_not_cached_when_not_shared(self):
+        key = scheduletags.month_table_cache_key(Context({'request': FakeRequest()}),
+            self.calendar, Month([], datetime.datetime(2008, 2, 7)), "small")
+        cache.delete(key)
+        scheduletags.FRAGMENT_CACHE_SHARED = False
+        try:
+            self.assertTrue("daynumber" in self.render())
+        finally:
+            scheduletags.FRAGMENT_CACHE_SHARED = True
+        self.assertEqual(cache.get(key), None)
+
+    def test_change_to_calendar_invalidates(self):
+        first = self.render()
+        self.assertFalse("daynumber busy" in first)
+        self.add_event()
+        self.assertTrue("daynumber busy" in self.render())
+
+    def test_not_cached_without_request(self):
+        calendar = Calendar.objects.get(pk=self.calendar.pk)
+        month = Month(calendar.event_set.all(), datetime.datetime(2008, 2, 7))
+        key = scheduletags.month_table_cache_key(Context({'request': FakeRequest()}),
+            calendar, month, "small")
+        cache.delete(key)
+        output = self.template.render(Context({'calendar': calendar, 'month': month}))
+        self.assertTrue("daynumber" in output)
+        self.assertEqual(cache.get(key), None)
+
+    def test_key_depends_on_permission_class_and_size(self):
+        class User(object):
+            def __init__(self, authenticated):
+                self.authenticated = authenticated
+            def is_authenticated(self):
+                return self.authenticated
+        class Request(object):
+            def __init__(self, user):
+                self.user = user
+        month = Month([], datetime.datetime(2008, 2, 7))
+        anonymous = Context({'request': Request(User(False))})
+        authenticated = Context({'request': Request(User(True))})
+        keys = set([
+            scheduletags.month_table_cache_key(anonymous, self.calendar, month, "small"),
+            scheduletags.month_table_cache_key(authenticated, self.calendar, month, "small"),
+            scheduletags.month_table_cache_key(anonymous, self.calendar, month, "regular"),
+            scheduletags.month_table_cache_key(anonymous, self.calendar, month, "small", -1),
+            scheduletags.month_table_cache_key(anonymous, self.calendar, month.next(), "small"),
+        ])
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(scheduletags.month_table_cache_key(Context(), self.calendar, month), None)
+
+
+class TestCalendarsForObjects(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username="user%d" % i) for i in range(4)]
+        self.calendars = []
+        for user in self.users[:3]:
+            calendar = Calendar.objects.create(name=user.username, slug=user.username)
+            calendar.create_relation(user, 'owner')
+            self.calendars.append(calendar)
+        self.calendars[0].create_relation(self.users[1], 'viewer')
+
+    def count_queries(self, func):
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            result = func()
+            return result, len(connection.queries)
+        finally:
+            settings.DEBUG = False
+
+    def test_get_calendars_for_objects(self):
+        calendars, queries = self.count_queries(
+            lambda: Calendar.objects.get_calendars_for_objects(self.users))
+        self.assertEqual(queries, 1)
+        self.assertEqual(calendars, {
+            self.users[0]: [self.calendars[0]],
+            self.users[1]: [self.calendars[0], self.calendars[1]],
+            self.users[2]: [self.calendars[2]],
+            self.users[3]: [],
+        })
+        # the users of a queryset are not loaded, only their ids
+        calendars, queries = self.count_queries(lambda: Calendar.objects.get_calendars_for_objects(
+            User.objects.all(), 'owner'))
+        self.assertEqual(calendars[self.users[1].pk], [self.calendars[1]])
+        self.assertEqual(sorted(calendars), sorted([user.pk for user in self.users]))
+        self.assertFalse([query for query in connection.queries if '"auth_user"."username"' in query['sql']])
+
+    def test_prefetch_calendars(self):
+        template = Template('{% load scheduletags %}{% prefetch_calendars users by owner %}'
+            '{% for user in users %}{% get_calendar user owner as calendar %}'
+            '{{ calendar.slug }} {% endfor %}')
+        context = Context({'users': self.users[:3], 'request': FakeRequest()})
+        output, queries = self.count_queries(lambda: template.render(context))
+        self.assertEqual(output, 'user0 user1 user2 ')
+        self.assertEqual(queries, 1)
+
+    def test_get_calendar_is_cached(self):
+        template = Template('{% load scheduletags %}{% get_calendar user as calendar %}'
+            '{% get_calendar user as calendar %}{{ calendar.slug }}')
+        context = Context({'user': self.users[0], 'request': FakeRequest()})
+        output, queries = self.count_queries(lambda: template.render(context))
+        self.assertEqual(output, 'user0')
+        self.assertEqual(queries, 1)
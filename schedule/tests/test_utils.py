@@ -1,12 +1,18 @@
 import datetime
+import logging
 import os
 
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, set_script_prefix
 
 from schedule.models import Event, Rule, Occurrence, Calendar
 from schedule.periods import Period, Month, Day
-from schedule.utils import EventListManager
+from django.contrib.auth.models import AnonymousUser, User
+
+from schedule import instrumentation, utils
+from schedule.utils import EventListManager, URLBuilder, attach_occurrence_options
 
 class TestEventListManager(TestCase):
     def setUp(self):
@@ -48,3 +54,256 @@ class TestEventListManager(TestCase):
         self.assertEqual(occurrences.next().event, self.event2)
         self.assertEqual(occurrences.next().event, self.event2)
         self.assertEqual(occurrences.next().event, self.event1)
+
+
+class TestAttachOccurrenceOptions(TestCase):
+
+    def setUp(self):
+        calendar = Calendar(name="Options", slug="options")
+        calendar.save()
+        daily = Rule(frequency="DAILY", name="daily")
+        daily.save()
+        self.events = []
+        for title in ("First", "Second"):
+            event = Event(calendar=calendar, title=title, rule=daily,
+                start=datetime.datetime(2008, 1, 1, 9, 0),
+                end=datetime.datetime(2008, 1, 1, 10, 0))
+            event.save()
+            self.events.append(Event.objects.get(pk=event.pk))
+        self.occurrences = []
+        for event in self.events:
+            self.occurrences += event.get_occurrences(datetime.datetime(2008, 1, 1),
+                datetime.datetime(2008, 1, 11))
+        self.occurrences[0].save()
+        self.user = User.objects.create_user('options', 'options@example.com', 'options')
+        self.checked = []
+        self.check_permission = utils.CHECK_PERMISSION_FUNC
+        def check_permission(event, user):
+            self.checked.append(event.pk)
+            return user.is_authenticated()
+        utils.CHECK_PERMISSION_FUNC = check_permission
+
+    def tearDown(self):
+        utils.CHECK_PERMISSION_FUNC = self.check_permission
+
+    def test_urls(self):
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            attach_occurrence_options(self.occurrences, self.user)
+            queries = len(connection.queries)
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(sorted(self.checked), [e.pk for e in self.events])
+        # the slug of the calendar, the events were loaded with the occurrences
+        self.assertEqual(queries, 1)
+        for occurrence in self.occurrences:
+            event = occurrence.event
+            self.assertEqual(occurrence.options, {
+                'view_occurrence': occurrence.get_absolute_url(),
+                'edit_occurrence': occurrence.get_edit_url(),
+                'cancel_occurrence': occurrence.get_cancel_url(),
+                'delete_event': reverse('delete_event', args=(event.id,)),
+                'edit_event': reverse('edit_event', args=(event.calendar.slug, event.id,)),
+            })
+
+    def test_not_allowed(self):
+        attach_occurrence_options(self.occurrences, AnonymousUser())
+        for occurrence in self.occurrences:
+            self.assertEqual(occurrence.options, {
+                'view_occurrence': occurrence.get_absolute_url(),
+                'edit_event': '',
+                'delete_event': '',
+            })
+
+    def test_cache(self):
+        cache = {}
+        attach_occurrence_options(self.occurrences, self.user, cache)
+        attach_occurrence_options(self.occurrences, self.user, cache)
+        self.assertEqual(len(self.checked), 2)
+
+
+class TestURLBuilder(TestCase):
+
+    def setUp(self):
+        calendar = Calendar(name="Urls", slug="urls")
+        calendar.save()
+        self.event = Event(calendar=calendar, title="Urls",
+            start=datetime.datetime(2008, 1, 5, 8, 0, 5),
+            end=datetime.datetime(2008, 1, 5, 9, 0))
+        self.event.save()
+
+    def date_kwargs(self, occurrence):
+        return {'event_id': self.event.id, 'year': occurrence.start.year,
+            'month': occurrence.start.month, 'day': occurrence.start.day,
+            'hour': occurrence.start.hour, 'minute': occurrence.start.minute,
+            'second': occurrence.start.second}
+
+    def test_unpersisted_occurrence(self):
+        occurrence = self.event.get_occurrences(datetime.datetime(2008, 1, 1),
+            datetime.datetime(2008, 2, 1))[0]
+        kwargs = self.date_kwargs(occurrence)
+        self.assertEqual(occurrence.get_absolute_url(), reverse('occurrence_by_date', kwargs=kwargs))
+        self.assertEqual(occurrence.get_edit_url(), reverse('edit_occurrence_by_date', kwargs=kwargs))
+        self.assertEqual(occurrence.get_cancel_url(), reverse('cancel_occurrence_by_date', kwargs=kwargs))
+
+    def test_persisted_occurrence(self):
+        occurrence = self.event.get_occurrences(datetime.datetime(2008, 1, 1),
+            datetime.datetime(2008, 2, 1))[0]
+        occurrence.save()
+        kwargs = {'event_id': self.event.id, 'occurrence_id': occurrence.id}
+        self.assertEqual(occurrence.get_absolute_url(), reverse('occurrence', kwargs=kwargs))
+        self.assertEqual(occurrence.get_edit_url(), reverse('edit_occurrence', kwargs=kwargs))
+        self.assertEqual(occurrence.get_cancel_url(), reverse('cancel_occurrence', kwargs=kwargs))
+
+    def test_quoted_values(self):
+        edit_event = URLBuilder('edit_event', ['calendar_slug', 'event_id'])
+        for slug in ('urls', u'caf\xe9', '10'):
+            kwargs = {'calendar_slug': slug, 'event_id': 3}
+            self.assertEqual(edit_event(**kwargs), reverse('edit_event', kwargs=kwargs))
+
+    def test_script_prefix(self):
+        occurrence_url = URLBuilder('occurrence', ['event_id', 'occurrence_id'])
+        set_script_prefix('/prefix/')
+        try:
+            self.assertEqual(occurrence_url(event_id=1, occurrence_id=2),
+                reverse('occurrence', kwargs={'event_id': 1, 'occurrence_id': 2}))
+        finally:
+            set_script_prefix('/')
+        self.assertEqual(occurrence_url(event_id=1, occurrence_id=2),
+            reverse('occurrence', kwargs={'event_id': 1, 'occurrence_id': 2}))
+
+
+class TestBenchmarks(TestCase):
+
+    def test_run_benchmark(self):
+        from schedule.benchmarks import run_benchmark
+        results = run_benchmark('rule_params', 10)
+        self.assertEqual([r['label'] for r in results],
+            ['daily', 'weekdays', 'monthly', 'hourly', 'many params'])
+        for result in results:
+            self.assertEqual((result['benchmark'], result['size'], result['count']),
+                ('rule_params', 10, 10))
+
+    def test_compare_results(self):
+        from schedule.benchmarks import compare_results
+        def result(label, us):
+            return {'benchmark': 'b', 'size': 10, 'label': label, 'seconds': us,
+                'count': 1, 'us_per_item': us}
+        baseline = [result('same', 10.0), result('slower', 10.0)]
+        comparison = compare_results([result('same', 11.0), result('slower', 13.0),
+            result('new', 1.0)], baseline, 0.2)
+        self.assertEqual([(c[0]['label'], c[1], c[3]) for c in comparison],
+            [('same', 10.0, False), ('slower', 10.0, True), ('new', None, False)])
+        self.assertAlmostEqual(comparison[1][2], 1.3)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        daily = Rule(frequency = "DAILY")
+        daily.save()
+        cal = Calendar(name="MyCal")
+        cal.save()
+        self.event = Event(title='Daily', start=datetime.datetime(2009, 4, 1, 8, 0),
+            end=datetime.datetime(2009, 4, 1, 9, 0), rule=daily, calendar=cal)
+        self.event.save()
+        occurrence = self.event.get_occurrence(datetime.datetime(2009, 4, 2, 8, 0))
+        occurrence.move(occurrence.start + datetime.timedelta(hours=1),
+            occurrence.end + datetime.timedelta(hours=1))
+
+    def test_disabled(self):
+        self.assertEqual(instrumentation.current_collector(), None)
+        self.assertEqual(instrumentation.start_timer(), None)
+        instrumentation.count('periods')
+        instrumentation.stop_timer('expansion', None)
+
+    def test_collect(self):
+        outer = instrumentation.start_collecting()
+        collector = instrumentation.start_collecting()
+        try:
+            day = Day(Event.objects.all(), datetime.datetime(2009, 4, 2))
+            self.assertEqual(len(day.get_occurrence_partials()), 1)
+        finally:
+            instrumentation.stop_collecting(collector)
+        self.assertEqual(instrumentation.current_collector(), outer)
+        instrumentation.stop_collecting(outer)
+        self.assertEqual(instrumentation.current_collector(), None)
+        self.assertEqual(collector.counts, {'periods': 1, 'persisted_lookups': 1,
+            'persisted_occurrences': 1, 'rrule_expansions': 1,
+            'occurrences_generated': 1, 'replacer_hits': 1, 'classifications': 1})
+        self.assertEqual(outer.counts, {})
+        self.assertEqual(sorted(collector.as_dict()['timings']),
+            ['events', 'expansion', 'persisted'])
+
+    def test_middleware(self):
+        from django.http import HttpRequest, HttpResponse
+        received = []
+        def receiver(sender, request, collector, **kwargs):
+            received.append(collector)
+        instrumentation.request_instrumented.connect(receiver)
+        try:
+            middleware = instrumentation.InstrumentationMiddleware()
+            request = HttpRequest()
+            middleware.process_request(request)
+            self.event.occurrences_after(datetime.datetime(2009, 4, 1)).next()
+            response = HttpResponse()
+            self.assertTrue(middleware.process_response(request, response) is response)
+        finally:
+            instrumentation.request_instrumented.disconnect(receiver)
+        self.assertEqual(instrumentation.current_collector(), None)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].counts['rrule_expansions'], 1)
+
+    def test_middleware_drops_stale_collectors(self):
+        from django.http import HttpRequest
+        middleware = instrumentation.InstrumentationMiddleware()
+        # left over by a request that never reached process_response
+        instrumentation.start_collecting()
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertEqual(request._schedule_collector.parent, None)
+        self.assertEqual(middleware.process_exception(request, ValueError()), None)
+        self.assertEqual(instrumentation.current_collector(), None)
+
+    def test_server_timing(self):
+        from django.http import HttpRequest, HttpResponse
+        from schedule.instrumentation import ServerTimingMiddleware
+        middleware = ServerTimingMiddleware()
+        request = HttpRequest()
+        request.path = '/schedule/calendar/month/mycal/'
+        middleware.process_request(request)
+        Day(Event.objects.all(), datetime.datetime(2009, 4, 2)).get_occurrences()
+        collector = request._schedule_collector
+        response = middleware.process_response(request, HttpResponse())
+        metrics = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        self.assertEqual(metrics, ['events', 'expansion', 'persisted', 'layout', 'render', 'total'])
+
+        # a request that does not touch the schedule gets no header
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertFalse(middleware.process_response(request, HttpResponse()).has_header('Server-Timing'))
+
+        # a request that expands for longer than the threshold is flagged
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = Handler()
+        instrumentation.logger.addHandler(handler)
+        try:
+            request = HttpRequest()
+            request.path = '/schedule/calendar/month/mycal/'
+            middleware.process_request(request)
+            instrumentation.count('rrule_expansions', 12)
+            instrumentation.current_collector().add_time('expansion', 10.0)
+            response = middleware.process_response(request, HttpResponse())
+        finally:
+            instrumentation.logger.removeHandler(handler)
+        self.assertTrue(response['Server-Timing'].endswith(
+            ', slow-expansion;desc="12 rrule expansions"'))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].levelno, logging.WARNING)
+        line = records[0].getMessage()
+        self.assertTrue(line.startswith('path=/schedule/calendar/month/mycal/ status=200 events_ms=0.0 expansion_ms=10000.0 '))
+        self.assertTrue(line.endswith(' rrule_expansions=12 slow_expansion=1'))
@@ -1,11 +1,16 @@
 import os, datetime
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.test import Client
+from django.utils import simplejson
 
+from schedule.models import Calendar, Event, Rule
 from schedule.views import check_next_url, coerce_date_dict
-from schedule.templatetags.scheduletags import querystring_for_date
+from schedule.templatetags.scheduletags import calendar_colour, querystring_for_date
 
 class TestViewUtils(TestCase):
 
@@ -120,3 +125,219 @@ class TestUrls(TestCase):
         self.assertEqual(self.response.status_code, 404)
         c.logout()
 
+
+
+class TestConditionalViews(TestCase):
+
+    def setUp(self):
+        self.calendar = Calendar(name="Conditional", slug="conditional")
+        self.calendar.save()
+        self.event = Event(calendar=self.calendar, title="Event",
+            start=datetime.datetime(2008, 1, 5, 8, 0),
+            end=datetime.datetime(2008, 1, 5, 9, 0))
+        self.event.save()
+
+    def get(self, url, response=None):
+        headers = {}
+        if response is not None:
+            headers = {'HTTP_IF_NONE_MATCH': response['ETag'],
+                       'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}
+        return c.get(url, {'year': 2008, 'month': 1}, **headers)
+
+    def test_calendar_version_bumps(self):
+        version = Calendar.objects.get_version(pk=self.calendar.pk)
+        self.event.title = "Renamed"
+        self.event.save()
+        self.assertTrue(Calendar.objects.get_version(pk=self.calendar.pk)[0] > version[0])
+        version = Calendar.objects.get_version(pk=self.calendar.pk)
+        self.event.get_occurrence(self.event.start).cancel()
+        self.assertTrue(Calendar.objects.get_version(pk=self.calendar.pk)[0] > version[0])
+
+    def test_moved_event_bumps_both_calendars(self):
+        other = Calendar.objects.create(name="Other", slug="other")
+        versions = [Calendar.objects.get_version(pk=pk)[0] for pk in (self.calendar.pk, other.pk)]
+        event = Event.objects.get(pk=self.event.pk)
+        event.calendar = other
+        event.save()
+        self.assertEqual([Calendar.objects.get_version(pk=pk)[0] for pk in (self.calendar.pk, other.pk)],
+            [version + 1 for version in versions])
+        # the calendar is only read back when it changed
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            event.title = "Renamed"
+            event.save()
+            queries = [query['sql'] for query in connection.queries]
+        finally:
+            settings.DEBUG = debug
+        self.assertFalse([sql for sql in queries if 'SELECT "schedule_event"."calendar_id"' in sql])
+        self.assertEqual(Calendar.objects.get_version(pk=other.pk)[0], versions[1] + 2)
+
+    def test_month_not_modified(self):
+        url = reverse("month_calendar", kwargs={"calendar_slug": 'conditional'})
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(url, response).status_code, 304)
+        self.event.title = "Renamed"
+        self.event.save()
+        self.assertEqual(self.get(url, response).status_code, 200)
+
+    def test_ical_not_modified(self):
+        url = '/schedule/ical/calendar/%s/' % self.calendar.pk
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(url, response).status_code, 304)
+        Event(calendar=self.calendar, title="Another Event",
+            start=datetime.datetime(2008, 1, 6, 8, 0),
+            end=datetime.datetime(2008, 1, 6, 9, 0)).save()
+        self.assertEqual(self.get(url, response).status_code, 200)
+
+
+class TestOccurrencesApi(TestCase):
+
+    def setUp(self):
+        self.calendar = Calendar(name="Api", slug="api")
+        self.calendar.save()
+        rule = Rule(frequency="DAILY", name="daily")
+        rule.save()
+        self.event = Event(calendar=self.calendar, title="Standup", rule=rule,
+            start=datetime.datetime(2008, 1, 1, 9, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 15),
+            end_recurring_period=datetime.datetime(2008, 2, 1))
+        self.event.save()
+        self.url = reverse("occurrences_api", kwargs={"calendar_slug": "api"})
+
+    def get(self, start, end):
+        return c.get(self.url, {'start': start, 'end': end})
+
+    def test_occurrences(self):
+        occ = self.event.get_occurrence(datetime.datetime(2008, 1, 3, 9, 0))
+        occ.cancel()
+        moved = self.event.get_occurrence(datetime.datetime(2008, 1, 4, 9, 0))
+        moved.move(datetime.datetime(2008, 1, 4, 10, 0),
+            datetime.datetime(2008, 1, 4, 10, 15))
+        response = self.get('2008-01-02', '2008-01-05')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = simplejson.loads(response.content)['occurrences']
+        self.assertEqual([o['start'] for o in data], ['2008-01-02T09:00:00',
+            '2008-01-03T09:00:00', '2008-01-04T10:00:00'])
+        self.assertEqual([o['cancelled'] for o in data], [False, True, False])
+        self.assertEqual(data[0]['id'], None)
+        self.assertEqual(data[1]['id'], occ.id)
+        self.assertEqual(data[2]['id'], moved.id)
+        self.assertEqual(data[0]['event'], self.event.id)
+        self.assertEqual(data[0]['title'], "Standup")
+
+    def test_bad_window(self):
+        self.assertEqual(self.get('2008-01-05', '2008-01-02').status_code, 404)
+        self.assertEqual(self.get('2008-01-01', '2010-01-01').status_code, 404)
+        self.assertEqual(self.get('yesterday', '2008-01-02').status_code, 404)
+
+class TestCalendarsByPeriods(TestCase):
+
+    def setUp(self):
+        self.work = Calendar(name="Work", slug="work")
+        self.work.save()
+        self.home = Calendar(name="Home", slug="home")
+        self.home.save()
+        rule = Rule(frequency="WEEKLY", name="weekly")
+        rule.save()
+        Event(calendar=self.work, title="Standup", rule=rule,
+            start=datetime.datetime(2008, 1, 7, 9, 0),
+            end=datetime.datetime(2008, 1, 7, 9, 15),
+            end_recurring_period=datetime.datetime(2008, 2, 1)).save()
+        Event(calendar=self.home, title="Dinner",
+            start=datetime.datetime(2008, 1, 10, 19, 0),
+            end=datetime.datetime(2008, 1, 10, 21, 0)).save()
+
+    def get_month(self, response):
+        month = response.context[0]['periods']['month']
+        return [(o.title, o.calendar.slug, o.calendar_index)
+            for o in month.get_occurrences()]
+
+    def test_merged_month(self):
+        url = reverse("multi_month_calendar", kwargs={"calendar_slugs": "home+work"})
+        response = c.get(url, {'year': 2008, 'month': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context[0]['calendars']), [self.home, self.work])
+        self.assertEqual(self.get_month(response), [
+            ("Standup", "work", 1),
+            ("Dinner", "home", 0),
+            ("Standup", "work", 1),
+            ("Standup", "work", 1),
+            ("Standup", "work", 1),
+        ])
+        self.assertTrue('calendar1' in response.content)
+        # the cells come from day_cell
+        self.assertTrue('daynumber busy' in response.content)
+
+    def test_calendar_colours_cycle(self):
+        self.assertEqual([calendar_colour(index) for index in (0, 5, 6, 13, '')],
+            ['calendar0', 'calendar5', 'calendar0', 'calendar1', ''])
+
+    def test_calendars_from_query(self):
+        url = reverse("multi_month_calendar_query")
+        response = c.get(url, {'calendar': ['work'], 'year': 2008, 'month': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([title for title, slug, index in self.get_month(response)],
+            ["Standup"] * 4)
+
+    def test_unknown_calendars(self):
+        url = reverse("multi_month_calendar", kwargs={"calendar_slugs": "nope"})
+        self.assertEqual(c.get(url).status_code, 404)
+        self.assertEqual(c.get(reverse("multi_month_calendar_query")).status_code, 404)
+
+class TestEventRequestCache(TestCase):
+
+    def setUp(self):
+        User.objects.create_user('editor', 'editor@example.com', 'editor')
+        self.client = Client()
+        self.client.login(username='editor', password='editor')
+        calendar = Calendar(name="Cache", slug="cache")
+        calendar.save()
+        rule = Rule(frequency="DAILY", name="daily")
+        rule.save()
+        self.event = Event(calendar=calendar, title="Standup", rule=rule,
+            description="Daily", start=datetime.datetime(2008, 1, 1, 9, 0),
+            end=datetime.datetime(2008, 1, 1, 9, 15),
+            end_recurring_period=datetime.datetime(2008, 2, 1))
+        self.event.save()
+        self.date_kwargs = {'event_id': self.event.id, 'year': 2008,
+            'month': 1, 'day': 3, 'hour': 9, 'minute': 0, 'second': 0}
+
+    def count_event_queries(self, url):
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            response = self.client.get(url)
+            return response, len([q for q in connection.queries
+                if 'FROM "schedule_event"' in q['sql']])
+        finally:
+            settings.DEBUG = False
+
+    def test_event_loaded_once(self):
+        for name in ('edit_occurrence_by_date', 'cancel_occurrence_by_date'):
+            response, count = self.count_event_queries(
+                reverse(name, kwargs=self.date_kwargs))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(count, 1)
+        response, count = self.count_event_queries(
+            reverse('edit_event', args=['cache', self.event.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count, 1)
+
+    def test_persisted_occurrence(self):
+        occurrence = self.event.get_occurrence(datetime.datetime(2008, 1, 3, 9, 0))
+        occurrence.save()
+        response, count = self.count_event_queries(reverse('edit_occurrence',
+            kwargs={'event_id': self.event.id, 'occurrence_id': occurrence.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count, 1)
+        other = Event(calendar=self.event.calendar, title="Other",
+            start=self.event.start, end=self.event.end)
+        other.save()
+        response = self.client.get(reverse('edit_occurrence',
+            kwargs={'event_id': other.id, 'occurrence_id': occurrence.id}))
+        self.assertEqual(response.status_code, 404)
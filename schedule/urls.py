@@ -52,6 +52,21 @@ url(r'^calendar/(?P<calendar_slug>[-\w]+)/$',
     name = "calendar_home",
     ),
 
+url(r'^calendars/month/$',
+    'schedule.views.calendars_by_periods',
+    name = "multi_month_calendar_query",
+    kwargs={'periods': [Month], 'template_name': 'schedule/calendars_month.html'}),
+
+url(r'^calendars/month/for/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
+    'schedule.views.calendars_by_periods',
+    name = "object_month_calendar",
+    kwargs={'periods': [Month], 'template_name': 'schedule/calendars_month.html'}),
+
+url(r'^calendars/month/(?P<calendar_slugs>[-\w]+(?:\+[-\w]+)*)/$',
+    'schedule.views.calendars_by_periods',
+    name = "multi_month_calendar",
+    kwargs={'periods': [Month], 'template_name': 'schedule/calendars_month.html'}),
+
 #Event Urls
 url(r'^event/create/(?P<calendar_slug>[-\w]+)/$',
     'schedule.views.create_or_edit_event',
@@ -88,10 +103,20 @@ url(r'^occurrence/edit/(?P<event_id>\d+)/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d
     'schedule.views.edit_occurrence', 
     name="edit_occurrence_by_date"),
     
+url(r'^freebusy/$',
+    'schedule.views.free_busy',
+    name="free_busy"),
+url(r'^freebusy/slots/$',
+    'schedule.views.next_available_slots',
+    name="next_available_slots"),
+
+url(r'^api/calendar/(?P<calendar_slug>[-\w]+)/occurrences/$',
+    'schedule.views.occurrences_api',
+    name="occurrences_api"),
 
 #feed urls 
 url(r'^feed/calendar/(.*)/$',
-    'django.contrib.syndication.views.feed', 
+    'schedule.feeds.feed', 
     { "feed_dict": { "upcoming": UpcomingEventsFeed } }),
  
 (r'^ical/calendar/(.*)/$', CalendarICalendar()),
@@ -1,9 +1,56 @@
 import datetime
 import heapq
+import time
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import AutoField, Q
+from django.db.models.query import QuerySet
+from django.db.models.sql import DeleteQuery
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.http import HttpResponseRedirect
 from django.conf import settings
+from django.core.urlresolvers import get_script_prefix, reverse
+from django.utils.encoding import force_unicode, iri_to_uri
+from django.utils.hashcompat import md5_constructor
 from schedule.conf.settings import CHECK_PERMISSION_FUNC
+from schedule.instrumentation import count, start_timer, stop_timer
+
+def select_rules(events):
+    """
+    Returns ``events`` with their rules selected, when it is a queryset that
+    does not select related objects yet, so expanding the events does not
+    query every rule.
+    """
+    if isinstance(events, QuerySet) and not events.query.select_related:
+        return events.select_related('rule')
+    return events
+
+def recurring_events_q(events, date):
+    """
+    Returns a Q matching the recurring events of the queryset ``events`` that
+    may have an occurrence ending after ``date``.  An occurrence can start as
+    late as the end_recurring_period of its event and lasts as long as the
+    event, so the series that ended before ``date`` are read, a few columns
+    each, and kept when their last occurrence may run past ``date``.
+    """
+    ended = events.filter(rule__isnull = False, end_recurring_period__lt = date
+        ).values_list('id', 'start', 'end', 'end_recurring_period')
+    running = [pk for pk, start, end, until in ended if until + (end - start) > date]
+    return Q(Q(end_recurring_period__isnull = True) |
+        Q(end_recurring_period__gte = date) | Q(id__in = running),
+        rule__isnull = False)
+
+def read_persisted_occurrences(queryset):
+    """
+    Reads a queryset of persisted occurrences into a list.  The query is
+    counted and timed as a persisted lookup (see schedule.instrumentation).
+    """
+    started = start_timer()
+    occurrences = list(queryset)
+    stop_timer('persisted', started)
+    count('persisted_lookups')
+    count('persisted_occurrences', len(occurrences))
+    return occurrences
 
 class EventListManager(object):
     """
@@ -12,7 +59,7 @@ class EventListManager(object):
     from these events in as a group
     """
     def __init__(self, events):
-        self.events = events
+        self.events = select_rules(events)
 
     def occurrences_after(self, after=None):
         """
@@ -24,8 +71,9 @@ class EventListManager(object):
         from schedule.models import Occurrence
         if after is None:
             after = datetime.datetime.now()
-        occ_replacer = OccurrenceReplacer(
-            Occurrence.objects.filter(event__in = self.events))
+        occ_replacer = OccurrenceReplacer(read_persisted_occurrences(
+            Occurrence.objects.filter(event__in = self.events,
+            original_end__gt = after).select_related('event')))
         generators = [event._occurrences_after_generator(after) for event in self.events]
         occurrences = []
 
@@ -46,6 +94,43 @@ class EventListManager(object):
                 next = heapq.heappop(occurrences)[0]
             yield occ_replacer.get_occurrence(next)
 
+    def get_occurrences(self, start, end):
+        """
+        Returns the occurrences of all the events in ``self.events`` that
+        happen between ``start`` and ``end``, replaced by their persisted
+        counterparts.  Unlike calling ``Event.get_occurrences`` on every
+        event, the persisted occurrences of the whole list are fetched with a
+        single query.
+        """
+        from schedule.models import Occurrence
+        events = list(self.events)
+        persisted_occurrences = read_persisted_occurrences(
+            Occurrence.objects.filter(
+            Q(start__lt = end, end__gte = start) |
+            Q(original_start__lte = end, original_end__gte = start),
+            event__in = self.events))
+        # the events of the list come with their rules, unlike a join
+        events_by_id = dict([(event.pk, event) for event in events])
+        for occurrence in persisted_occurrences:
+            if occurrence.event_id in events_by_id:
+                occurrence.set_event(events_by_id[occurrence.event_id])
+        occ_replacer = OccurrenceReplacer(persisted_occurrences)
+        final_occurrences = []
+        for event in events:
+            for occ in event._get_occurrence_list(start, end):
+                # replace occurrences with their persisted counterparts
+                if occ_replacer.has_occurrence(occ):
+                    p_occ = occ_replacer.get_occurrence(occ)
+                    # ...but only if they are within this period
+                    if p_occ.start < end and p_occ.end >= start:
+                        final_occurrences.append(p_occ)
+                else:
+                    final_occurrences.append(occ)
+        # then add persisted occurrences which originated outside of this
+        # period but now fall within it
+        final_occurrences += occ_replacer.get_additional_occurrences(start, end)
+        return final_occurrences
+
 
 class OccurrenceReplacer(object):
     """
@@ -55,8 +140,9 @@ class OccurrenceReplacer(object):
     the generated ones that are equivalent.  This class makes this easier.
     """
     def __init__(self, persisted_occurrences):
-        lookup = [((occ.event, occ.original_start, occ.original_end), occ) for
-            occ in persisted_occurrences]
+        lookup = []
+        for occ in persisted_occurrences:
+            lookup.append(((occ.event, occ.original_start, occ.original_end), occ))
         self.lookup = dict(lookup)
 
     def get_occurrence(self, occ):
@@ -64,9 +150,12 @@ class OccurrenceReplacer(object):
         Return a persisted occurrences matching the occ and remove it from lookup since it
         has already been matched
         """
-        return self.lookup.pop(
-            (occ.event, occ.original_start, occ.original_end),
-            occ)
+        persisted = self.lookup.pop(
+            (occ.event, occ.original_start, occ.original_end), None)
+        if persisted is None:
+            return occ
+        count('replacer_hits')
+        return persisted
 
     def has_occurrence(self, occ):
         return (occ.event, occ.original_start, occ.original_end) in self.lookup
@@ -78,7 +167,25 @@ class OccurrenceReplacer(object):
         return [occ for key,occ in self.lookup.items() if (occ.start < end and occ.end >= start and not occ.cancelled)]
 
 
+def get_request_cache(request):
+    """
+    Returns a dict that lives as long as ``request``, for the objects that a
+    request would otherwise load more than once, like the event that
+    check_event_permissions loads and the view edits.
+    """
+    try:
+        return request._schedule_cache
+    except AttributeError:
+        request._schedule_cache = {}
+        return request._schedule_cache
+
 class check_event_permissions(object):
+    """
+    Redirects to the login page unless ``CHECK_PERMISSION_FUNC`` allows the
+    user on the event designated by the ``event_id`` keyword argument.  The
+    event is left in the request cache (see ``get_request_cache``) under
+    ``('event', event.pk)`` so the view does not load it again.
+    """
 
     def __init__(self, f):
         self.f = f
@@ -87,16 +194,132 @@ class check_event_permissions(object):
     def __call__(self, request, *args, **kwargs):
         user = request.user
         object_id = kwargs.get('event_id', None)
+        model = self.contenttype.model_class()
         try:
-            obj = self.contenttype.get_object_for_this_type(pk=object_id)
-        except self.contenttype.model_class().DoesNotExist:
+            obj = model._default_manager.select_related('calendar', 'rule').get(pk=object_id)
+        except (model.DoesNotExist, ValueError):
             obj = None
+        else:
+            get_request_cache(request)[('event', obj.pk)] = obj
         allowed = CHECK_PERMISSION_FUNC(obj, user)
         if not allowed:
             return HttpResponseRedirect(settings.LOGIN_URL)
         return self.f(request, *args, **kwargs)
 
 
+class URLBuilder(object):
+    """
+    Builds the urls of a named url pattern without calling ``reverse()`` for
+    each of them.  ``reverse()`` is called once per script prefix and
+    urlconf, with a placeholder for every keyword argument, and the url is
+    then formatted directly.  The values are not checked against the
+    pattern.  When the placeholders cannot be found in the reversed url the
+    builder falls back to ``reverse()``.
+
+    >>> occurrence_url = URLBuilder('occurrence', ['event_id', 'occurrence_id'])
+    >>> occurrence_url(event_id=1, occurrence_id=2)
+    '/schedule/occurrence/1/2/'
+    """
+    def __init__(self, name, kwarg_names):
+        self.name = name
+        self.kwarg_names = kwarg_names
+        self._templates = {}
+
+    def get_template(self):
+        key = (get_script_prefix(), settings.ROOT_URLCONF)
+        if key not in self._templates:
+            placeholders = dict([(name, str(987654300 + i))
+                for i, name in enumerate(self.kwarg_names)])
+            template = reverse(self.name, kwargs=placeholders).replace('%', '%%')
+            for name, placeholder in placeholders.items():
+                if template.count(placeholder) != 1:
+                    template = None
+                    break
+                template = template.replace(placeholder, '%%(%s)s' % name)
+            self._templates[key] = template
+        return self._templates[key]
+
+    def __call__(self, **kwargs):
+        template = self.get_template()
+        if template is None:
+            return reverse(self.name, kwargs=kwargs)
+        for name, value in kwargs.items():
+            if not isinstance(value, (int, long)):
+                kwargs[name] = iri_to_uri(force_unicode(value))
+        return template % kwargs
+
+DATE_KWARGS = ['event_id', 'year', 'month', 'day', 'hour', 'minute', 'second']
+
+OCCURRENCE_URLS = {
+    'view': (URLBuilder('occurrence', ['event_id', 'occurrence_id']),
+        URLBuilder('occurrence_by_date', DATE_KWARGS)),
+    'cancel': (URLBuilder('cancel_occurrence', ['event_id', 'occurrence_id']),
+        URLBuilder('cancel_occurrence_by_date', DATE_KWARGS)),
+    'edit': (URLBuilder('edit_occurrence', ['event_id', 'occurrence_id']),
+        URLBuilder('edit_occurrence_by_date', DATE_KWARGS)),
+}
+EVENT_URLS = {
+    'edit': URLBuilder('edit_event', ['calendar_slug', 'event_id']),
+    'delete': URLBuilder('delete_event', ['event_id']),
+}
+
+def occurrence_url(kind, occurrence):
+    """
+    Returns the url of ``occurrence`` for ``kind``, one of 'view', 'cancel'
+    and 'edit': the url by id of a persisted occurrence or by date.
+    """
+    by_id, by_date = OCCURRENCE_URLS[kind]
+    if occurrence.pk is not None:
+        return by_id(event_id=occurrence.event_id, occurrence_id=occurrence.pk)
+    start = occurrence.start
+    return by_date(event_id=occurrence.event_id, year=start.year,
+        month=start.month, day=start.day, hour=start.hour,
+        minute=start.minute, second=start.second)
+
+def attach_occurrence_options(occurrences, user, cache=None):
+    """
+    Sets ``options`` on every occurrence of ``occurrences`` to a dict with
+    the urls the ``options`` tag shows: ``view_occurrence`` and, when
+    CHECK_PERMISSION_FUNC allows ``user`` on the event, ``edit_occurrence``,
+    ``cancel_occurrence``, ``delete_event`` and ``edit_event`` (the last two
+    are empty otherwise).
+
+    The permission is evaluated once per distinct event, the calendars the
+    edit urls need are loaded with one query and the urls are formatted by
+    URLBuilders.  ``cache``, like the dict of ``get_request_cache``, keeps
+    the permissions and calendars from one call to the next.
+    """
+    from schedule.models import Calendar
+    if cache is None:
+        cache = {}
+    events = {}
+    for occurrence in occurrences:
+        events.setdefault(occurrence.event_id, occurrence.event)
+    allowed = {}
+    for event_id, event in events.items():
+        key = ('event_permission', event_id, getattr(user, 'pk', None))
+        if key not in cache:
+            cache[key] = bool(CHECK_PERMISSION_FUNC(event, user))
+        allowed[event_id] = cache[key]
+    calendar_ids = set([event.calendar_id for event_id, event in events.items()
+        if allowed[event_id] and ('calendar_slug', event.calendar_id) not in cache])
+    if calendar_ids:
+        for pk, slug in Calendar.objects.filter(pk__in=calendar_ids).values_list('pk', 'slug'):
+            cache[('calendar_slug', pk)] = slug
+    for occurrence in occurrences:
+        options = {'view_occurrence': occurrence_url('view', occurrence)}
+        event = events[occurrence.event_id]
+        if allowed[occurrence.event_id]:
+            options['edit_occurrence'] = occurrence_url('edit', occurrence)
+            options['cancel_occurrence'] = occurrence_url('cancel', occurrence)
+            options['delete_event'] = EVENT_URLS['delete'](event_id=event.pk)
+            options['edit_event'] = EVENT_URLS['edit'](event_id=event.pk,
+                calendar_slug=cache[('calendar_slug', event.calendar_id)])
+        else:
+            options['edit_event'] = options['delete_event'] = ''
+        occurrence.options = options
+    return occurrences
+
 def coerce_date_dict(date_dict):
     """
     given a dictionary (presumed to be from request.GET) it returns a tuple
@@ -122,3 +345,94 @@ def coerce_date_dict(date_dict):
             break
     return modified and retVal or {}
 
+
+def coerce_datetime(value):
+    """
+    given a string (presumed to be from request.GET) in one of the forms
+    ``YYYY-MM-DD``, ``YYYY-MM-DDTHH:MM`` or ``YYYY-MM-DDTHH:MM:SS`` it returns
+    the datetime it represents.  A ValueError is raised for anything else.
+    """
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime(*time.strptime(value, format)[:6])
+        except (TypeError, ValueError):
+            pass
+    raise ValueError("%r is not a valid datetime" % (value,))
+
+def make_etag(*parts):
+    """
+    Returns an ETag built from the given parts, typically a calendar version
+    (see CalendarManager.get_version) and whatever else the response depends
+    on.
+    """
+    return md5_constructor('|'.join([unicode(part) for part in parts]).encode('utf-8')).hexdigest()
+
+def bulk_insert(model, objects, batch_size=10000):
+    """
+    Inserts ``objects``, unsaved instances of ``model``, with ``executemany``
+    in batches of ``batch_size`` rows.  ``objects`` can be any iterable, so
+    a generator never has to be held in memory at once.  Unlike ``save()``
+    it sends no signals and does not set the primary keys of the objects, so
+    it is meant for rows nothing else refers to.  Like ``save()`` it commits
+    unless the transaction is managed.  Returns the number of rows inserted.
+    """
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+        ', '.join([qn(f.column) for f in fields]),
+        ', '.join(['%s'] * len(fields)))
+    cursor = connection.cursor()
+    count = 0
+    rows = []
+    for obj in objects:
+        rows.append([f.get_db_prep_save(f.pre_save(obj, True)) for f in fields])
+        if len(rows) >= batch_size:
+            cursor.executemany(sql, rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        cursor.executemany(sql, rows)
+        count += len(rows)
+    transaction.commit_unless_managed()
+    return count
+
+def bulk_delete(queryset):
+    """
+    Deletes the rows of ``queryset`` with a single DELETE statement.  Unlike
+    ``delete()`` it neither loads the rows nor sends signals, and nothing is
+    deleted in cascade, so it is meant for rows nothing else refers to.  The
+    queryset must not join other tables.  Like ``delete()`` it commits
+    unless the transaction is managed.
+    """
+    query = DeleteQuery(queryset.model, connection)
+    try:
+        query.do_query(queryset.model._meta.db_table, queryset.query.where)
+    except EmptyResultSet:
+        return
+    transaction.commit_unless_managed()
+
+def group_content_objects(objects):
+    """
+    Groups ``objects``, a list of model instances or a queryset, by content
+    type.  Returns a list of (content type, ids) tuples.  The ids of a
+    queryset are a ``values_list`` queryset, so they can be iterated or used
+    as a subquery without loading the objects.
+    """
+    if hasattr(objects, 'values_list'):
+        return [(ContentType.objects.get_for_model(objects.model),
+            objects.values_list('pk', flat=True))]
+    groups = {}
+    for obj in objects:
+        groups.setdefault(type(obj), []).append(obj.pk)
+    return [(ContentType.objects.get_for_model(model), ids)
+        for model, ids in groups.items()]
+
+def content_objects_q(groups):
+    """
+    Returns a Q matching the generic relations to the objects of ``groups``,
+    as returned by ``group_content_objects``.
+    """
+    q = Q(pk__in=[])
+    for content_type, ids in groups:
+        q |= Q(content_type=content_type, object_id__in=ids)
+    return q
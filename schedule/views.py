@@ -6,14 +6,23 @@ from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
 from django.views.generic.create_update import delete_object
+from django.utils import simplejson
+from django.utils.translation import get_language
+from django.views.decorators.http import condition
 import datetime
+import operator
+import time
+import vobject
 
 from schedule.conf.settings import GET_EVENTS_FUNC, OCCURRENCE_CANCEL_REDIRECT
 from schedule.forms import EventForm, OccurrenceForm
+from schedule.freebusy import find_free_slots, get_events_for_calendars, get_free_busy
 from schedule.models import *
 from schedule.periods import weekday_names
-from schedule.utils import check_event_permissions, coerce_date_dict
+from schedule.utils import EventListManager, check_event_permissions, coerce_date_dict, coerce_datetime, get_request_cache, make_etag
 
 def calendar(request, calendar_slug, template='schedule/calendar.html'):
     """
@@ -32,6 +41,33 @@ def calendar(request, calendar_slug, template='schedule/calendar.html'):
         "calendar": calendar,
     }, context_instance=RequestContext(request))
 
+def calendar_by_periods_etag(request, calendar_slug, periods=None,
+    template_name="schedule/calendar_by_period.html"):
+    """
+    The ETag of a calendar_by_periods page. The page depends on the calendar,
+    the query string, the user, the language and, when no date is given, on
+    the current day.
+    """
+    stamp = Calendar.objects.get_version(slug=calendar_slug)
+    if stamp is None:
+        return None
+    if request.user.is_authenticated():
+        user = request.user.pk
+    else:
+        user = 'anonymous'
+    return make_etag(stamp[0], stamp[1], request.get_full_path(), user,
+        template_name, get_language(), datetime.date.today())
+
+def calendar_by_periods_last_modified(request, calendar_slug, periods=None,
+    template_name="schedule/calendar_by_period.html"):
+    stamp = Calendar.objects.get_version(slug=calendar_slug)
+    if stamp is None:
+        return None
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    return max(stamp[1], today)
+
+@condition(etag_func=calendar_by_periods_etag,
+    last_modified_func=calendar_by_periods_last_modified)
 def calendar_by_periods(request, calendar_slug, periods=None,
     template_name="schedule/calendar_by_period.html"):
     """
@@ -85,6 +121,79 @@ def calendar_by_periods(request, calendar_slug, periods=None,
             'here':quote(request.get_full_path()),
         },context_instance=RequestContext(request),)
 
+def calendars_by_periods(request, calendar_slugs=None, content_type_id=None,
+    object_id=None, periods=None, template_name="schedule/calendars_month.html"):
+    """
+    This view is like calendar_by_periods, but for a set of calendars at
+    once.  The calendars are either
+
+    * ``calendar_slugs``, separated by ``+`` (or every ``calendar`` GET
+      variable if it is None), or
+    * the calendars related to the object designated by ``content_type_id``
+      and ``object_id``, optionally filtered by the ``distinction`` GET
+      variable (see CalendarManager.get_calendars_for_object).
+
+    The events of all the calendars are loaded with one query, and expanded
+    once over the span of all the periods.  Every period is then cut from
+    that shared pool of occurrences.  Each occurrence is tagged with its
+    ``calendar`` and with ``calendar_index``, the position of its calendar in
+    ``calendars``, so that the template can colour it.
+
+    Context Variables
+
+    ``date``, ``periods`` and ``weekday_names``
+        See calendar_by_periods.
+
+    ``calendars``
+        The list of calendars.
+    """
+    if content_type_id is not None:
+        content_type = get_object_or_404(ContentType, pk=content_type_id)
+        try:
+            obj = content_type.get_object_for_this_type(pk=object_id)
+        except ObjectDoesNotExist:
+            raise Http404
+        calendars = list(Calendar.objects.get_calendars_for_object(obj,
+            request.GET.get('distinction')).order_by('pk'))
+    else:
+        if calendar_slugs is None:
+            slugs = request.GET.getlist('calendar')
+        else:
+            slugs = calendar_slugs.split('+')
+        calendars = list(Calendar.objects.filter(slug__in=slugs))
+        calendars.sort(key=lambda calendar: slugs.index(calendar.slug))
+    if not calendars:
+        raise Http404
+    date = coerce_date_dict(request.GET)
+    if date:
+        try:
+            date = datetime.datetime(**date)
+        except ValueError:
+            raise Http404
+    else:
+        date = datetime.datetime.now()
+    event_list = reduce(operator.or_, [GET_EVENTS_FUNC(request, calendar)
+        for calendar in calendars]).select_related('calendar', 'rule')
+    period_objects = dict([(period.__name__.lower(), period(event_list, date)) for period in periods])
+    start = min([period.start for period in period_objects.values()])
+    end = max([period.end for period in period_objects.values()])
+    calendars_by_id = dict([(calendar.pk, (index, calendar))
+        for index, calendar in enumerate(calendars)])
+    pool = EventListManager(event_list).get_occurrences(start, end)
+    for occurrence in pool:
+        occurrence.calendar_index, occurrence.calendar = calendars_by_id.get(
+            occurrence.event.calendar_id, (None, None))
+    pool.sort()
+    for period in period_objects.values():
+        period.occurrence_pool = pool
+    return render_to_response(template_name, {
+            'date': date,
+            'periods': period_objects,
+            'calendars': calendars,
+            'weekday_names': weekday_names,
+            'here': quote(request.get_full_path()),
+        }, context_instance=RequestContext(request))
+
 def event(request, event_id, template_name="schedule/event.html"):
     """
     This view is for showing an event. It is important to remember that an
@@ -127,7 +236,7 @@ def occurrence(request, event_id,
     ``back_url``
         the url from which this request was refered
     """
-    event, occurrence = get_occurrence(event_id, *args, **kwargs)
+    event, occurrence = get_occurrence(event_id, request=request, *args, **kwargs)
     back_url = request.META.get('HTTP_REFERER', None)
     return render_to_response(template_name, {
         'event': event,
@@ -138,10 +247,12 @@ def occurrence(request, event_id,
 
 @check_event_permissions
 def edit_occurrence(request, event_id,
-    template_name="schedule/edit_occurrence.html", *args, **kwargs):
-    event, occurrence = get_occurrence(event_id, *args, **kwargs)
-    next = kwargs.get('next', None)
-    form = OccurrenceForm(data=request.POST or None, instance=occurrence)
+    template_name="schedule/edit_occurrence.html", check_conflicts=False,
+    *args, **kwargs):
+    next = kwargs.pop('next', None)
+    event, occurrence = get_occurrence(event_id, request=request, *args, **kwargs)
+    form = OccurrenceForm(data=request.POST or None, instance=occurrence,
+        check_conflicts=check_conflicts)
     if form.is_valid():
         occurrence = form.save(commit=False)
         occurrence.event = event
@@ -164,8 +275,9 @@ def cancel_occurrence(request, event_id,
     will cancel the view. If it is called with a GET it will ask for
     conformation to cancel.
     """
-    event, occurrence = get_occurrence(event_id, *args, **kwargs)
-    next = kwargs.get('next',None) or get_next_url(request, event.get_absolute_url())
+    next = kwargs.pop('next', None)
+    event, occurrence = get_occurrence(event_id, request=request, *args, **kwargs)
+    next = next or get_next_url(request, event.get_absolute_url())
     if request.method != "POST":
         return render_to_response(template_name, {
             "occurrence": occurrence,
@@ -175,23 +287,61 @@ def cancel_occurrence(request, event_id,
     return HttpResponseRedirect(next)
 
 
+def get_event(request, event_id):
+    """
+    Returns the event with ``event_id``, taken from the request cache when
+    check_event_permissions already loaded it, or raises Http404.
+    """
+    cache = get_request_cache(request)
+    try:
+        key = ('event', int(event_id))
+    except (TypeError, ValueError):
+        raise Http404
+    if key not in cache:
+        cache[key] = get_object_or_404(Event.objects.select_related('calendar', 'rule'),
+            id=event_id)
+    return cache[key]
+
 def get_occurrence(event_id, occurrence_id=None, year=None, month=None,
-    day=None, hour=None, minute=None, second=None):
+    day=None, hour=None, minute=None, second=None, request=None):
     """
     Because occurrences don't have to be persisted, there must be two ways to
     retrieve them. both need an event, but if its persisted the occurrence can
     be retrieved with an id. If it is not persisted it takes a date to
     retrieve it.  This function returns an event and occurrence regardless of
     which method is used.
+
+    Given the ``request``, the event comes from the request cache (see
+    get_event) and the occurrence is kept there, so an occurrence is resolved
+    once per request.
     """
+    if request is not None:
+        cache = get_request_cache(request)
+        key = ('occurrence', event_id, occurrence_id, year, month, day, hour,
+            minute, second)
+        if key not in cache:
+            cache[key] = _get_occurrence(get_event(request, event_id),
+                occurrence_id, year, month, day, hour, minute, second)
+        return cache[key]
     if(occurrence_id):
         occurrence = get_object_or_404(Occurrence, id=occurrence_id)
-        event = occurrence.event
-    elif(all((year, month, day, hour, minute, second))):
-        event = get_object_or_404(Event, id=event_id)
-        occurrence = event.get_occurrence(
-            datetime.datetime(int(year), int(month), int(day), int(hour),
-                int(minute), int(second)))
+        occurrence.set_event(occurrence.event)
+        return occurrence.event, occurrence
+    return _get_occurrence(get_object_or_404(Event, id=event_id), None, year,
+        month, day, hour, minute, second)
+
+def _get_occurrence(event, occurrence_id, year, month, day, hour, minute,
+    second):
+    if occurrence_id:
+        occurrence = get_object_or_404(Occurrence, id=occurrence_id, event=event)
+        occurrence.set_event(event)
+    elif all((year, month, day, hour, minute, second)):
+        try:
+            date = datetime.datetime(int(year), int(month), int(day),
+                int(hour), int(minute), int(second))
+        except ValueError:
+            raise Http404
+        occurrence = event.get_occurrence(date)
         if occurrence is None:
             raise Http404
     else:
@@ -201,7 +351,8 @@ def get_occurrence(event_id, occurrence_id=None, year=None, month=None,
 
 @check_event_permissions
 def create_or_edit_event(request, calendar_slug, event_id=None, next=None,
-    template_name='schedule/create_event.html', form_class = EventForm):
+    template_name='schedule/create_event.html', form_class = EventForm,
+    check_conflicts=False):
     """
     This function, if it receives a GET request or if given an invalid form in a
     POST request it will generate the following response
@@ -232,6 +383,9 @@ def create_or_edit_event(request, calendar_slug, event_id=None, next=None,
     # Try to find a 'next' GET variable
     # If the key word argument redirect is set
     # Lastly redirect to the event detail of the recently create event
+
+    If ``check_conflicts`` is True the form will refuse an event that overlaps
+    the occurrences of another event in the calendar.
     """
     date = coerce_date_dict(request.GET)
     initial_data = None
@@ -249,12 +403,15 @@ def create_or_edit_event(request, calendar_slug, event_id=None, next=None,
 
     instance = None
     if event_id is not None:
-        instance = get_object_or_404(Event, id=event_id)
+        instance = get_event(request, event_id)
 
     calendar = get_object_or_404(Calendar, slug=calendar_slug)
 
+    form_kwargs = {}
+    if check_conflicts:
+        form_kwargs = {'check_conflicts': True, 'calendar': calendar}
     form = form_class(data=request.POST or None, instance=instance,
-        hour24=True, initial=initial_data)
+        hour24=True, initial=initial_data, **form_kwargs)
 
     if form.is_valid():
         event = form.save(commit=False)
@@ -284,7 +441,7 @@ def delete_event(request, event_id, next=None, login_required=True):
     # If the key word argument redirect is set
     # Lastly redirect to the event detail of the recently create event
     """
-    event = get_object_or_404(Event, id=event_id)
+    event = get_event(request, event_id)
     next = next or reverse('day_calendar', args=[event.calendar.slug])
     next = get_next_url(request, next)
     return delete_object(request,
@@ -296,6 +453,179 @@ def delete_event(request, event_id, next=None, login_required=True):
                          login_required = login_required
                         )
 
+def free_busy(request, calendar_slugs=None):
+    """
+    This view returns the busy time of a set of calendars, merged together,
+    for the window designated by the ``start`` and ``end`` GET variables
+    (``YYYY-MM-DD`` or ``YYYY-MM-DDTHH:MM:SS``).  The calendars are taken from
+    ``calendar_slugs`` or from every ``calendar`` GET variable.
+
+    If the ``format`` GET variable is ``ics`` the result is returned as an
+    iCalendar VFREEBUSY component, otherwise it is returned as JSON:
+
+        {
+            "start": "2009-01-01T00:00:00",
+            "end": "2009-02-01T00:00:00",
+            "busy": [["2009-01-02T08:00:00", "2009-01-02T09:00:00"], ...]
+        }
+    """
+    if calendar_slugs is None:
+        calendar_slugs = request.GET.getlist('calendar')
+    calendars = Calendar.objects.filter(slug__in=calendar_slugs)
+    try:
+        start = coerce_datetime(request.GET.get('start'))
+        end = coerce_datetime(request.GET.get('end'))
+    except ValueError:
+        raise Http404
+    if not calendar_slugs or end <= start:
+        raise Http404
+    busy = get_free_busy(calendars, start, end)
+    if request.GET.get('format') == 'ics':
+        cal = vobject.iCalendar()
+        cal.add('method').value = 'PUBLISH'
+        vfreebusy = cal.add('vfreebusy')
+        vfreebusy.add('uid').value = '%s-%s' % (
+            '+'.join(calendar_slugs), start.strftime('%Y%m%dT%H%M%S'))
+        vfreebusy.add('dtstamp').value = datetime.datetime.now()
+        vfreebusy.add('dtstart').value = start
+        vfreebusy.add('dtend').value = end
+        for busy_start, busy_end in busy:
+            vfreebusy.add('freebusy').value = [(busy_start, busy_end)]
+        response = HttpResponse(cal.serialize())
+        response['Content-Type'] = 'text/calendar'
+        return response
+    return HttpResponse(simplejson.dumps({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'busy': [(s.isoformat(), e.isoformat()) for s, e in busy],
+    }), mimetype='application/json')
+
+def next_available_slots(request, calendar_slugs=None, max_count=100,
+    max_days=366):
+    """
+    This view returns, as JSON, the next free slots that are common to a set
+    of calendars.  The calendars are taken from ``calendar_slugs`` or from
+    every ``calendar`` GET variable.  The search is controlled with these GET
+    variables:
+
+    ``duration``
+        the length of a slot in minutes (required)
+
+    ``count``
+        how many slots to return, at most ``max_count``. Defaults to 1.
+
+    ``after``
+        search from this datetime on. Defaults to now.
+
+    ``until``
+        do not search past this datetime, which is at most ``max_days`` days
+        after ``after``. Defaults to that.
+
+    ``day_start`` and ``day_end``
+        the working hours (``HH:MM``) slots have to fit in. A duration that
+        does not fit in them is a 404.
+
+    ``weekdays``
+        a comma separated list of the weekdays (0 is Monday) slots may fall on.
+
+    The response looks like this:
+
+        {"slots": [["2009-01-02T09:00:00", "2009-01-02T09:30:00"], ...]}
+    """
+    if calendar_slugs is None:
+        calendar_slugs = request.GET.getlist('calendar')
+    if not calendar_slugs:
+        raise Http404
+    try:
+        duration = datetime.timedelta(minutes=int(request.GET['duration']))
+        count = min(int(request.GET.get('count', 1)), max_count)
+        working_hours = weekdays = None
+        after = datetime.datetime.now()
+        if 'after' in request.GET:
+            after = coerce_datetime(request.GET['after'])
+        until = after + datetime.timedelta(days=max_days)
+        if 'until' in request.GET:
+            until = min(coerce_datetime(request.GET['until']), until)
+        if 'day_start' in request.GET or 'day_end' in request.GET:
+            working_hours = tuple([
+                datetime.time(*time.strptime(request.GET.get(key, default), '%H:%M')[3:5])
+                for key, default in (('day_start', '00:00'), ('day_end', '23:59'))])
+        if 'weekdays' in request.GET:
+            weekdays = [int(day) for day in request.GET['weekdays'].split(',')]
+        events = get_events_for_calendars(
+            Calendar.objects.filter(slug__in=calendar_slugs))
+        slots = find_free_slots(events, duration, after, count,
+            working_hours, weekdays, until, max_days)
+    except (KeyError, ValueError, OverflowError):
+        raise Http404
+    return HttpResponse(simplejson.dumps({
+        'slots': [(s.isoformat(), e.isoformat()) for s, e in slots],
+    }), mimetype='application/json')
+
+def occurrences_api_etag(request, calendar_slug, max_days=366):
+    """
+    The ETag of an occurrence list. It depends on the calendar, the query
+    string and the user, who may see other events through GET_EVENTS_FUNC.
+    """
+    stamp = Calendar.objects.get_version(slug=calendar_slug)
+    if stamp is None:
+        return None
+    if request.user.is_authenticated():
+        user = request.user.pk
+    else:
+        user = 'anonymous'
+    return make_etag(stamp[0], stamp[1], request.get_full_path(), user)
+
+def occurrences_api_last_modified(request, calendar_slug, max_days=366):
+    stamp = Calendar.objects.get_version(slug=calendar_slug)
+    if stamp is None:
+        return None
+    return stamp[1]
+
+@condition(etag_func=occurrences_api_etag,
+    last_modified_func=occurrences_api_last_modified)
+def occurrences_api(request, calendar_slug, max_days=366):
+    """
+    This view returns, as compact JSON, the occurrences of a calendar between
+    the ``start`` and ``end`` GET variables (``YYYY-MM-DD`` or
+    ``YYYY-MM-DDTHH:MM:SS``), already replaced by their persisted
+    counterparts.  The window can be at most ``max_days`` long.  The events
+    are the ones GET_EVENTS_FUNC returns, like in calendar_by_periods.
+
+    The response looks like this:
+
+        {"occurrences": [{"start": "2009-01-02T08:00:00",
+                          "end": "2009-01-02T09:00:00",
+                          "event": 1,
+                          "title": "Breakfast",
+                          "cancelled": false,
+                          "id": null}, ...]}
+
+    ``id`` is the id of the persisted occurrence, or null when the
+    occurrence has never been saved.
+    """
+    calendar = get_object_or_404(Calendar, slug=calendar_slug)
+    try:
+        start = coerce_datetime(request.GET.get('start'))
+        end = coerce_datetime(request.GET.get('end'))
+    except ValueError:
+        raise Http404
+    if end <= start or end - start > datetime.timedelta(days=max_days):
+        raise Http404
+    events = GET_EVENTS_FUNC(request, calendar)
+    occurrences = EventListManager(events).get_occurrences(start, end)
+    occurrences.sort(key=lambda occ: (occ.start, occ.end, occ.event.id))
+    return HttpResponse(simplejson.dumps({
+        'occurrences': [{
+            'start': occ.start.isoformat(),
+            'end': occ.end.isoformat(),
+            'event': occ.event.id,
+            'title': occ.title,
+            'cancelled': occ.cancelled,
+            'id': occ.id,
+        } for occ in occurrences],
+    }, separators=(',', ':')), mimetype='application/json')
+
 def check_next_url(next):
     """
     Checks to make sure the next url is not redirecting to another page.